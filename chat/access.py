@@ -0,0 +1,125 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from .models import ChatRoom
+
+
+class RoomCache:
+    """
+    Room metadata, cached in two tiers: a small per-process LRU with a short
+    TTL in front of the shared Django cache (Redis, see CACHES). Membership
+    is cached per (room, user) in the shared cache only, under keys that
+    include the room entry's random `version`.
+
+    The signals in chat.signals drop a room's entry once a change to the
+    room or its participants is committed. The reload picks a new version, so every
+    membership answer for the room goes stale at once. Other processes
+    catch up within the local TTL.
+    """
+    def __init__(self, maxsize=1024, local_ttl=5, shared_ttl=300):
+        self.maxsize = maxsize
+        self.local_ttl = local_ttl
+        self.shared_ttl = shared_ttl
+        self.local = OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, room_id):
+        return f'chat:room:{room_id}'
+
+    def membership_key(self, room, user_id):
+        return f'chat:room:{room["id"]}:{room["version"]}:member:{user_id}'
+
+    def get(self, room_id):
+        """
+        Return {'id', 'name', 'is_private', 'creator_id', 'member_count',
+        'version'} for the room, or None if it does not exist
+        """
+        room_id = str(room_id)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.local.get(room_id)
+            if entry is not None and entry[1] > now:
+                self.local.move_to_end(room_id)
+                return entry[0]
+
+        room = cache.get(self.key(room_id))
+        if room is None:
+            room = self.load(room_id)
+            if room is None:
+                return None
+            cache.set(self.key(room_id), room, self.shared_ttl)
+
+        with self.lock:
+            self.local[room_id] = (room, now + self.local_ttl)
+            self.local.move_to_end(room_id)
+            while len(self.local) > self.maxsize:
+                self.local.popitem(last=False)
+        return room
+
+    def load(self, room_id):
+        try:
+            room = ChatRoom.objects.values('id', 'name', 'is_private', 'creator_id').get(id=room_id)
+        except (ChatRoom.DoesNotExist, ValidationError, ValueError):
+            return None
+        room['member_count'] = ChatRoom.participants.through.objects.filter(chatroom_id=room['id']).count()
+        room['version'] = uuid.uuid4().hex
+        return room
+
+    def invalidate(self, room_id):
+        # After commit: dropping the entry inside the transaction would let
+        # another request cache the old membership again before the change
+        # is visible
+        room_id = str(room_id)
+        transaction.on_commit(lambda: self.drop(room_id))
+
+    def drop(self, room_id):
+        with self.lock:
+            self.local.pop(room_id, None)
+        cache.delete(self.key(room_id))
+
+    def is_member(self, room_id, user):
+        """
+        True if the user created or participates in the room
+        """
+        room = self.get(room_id)
+        if room is None or not user.is_authenticated:
+            return False
+        if user.id == room['creator_id']:
+            return True
+        key = self.membership_key(room, user.id)
+        member = cache.get(key)
+        if member is None:
+            member = ChatRoom.participants.through.objects.filter(chatroom_id=room['id'], user_id=user.id).exists()
+            cache.set(key, member, self.shared_ttl)
+        return member
+
+    def can_view(self, room_id, user):
+        """
+        True if the room exists and is public, or the user is a member
+        """
+        room = self.get(room_id)
+        if room is None:
+            return False
+        return not room['is_private'] or self.is_member(room_id, user)
+
+
+_room_cache = None
+
+
+def get_room_cache():
+    """
+    Return the per-process RoomCache, creating it on first use
+    """
+    global _room_cache
+    if _room_cache is None:
+        _room_cache = RoomCache(
+            maxsize=settings.CHAT_ROOM_CACHE_SIZE,
+            local_ttl=settings.CHAT_ROOM_CACHE_LOCAL_TTL,
+            shared_ttl=settings.CHAT_ROOM_CACHE_TTL,
+        )
+    return _room_cache
@@ -1,39 +1,236 @@
+from django import forms
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.views.main import ORDER_VAR, PAGE_VAR, ChangeList
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.widgets import AutocompleteSelect
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
-from .models import ChatRoom, Message, UserProfile, Notification
+from .models import ArchivedMessage, ChatRoom, Message, UserProfile, Notification
+
+# Query string parameter of the "older" keyset link
+KEYSET_VAR = 'before'
+
+
+def estimated_row_count(model, using='default'):
+    """
+    The database's own idea of a table's size, read without scanning it;
+    None where the backend keeps no estimate
+    """
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [table])
+        elif connection.vendor == 'mysql':
+            cursor.execute(
+                'SELECT table_rows FROM information_schema.tables '
+                'WHERE table_schema = DATABASE() AND table_name = %s', [table]
+            )
+        elif connection.vendor == 'sqlite':
+            # Read from the end of the rowid b-tree; an upper bound, as
+            # deleted rows are not subtracted
+            cursor.execute(f'SELECT MAX(rowid) FROM {connection.ops.quote_name(table)}')
+        else:
+            return None
+        row = cursor.fetchone()
+    if row is None or row[0] is None or row[0] < 0:
+        return None
+    return int(row[0])
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that never runs COUNT(*) over a whole large table: unfiltered
+    lists use the database's estimate once it is past
+    CHAT_ADMIN_EXACT_COUNT_LIMIT, and filtered lists count at most that
+    many rows. Deeper rows are reached through the keyset "older" link.
+    """
+    @cached_property
+    def count(self):
+        limit = settings.CHAT_ADMIN_EXACT_COUNT_LIMIT
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_row_count(queryset.model, queryset.db)
+            if estimate is not None and estimate > limit:
+                return estimate
+        return queryset[:limit].count()
+
+
+class KeysetChangeList(ChangeList):
+    """
+    ChangeList with "older"/"newest" links: ?before=<key of the last row>
+    continues the default ordering from where the page ended, which stays
+    cheap where deep page offsets do not
+    """
+    def __init__(self, request, *args, **kwargs):
+        self.keyset = request.GET.get(KEYSET_VAR)
+        self.older_url = None
+        self.newest_url = None
+        super().__init__(request, *args, **kwargs)
+
+    def get_filters_params(self, params=None):
+        params = super().get_filters_params(params)
+        params.pop(KEYSET_VAR, None)
+        return params
+
+    def get_queryset(self, request, exclude_parameters=None):
+        queryset = super().get_queryset(request, exclude_parameters)
+        if self.keyset:
+            try:
+                queryset = self.model_admin.keyset_filter(queryset, self.keyset)
+            except ValueError as e:
+                raise IncorrectLookupParameters(e)
+        return queryset
+
+    def get_results(self, request):
+        super().get_results(request)
+        if self.keyset:
+            self.newest_url = self.get_query_string(remove=[KEYSET_VAR, PAGE_VAR])
+        # Only meaningful in the default ordering, and on a full page
+        if ORDER_VAR in self.params or self.model_admin.keyset_key is None:
+            return
+        rows = list(self.result_list)
+        if len(rows) >= self.list_per_page:
+            self.older_url = self.get_query_string({KEYSET_VAR: self.model_admin.keyset_key(rows[-1])}, [PAGE_VAR])
+
+
+class AutocompleteFilter(admin.RelatedFieldListFilter):
+    """
+    Foreign-key filter rendered as the admin's autocomplete box, instead of
+    a link per related object (which loads the whole related table). The
+    related model's admin needs search_fields.
+    """
+    template = 'admin/chat/autocomplete_filter.html'
+
+    def __init__(self, field, request, params, model, model_admin, field_path):
+        super().__init__(field, request, params, model, model_admin, field_path)
+        choice_field = forms.ModelChoiceField(
+            queryset=field.remote_field.model._default_manager.all(),
+            widget=AutocompleteSelect(field, model_admin.admin_site),
+        )
+        self.rendered_widget = choice_field.widget.render(
+            self.lookup_kwarg,
+            self.lookup_val[-1] if self.lookup_val else None,
+            {'id': f'autocomplete_filter_{field_path}'},
+        )
+
+    def field_choices(self, field, request, model_admin):
+        # Choices come from the autocomplete view, as the user types
+        return []
+
+    def has_output(self):
+        return True
+
+    def choices(self, changelist):
+        yield {
+            'selected': self.lookup_val is None,
+            'query_string': changelist.get_query_string(remove=[self.lookup_kwarg, self.lookup_kwarg_isnull, PAGE_VAR, KEYSET_VAR]),
+            'display': _('All'),
+        }
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """
+    Changelist settings for tables with millions of rows: estimated counts,
+    no second unfiltered COUNT, no facet counts, and keyset navigation for
+    admins that define keyset_filter()/keyset_key()
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    show_facets = admin.ShowFacets.NEVER
+    change_list_template = 'admin/chat/keyset_change_list.html'
+    keyset_key = None
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    @property
+    def media(self):
+        media = super().media
+        for spec in self.list_filter:
+            if isinstance(spec, tuple) and issubclass(spec[1], AutocompleteFilter):
+                field = self.model._meta.get_field(spec[0])
+                return media + AutocompleteSelect(field, self.admin_site).media
+        return media
+
 
 @admin.register(ChatRoom)
-class ChatRoomAdmin(admin.ModelAdmin):
+class ChatRoomAdmin(LargeTableAdmin):
     list_display = ('name', 'creator', 'get_participants_count', 'is_private', 'created_at')
     list_filter = ('is_private', 'created_at')
+    list_select_related = ('creator',)
     search_fields = ('name', 'description', 'creator__username')
-    filter_horizontal = ('participants',)
-    
+    autocomplete_fields = ('creator', 'participants')
+
+    def get_queryset(self, request):
+        # One correlated COUNT per listed row rather than one query per row
+        participants = ChatRoom.participants.through.objects.filter(
+            chatroom_id=OuterRef('pk')
+        ).order_by().values('chatroom_id').annotate(count=Count('*')).values('count')
+        return super().get_queryset(request).annotate(participant_count=Coalesce(Subquery(participants), 0))
+
+    @admin.display(description=_('Participants'), ordering='participant_count')
     def get_participants_count(self, obj):
-        return obj.participants.count()
-    get_participants_count.short_description = _('Participants')
+        return obj.participant_count
 
 @admin.register(Message)
-class MessageAdmin(admin.ModelAdmin):
-    list_display = ('sender', 'room', 'content_preview', 'timestamp', 'is_read')
-    list_filter = ('timestamp', 'is_read', 'room')
+class MessageAdmin(LargeTableAdmin):
+    list_display = ('sender', 'room', 'content_preview', 'timestamp')
+    list_filter = (('room', AutocompleteFilter), ('sender', AutocompleteFilter), 'timestamp')
+    list_select_related = ('sender', 'room')
     search_fields = ('content', 'sender__username', 'room__name')
-    
+    ordering = ('-timestamp', '-id')
+    autocomplete_fields = ('room', 'sender')
+    raw_id_fields = ('parent_message',)
+
+    def keyset_filter(self, queryset, key):
+        return queryset.before(key)
+
+    def keyset_key(self, obj):
+        return obj.cursor
+
+    @admin.display(description=_('Content'))
     def content_preview(self, obj):
         return obj.content[:50] + '...' if len(obj.content) > 50 else obj.content
-    content_preview.short_description = _('Content')
+
+@admin.register(ArchivedMessage)
+class ArchivedMessageAdmin(MessageAdmin):
+    list_display = ('sender', 'room', 'content_preview', 'timestamp', 'archived_at')
+    raw_id_fields = ()
+
+    def has_add_permission(self, request):
+        # Rows only arrive through chat.archive
+        return False
 
 @admin.register(UserProfile)
 class UserProfileAdmin(admin.ModelAdmin):
     list_display = ('user', 'online_status', 'last_seen', 'language', 'theme')
     list_filter = ('online_status', 'language', 'theme')
+    list_select_related = ('user',)
     search_fields = ('user__username', 'user__email')
+    autocomplete_fields = ('user',)
 
 @admin.register(Notification)
-class NotificationAdmin(admin.ModelAdmin):
+class NotificationAdmin(LargeTableAdmin):
     list_display = ('user', 'message_preview', 'is_read', 'created_at')
-    list_filter = ('is_read', 'created_at')
-    
+    list_filter = (('user', AutocompleteFilter), 'is_read', 'created_at')
+    list_select_related = ('user', 'message')
+    ordering = ('-id',)
+    autocomplete_fields = ('user',)
+    raw_id_fields = ('message',)
+
+    def keyset_filter(self, queryset, key):
+        # Ids increase with created_at
+        return queryset.filter(id__lt=int(key))
+
+    def keyset_key(self, obj):
+        return obj.pk
+
+    @admin.display(description=_('Message'))
     def message_preview(self, obj):
         return obj.message.content[:50] + '...' if len(obj.message.content) > 50 else obj.message.content
-    message_preview.short_description = _('Message')
\ No newline at end of file
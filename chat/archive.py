@@ -0,0 +1,119 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import ArchivedMessage, Message, Notification, RoomReadState
+
+
+def archive_cutoff(days=None):
+    days = settings.CHAT_ARCHIVE_AFTER_DAYS if days is None else days
+    return timezone.now() - timedelta(days=days)
+
+
+def archivable(cutoff):
+    """
+    Hot messages older than `cutoff`, oldest first. A message with hot
+    replies waits until they are archived, so no hot reply ever points at
+    an archived parent (a parent with replies newer than the cutoff stays).
+    """
+    return Message.objects.filter(timestamp__lt=cutoff).exclude(
+        replies__isnull=False
+    ).order_by('timestamp', 'id')
+
+
+def archive_batch(cutoff, batch_size=1000):
+    """
+    Move one batch of messages older than `cutoff` to ArchivedMessage;
+    returns the number of messages moved
+    """
+    # Imported here: chat.search reads archived messages through this module
+    from .search import get_search_backend
+
+    with transaction.atomic():
+        rows = list(archivable(cutoff).values(
+            'id', 'room_id', 'sender_id', 'content', 'timestamp', 'parent_message_id'
+        )[:batch_size])
+        if not rows:
+            return 0
+        ids = [row['id'] for row in rows]
+        archived = [ArchivedMessage(**row) for row in rows]
+        ArchivedMessage.objects.bulk_create(archived, ignore_conflicts=True)
+        # Notifications of archived messages go with them; read cursors keep
+        # their timestamp and only lose the foreign key
+        Notification.objects.filter(message_id__in=ids).delete()
+        RoomReadState.objects.filter(last_read_message_id__in=ids).update(last_read_message=None)
+        # post_delete drops the messages' search entries; search covers both
+        # tables, so index them again as archived rows
+        Message.objects.filter(id__in=ids).delete()
+        get_search_backend().index(archived)
+    return len(rows)
+
+
+def archive_messages(days=None, batch_size=1000):
+    """
+    Archive every message older than `days` (CHAT_ARCHIVE_AFTER_DAYS by
+    default) in batches of short transactions; returns the number moved
+    """
+    cutoff = archive_cutoff(days)
+    total = 0
+    # Loop until nothing is left: archiving replies makes their parents eligible
+    while True:
+        moved = archive_batch(cutoff, batch_size)
+        if not moved:
+            return total
+        total += moved
+
+
+def attach_parents(messages):
+    """
+    Resolve `parent_message` on archived rows from whichever table holds the
+    parent, with one query per table
+    """
+    archived = [message for message in messages if isinstance(message, ArchivedMessage)]
+    parent_ids = {message.parent_message_id for message in archived if message.parent_message_id}
+    if not parent_ids:
+        return
+    parents = Message.objects.select_related('sender').in_bulk(parent_ids)
+    missing = parent_ids - set(parents)
+    if missing:
+        parents.update(ArchivedMessage.objects.select_related('sender').in_bulk(missing))
+    for message in archived:
+        message.parent_message = parents.get(message.parent_message_id)
+
+
+def newest_before(queryset, before, limit):
+    queryset = queryset.newest_first()
+    if before:
+        queryset = queryset.before(before)
+    return list(queryset[:limit])
+
+
+def message_page(room_id, before=None, limit=50):
+    """
+    Like MessageQuerySet.page() for a room, over hot and archived messages
+    together. A parent kept hot for its replies can be older than archived
+    messages, so neither table's rows are contiguous in time: both are read
+    under the same (timestamp, id) cursor and merged.
+    """
+    rows = newest_before(Message.objects.filter(room_id=room_id).for_display(), before, limit + 1)
+    rows += newest_before(ArchivedMessage.objects.filter(room_id=room_id).for_display(), before, limit + 1)
+    rows.sort(key=lambda message: (message.timestamp, message.id), reverse=True)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    attach_parents(rows)
+    return rows, has_more
+
+
+def fetch_messages(message_ids):
+    """
+    in_bulk() over both tables, for callers holding ids of possibly archived
+    messages (e.g. search hits)
+    """
+    messages = Message.objects.for_display().in_bulk(message_ids)
+    missing = set(message_ids) - set(messages)
+    if missing:
+        cold = ArchivedMessage.objects.for_display().in_bulk(missing)
+        attach_parents(list(cold.values()))
+        messages.update(cold)
+    return messages
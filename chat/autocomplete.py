@@ -0,0 +1,152 @@
+import hashlib
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from .models import ChatRoom, UserSearchTerm
+from .search import normalize_text
+
+# Upper bound of a term range: every term starting with `q` sorts below q + this
+RANGE_END = '\U0010ffff'
+MIN_TERM_LENGTH = 2
+# A full name can exceed the column (150 + 1 + 150); terms and queries are
+# cut to it, which is harmless for prefix matching
+MAX_TERM_LENGTH = UserSearchTerm._meta.get_field('term').max_length
+
+
+def normalize_name(value):
+    return ' '.join(normalize_text(value or '').lower().split())
+
+
+def user_terms(username, first_name, last_name):
+    """
+    Return {term: is_prefix} for the suffixes of the user's names that start
+    a word (after a space or punctuation such as "_" or "."), so a user has a
+    handful of terms rather than one per character. is_prefix marks terms
+    starting a whole name.
+    """
+    names = {
+        normalize_name(username),
+        normalize_name(first_name),
+        normalize_name(last_name),
+        normalize_name(f'{first_name} {last_name}'),
+    }
+    terms = {}
+    for name in names:
+        for start in range(len(name) - MIN_TERM_LENGTH + 1):
+            if start and (name[start - 1].isalnum() or not name[start].isalnum()):
+                continue
+            term = name[start:start + MAX_TERM_LENGTH]
+            terms[term] = terms.get(term, False) or start == 0
+    return terms
+
+
+def build_terms(user):
+    return [
+        UserSearchTerm(user_id=user.id, term=term, is_prefix=is_prefix)
+        for term, is_prefix in user_terms(user.username, user.first_name, user.last_name).items()
+    ]
+
+
+def index_user(user):
+    UserSearchTerm.objects.filter(user_id=user.id).delete()
+    UserSearchTerm.objects.bulk_create(build_terms(user))
+
+
+def rebuild_index(batch_size=1000, queryset=None, term_model=UserSearchTerm):
+    """
+    Rebuild the whole autocomplete index; returns the number of users indexed
+    """
+    queryset = User.objects.all() if queryset is None else queryset
+    term_model.objects.all().delete()
+    count = 0
+    batch = []
+    for user in queryset.only('id', 'username', 'first_name', 'last_name').order_by().iterator(chunk_size=batch_size):
+        batch.extend(
+            term_model(user_id=user.id, term=term, is_prefix=is_prefix)
+            for term, is_prefix in user_terms(user.username, user.first_name, user.last_name).items()
+        )
+        count += 1
+        if len(batch) >= batch_size * 10:
+            term_model.objects.bulk_create(batch, batch_size=batch_size)
+            batch = []
+    term_model.objects.bulk_create(batch, batch_size=batch_size)
+    return count
+
+
+def term_range(query):
+    return UserSearchTerm.objects.filter(term__gte=query, term__lt=query + RANGE_END).order_by('term')
+
+
+def matching_user_ids(query, limit, is_prefix):
+    # Over-fetch a little: one user can match through several terms
+    user_ids = term_range(query).filter(is_prefix=is_prefix).values_list('user_id', flat=True)[:limit * 3]
+    return list(dict.fromkeys(user_ids))
+
+
+def global_matches(query, limit):
+    """
+    Name-start and word-start matches for a query, shared by all users and
+    cached because short (hot) prefixes are requested constantly
+    """
+    key = f'chat:usersearch:v2:{limit}:{hashlib.md5(query.encode()).hexdigest()}'
+    matches = cache.get(key)
+    if matches is None:
+        matches = {
+            'prefix': matching_user_ids(query, limit, True),
+            'word': matching_user_ids(query, limit, False),
+        }
+        cache.set(key, matches, settings.CHAT_USER_SEARCH_CACHE_TTL)
+    return matches
+
+
+def contact_ids(user):
+    """
+    Ids of up to CHAT_USER_SEARCH_MAX_CONTACTS users sharing a room with
+    `user`, members of the most recently active rooms first. Cached per user
+    for CHAT_USER_SEARCH_CACHE_TTL: they only boost the ranking, so a
+    membership change may take that long to show.
+    """
+    key = f'chat:usersearch:contacts:{user.id}'
+    ids = cache.get(key)
+    if ids is None:
+        members = ChatRoom.participants.through.objects.filter(
+            chatroom_id__in=ChatRoom.objects.for_user(user).values('id')
+        ).exclude(user_id=user.id).order_by('-chatroom__updated_at').values_list('user_id', flat=True)
+        ids = []
+        seen = set()
+        for user_id in members.iterator():
+            if user_id not in seen:
+                seen.add(user_id)
+                ids.append(user_id)
+                if len(ids) >= settings.CHAT_USER_SEARCH_MAX_CONTACTS:
+                    break
+        cache.set(key, ids, settings.CHAT_USER_SEARCH_CACHE_TTL)
+    return ids
+
+
+def search_users(query, user, limit=10):
+    """
+    Rank users matching `query`: name-start matches before word-start
+    matches, and within each, people the user shares a room with first
+    """
+    query = normalize_name(query)[:MAX_TERM_LENGTH]
+    if len(query) < MIN_TERM_LENGTH:
+        return []
+
+    matches = global_matches(query, limit)
+    # One lookup per contact on the (user, term) index, not a scan of every
+    # term in the range, serves both match kinds
+    contact_matches = {'prefix': [], 'word': []}
+    contacts = contact_ids(user)
+    if contacts:
+        contact_terms = term_range(query).filter(user_id__in=contacts).order_by()
+        for user_id, is_prefix in contact_terms.values_list('user_id', 'is_prefix')[:limit * 6]:
+            contact_matches['prefix' if is_prefix else 'word'].append(user_id)
+
+    ranked = list(dict.fromkeys(
+        contact_matches['prefix'] + matches['prefix'] +
+        contact_matches['word'] + matches['word']
+    ))
+    ranked = [user_id for user_id in ranked if user_id != user.id][:limit]
+    users = User.objects.in_bulk(ranked)
+    return [users[user_id] for user_id in ranked if user_id in users]
@@ -0,0 +1,133 @@
+import hashlib
+import os
+from io import BytesIO
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile
+from django.utils.translation import gettext_lazy as _
+from PIL import Image, ImageOps, UnidentifiedImageError
+from .models import UserProfile
+from .preferences import invalidate_preferences
+
+# Extensions for the formats accepted as uploads
+UPLOAD_FORMATS = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp', 'GIF': '.gif'}
+
+
+def content_hash(chunks):
+    digest = hashlib.sha256()
+    for chunk in chunks:
+        digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+def validate_avatar(upload):
+    """
+    Check an uploaded avatar's byte size, format and pixel count (from the
+    header only, before anything is decoded) and give it a content-hashed
+    name; returns the upload
+    """
+    if upload.size > settings.CHAT_AVATAR_MAX_UPLOAD_SIZE:
+        raise ValidationError(
+            _('Avatar images may be at most %(size)d MB.'),
+            params={'size': settings.CHAT_AVATAR_MAX_UPLOAD_SIZE // (1024 * 1024)},
+        )
+    try:
+        upload.seek(0)
+        with Image.open(upload) as image:
+            image_format = image.format
+            width, height = image.size
+    except (UnidentifiedImageError, OSError):
+        raise ValidationError(_('Upload a valid image.'))
+    if image_format not in UPLOAD_FORMATS:
+        raise ValidationError(_('Avatars must be JPEG, PNG, WebP or GIF images.'))
+    if width * height > settings.CHAT_AVATAR_MAX_PIXELS:
+        raise ValidationError(_('Avatar image dimensions are too large.'))
+    upload.seek(0)
+    upload.name = content_hash(upload.chunks()) + UPLOAD_FORMATS[image_format]
+    upload.seek(0)
+    return upload
+
+
+class AvatarUploadHandler(FileUploadHandler):
+    """
+    Stops reading a file once it exceeds CHAT_AVATAR_MAX_UPLOAD_SIZE instead
+    of spooling all of it to disk; the field is listed in
+    request.oversized_uploads so the view can report it. Only the avatar
+    upload view installs it (request.upload_handlers), so other uploads are
+    not capped.
+    """
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        self.received = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > settings.CHAT_AVATAR_MAX_UPLOAD_SIZE:
+            if not hasattr(self.request, 'oversized_uploads'):
+                self.request.oversized_uploads = []
+            self.request.oversized_uploads.append(self.field_name)
+            raise SkipFile()
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
+
+
+def render_variant(image, size, image_format):
+    thumbnail = ImageOps.fit(image, (size, size), Image.LANCZOS)
+    output = BytesIO()
+    if image_format == 'WEBP':
+        thumbnail.save(output, 'WEBP', quality=80, method=4)
+    elif thumbnail.mode == 'RGBA':
+        thumbnail.save(output, 'PNG', optimize=True)
+    else:
+        thumbnail.save(output, 'JPEG', quality=85, optimize=True, progressive=True)
+    return output.getvalue()
+
+
+def generate_variants(avatar):
+    """
+    Write square WebP and JPEG/PNG (PNG when the image has transparency)
+    thumbnails of `avatar` for every CHAT_AVATAR_SIZES entry; returns
+    {size: {'webp': name, 'fallback': name}}.
+
+    Names are derived from the source's content, so they never change and
+    files that already exist are not rendered again.
+    """
+    with avatar.open('rb') as f:
+        data = f.read()
+    digest = content_hash([data])
+    storage = avatar.storage
+
+    with Image.open(BytesIO(data)) as source:
+        if source.width * source.height > settings.CHAT_AVATAR_MAX_PIXELS:
+            raise ValueError('avatar image dimensions are too large')
+        image = ImageOps.exif_transpose(source)
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+
+    fallback_ext = '.png' if has_alpha else '.jpg'
+    variants = {}
+    for size in settings.CHAT_AVATAR_SIZES:
+        names = {}
+        for kind, image_format, ext in (('webp', 'WEBP', '.webp'), ('fallback', None, fallback_ext)):
+            name = os.path.join(settings.CHAT_AVATAR_VARIANT_DIR, f'{digest}-{size}{ext}')
+            if not storage.exists(name):
+                name = storage.save(name, ContentFile(render_variant(image, size, image_format)))
+            names[kind] = name
+        variants[str(size)] = names
+    return variants
+
+
+def store_variants(profile):
+    """
+    Generate the profile's avatar variants and record them, unless the
+    avatar was replaced in the meantime
+    """
+    if not profile.avatar:
+        return
+    variants = generate_variants(profile.avatar)
+    updated = UserProfile.objects.filter(pk=profile.pk, avatar=profile.avatar.name).update(avatar_variants=variants)
+    if updated:
+        invalidate_preferences(profile.user_id)
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import time
+from collections import Counter, deque
+from .encoding import encode_frame
+from .server import TRANSPORT_EXTENSION
+
+logger = logging.getLogger(__name__)
+
+# Group events a client can lose without losing messages; shed first
+EPHEMERAL_EVENTS = frozenset({'typing_indicator', 'user_join', 'user_leave', 'read_receipts'})
+
+# Sent in place of a backlog the client could not keep up with; the client
+# refetches what it missed instead of receiving every queued frame
+RESYNC_FRAME = encode_frame({'type': 'resync'})
+
+# Policy outcomes per process: 'dropped' (ephemeral frame shed), 'resync'
+# (backlog collapsed) and 'disconnected' (socket closed as too slow)
+policy_counts = Counter()
+
+QUEUED = 'queued'
+DROPPED = 'dropped'
+RESYNC = 'resync'
+DISCONNECT = 'disconnected'
+
+
+class TransportWritable:
+    """
+    Streaming producer registered on a Daphne connection's Twisted transport.
+
+    Daphne's send() returns as soon as the frame is handed to Twisted, which
+    buffers whatever the socket cannot take yet, so a slow reader never
+    makes send() wait. Twisted pauses the transport's producer once that
+    buffer passes its bufferSize and resumes it when it drains; wait()
+    follows that state, so frames stay in the OutboundQueue (where the
+    slow-consumer policies see them) instead of piling up in Twisted.
+    """
+    def __init__(self, transport):
+        self.transport = transport
+        self.resumed = asyncio.Event()
+        self.resumed.set()
+        transport.registerProducer(self, True)
+
+    def pauseProducing(self):
+        self.resumed.clear()
+
+    def resumeProducing(self):
+        self.resumed.set()
+
+    def stopProducing(self):
+        # Connection lost: let the writer finish; sends are ignored from here
+        self.resumed.set()
+
+    async def wait(self):
+        await self.resumed.wait()
+
+    def close(self):
+        if getattr(self.transport, 'producer', None) is self:
+            self.transport.unregisterProducer()
+
+
+def transport_writable(scope):
+    """
+    A TransportWritable for the connection behind an ASGI scope, or None
+    when the server did not pass the transport (see server.ChatServer) or
+    the transport already has a producer
+    """
+    transport = scope.get('extensions', {}).get(TRANSPORT_EXTENSION, {}).get('transport')
+    if transport is None or not hasattr(transport, 'registerProducer'):
+        return None
+    try:
+        return TransportWritable(transport)
+    except RuntimeError:
+        return None
+
+
+class OutboundQueue:
+    """
+    Bounded per-connection queue between group events and the socket.
+
+    Frames are written by a single writer task, so a client that reads
+    slowly shows up as a growing queue here instead of as an unbounded
+    buffer in the server or a full channel in the channel layer. The writer
+    waits on `writable` (see TransportWritable) before each frame, for
+    servers whose send() does not wait for the socket. Once the
+    queue is `ephemeral_ratio` full, typing/presence/receipt frames are
+    dropped; when it is full the backlog is replaced by one resync frame;
+    more than `max_resyncs` resyncs within `resync_window` seconds and the
+    connection should be closed.
+    """
+    def __init__(self, send, capacity=200, ephemeral_ratio=0.5, max_resyncs=3, resync_window=60, writable=None):
+        self.send = send
+        self.writable = writable
+        self.capacity = capacity
+        self.ephemeral_limit = int(capacity * ephemeral_ratio)
+        self.max_resyncs = max_resyncs
+        self.resync_window = resync_window
+        self.frames = deque()
+        self.resyncs = deque()
+        self.ready = asyncio.Event()
+        self.writer = None
+        self.closed = False
+
+    def start(self):
+        self.writer = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self.writer is not None:
+            self.writer.cancel()
+            try:
+                await self.writer
+            except asyncio.CancelledError:
+                pass
+            self.writer = None
+        if self.writable is not None:
+            self.writable.close()
+
+    def put(self, event_type, text):
+        """
+        Queue a pre-encoded frame; returns the policy applied (QUEUED,
+        DROPPED, RESYNC or DISCONNECT)
+        """
+        if self.closed:
+            # Already given up on; the socket is being closed
+            return DROPPED
+        if event_type in EPHEMERAL_EVENTS and len(self.frames) >= self.ephemeral_limit:
+            return self.record(DROPPED)
+
+        if len(self.frames) >= self.capacity:
+            now = time.monotonic()
+            while self.resyncs and self.resyncs[0] < now - self.resync_window:
+                self.resyncs.popleft()
+            if len(self.resyncs) >= self.max_resyncs:
+                self.closed = True
+                self.frames.clear()
+                return self.record(DISCONNECT)
+            self.resyncs.append(now)
+            self.frames.clear()
+            self.frames.append(RESYNC_FRAME)
+            self.ready.set()
+            return self.record(RESYNC)
+
+        self.frames.append(text)
+        self.ready.set()
+        return QUEUED
+
+    def record(self, outcome):
+        policy_counts[outcome] += 1
+        if outcome != DROPPED:
+            logger.info('Slow consumer: %s (queue %d/%d)', outcome, len(self.frames), self.capacity)
+        return outcome
+
+    async def run(self):
+        while True:
+            await self.ready.wait()
+            while self.frames:
+                # The frame stays queued (and counted) until it can be written
+                if self.writable is not None:
+                    await self.writable.wait()
+                await self.send(self.frames.popleft())
+            self.ready.clear()
@@ -1,15 +1,80 @@
 import json
+import uuid
+from urllib.parse import parse_qs
+from channels.consumer import SyncConsumer
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 from django.utils import timezone
-from .models import ChatRoom, Message, UserProfile
+from django.utils.translation import gettext_lazy as _
+from .models import Message, Notification, RoomReadState, UserProfile
+from .persistence import get_batcher
+from .presence import get_presence_store
+from .preferences import get_preferences
+from .typing import get_typing_coalescer
+from .receipts import get_read_receipts
+from .replay import get_replay_buffer, missed_frames
+from .encoding import encode_frame
+from .access import get_room_cache
+from .avatars import store_variants
+from .archive import message_page
+from .backpressure import DISCONNECT, OutboundQueue, transport_writable
+from .metrics import InstrumentedConsumerMixin, group_send, track
+
+# Background channels served by `manage.py runworker <channel>`
+NOTIFICATION_CHANNEL = 'chat-notifications'
+MEDIA_CHANNEL = 'chat-media'
+
+class ChatConsumer(InstrumentedConsumerMixin, AsyncWebsocketConsumer):
+    frame_types = frozenset({'chat_message', 'typing', 'heartbeat', 'history_before', 'read', 'unread_counts'})
 
-class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        self.room_id = self.scope['url_route']['kwargs']['room_id']
-        self.room_group_name = f'chat_{self.room_id}'
         self.user = self.scope['user']
+        self.room_id = None
+        self.joined = False
+        room_id = self.scope['url_route']['kwargs']['room_id']
+        
+        # Resolve the room and authorize once for the lifetime of the socket
+        if not await database_sync_to_async(get_room_cache().can_view)(room_id, self.user):
+            await self.close()
+            return
+        
+        await self.accept()
+        await self.start()
+        
+        # A reconnecting client sends the cursor of the last message it saw;
+        # replay the gap from the room's recent-message buffer
+        query = parse_qs(self.scope.get('query_string', b'').decode(), keep_blank_values=True)
+        await self.enter_room(room_id, since=query['since'][0] if 'since' in query else None)
+
+    async def start(self):
+        self.joined = True
+        
+        # Room events go through a bounded queue with a slow-consumer policy
+        self.outbound = OutboundQueue(
+            self.send_text,
+            capacity=settings.CHAT_OUTBOUND_QUEUE_SIZE,
+            ephemeral_ratio=settings.CHAT_OUTBOUND_EPHEMERAL_RATIO,
+            max_resyncs=settings.CHAT_SLOW_CONSUMER_MAX_RESYNCS,
+            resync_window=settings.CHAT_SLOW_CONSUMER_WINDOW,
+            writable=transport_writable(self.scope),
+        )
+        self.outbound.start()
+        
+        # Register this socket with the presence store
+        if not isinstance(self.user, AnonymousUser):
+            await sync_to_async(get_presence_store().connect)(self.user.id, self.channel_name)
+
+    async def enter_room(self, room_id, since=None):
+        """
+        Start receiving the room's full event stream; the caller has
+        checked the user may view it
+        """
+        self.room_id = str(room_id)
+        self.room_group_name = f'chat_{self.room_id}'
+        self.is_member = await database_sync_to_async(get_room_cache().is_member)(self.room_id, self.user)
         
         # Join room group
         await self.channel_layer.group_add(
@@ -17,119 +82,225 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
         
-        await self.accept()
+        if since is not None:
+            await self.replay(since)
         
-        # Update user online status
         if not isinstance(self.user, AnonymousUser):
-            await self.update_user_status(True)
-            
-            # Send join notification
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'user_join',
-                    'user_id': str(self.user.id),
-                    'username': self.user.username,
-                    'timestamp': timezone.now().isoformat(),
-                }
-            )
+            # Send join notification; for members it doubles as a roster
+            # delta, so it carries what a roster row shows
+            avatar = None
+            if self.is_member:
+                avatar = (await database_sync_to_async(get_preferences)(self.user))['avatar']
+            await self.broadcast('user_join', {
+                'type': 'user_join',
+                'user_id': str(self.user.id),
+                'username': self.user.username,
+                'member': self.is_member,
+                'avatar': avatar,
+                'timestamp': timezone.now().isoformat(),
+            })
 
-    async def disconnect(self, close_code):
+    async def leave_room(self, online=True):
+        """
+        Stop following the room; `online` is False when the user's last
+        socket is closing, so rosters can mark them offline
+        """
         # Leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
         
-        # Update user online status
         if not isinstance(self.user, AnonymousUser):
-            await self.update_user_status(False)
+            get_typing_coalescer().update(
+                self.channel_layer, self.room_group_name, self.user.id, self.user.username, False
+            )
+            
+            # Everything broadcast while the room was open has been seen
+            if self.is_member:
+                await self.mark_room_read()
             
             # Send leave notification
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'user_leave',
-                    'user_id': str(self.user.id),
-                    'username': self.user.username,
-                    'timestamp': timezone.now().isoformat(),
-                }
-            )
+            await self.broadcast('user_leave', {
+                'type': 'user_leave',
+                'user_id': str(self.user.id),
+                'username': self.user.username,
+                'member': self.is_member,
+                'online': online,
+                'timestamp': timezone.now().isoformat(),
+            })
+        self.room_id = None
+
+    async def disconnect(self, close_code):
+        if not self.joined:
+            return
+        
+        # Drop this socket; the user stays online while other tabs remain
+        remaining = 0
+        if not isinstance(self.user, AnonymousUser):
+            remaining = await sync_to_async(get_presence_store().disconnect)(self.user.id, self.channel_name)
+        
+        if self.room_id is not None:
+            await self.leave_room(online=remaining > 0)
+        await self.outbound.stop()
 
     async def receive(self, text_data):
         text_data_json = json.loads(text_data)
         message_type = text_data_json.get('type', 'chat_message')
+        self.label_frame(message_type)
         
         if message_type == 'chat_message':
+            if not self.is_member:
+                await self.send(text_data=encode_frame({
+                    'type': 'error',
+                    'error': str(_('Access denied')),
+                }))
+                return
+            
             content = text_data_json['content']
             parent_id = text_data_json.get('parent_id')
             
-            # Save message to database
-            message = await self.save_message(content, parent_id)
+            if settings.CHAT_WRITE_BEHIND:
+                # Broadcast immediately; the batcher persists it shortly after
+                message = self.build_message(content, parent_id)
+                get_batcher().add(message)
+            else:
+                # Save message to database
+                message = await self.save_message(content, parent_id)
             
             # Send message to room group
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'chat_message',
-                    'message_id': str(message.id),
-                    'sender_id': str(self.user.id),
-                    'sender_username': self.user.username,
-                    'content': content,
-                    'timestamp': message.timestamp.isoformat(),
-                    'parent_id': parent_id,
-                }
-            )
+            text = await self.broadcast('chat_message', {
+                'type': 'chat_message',
+                'message_id': str(message.id),
+                'sender_id': str(self.user.id),
+                'sender_username': self.user.username,
+                'content': content,
+                'timestamp': message.timestamp.isoformat(),
+                'parent_id': parent_id,
+                'cursor': message.cursor,
+            })
+            await sync_to_async(get_replay_buffer().append)(self.room_id, message.cursor, text)
+            
+            # Lightweight delta for sockets following the room from the inbox
+            if settings.CHAT_MULTIPLEX:
+                await group_send(self.channel_layer, f'inbox_{self.room_id}', {
+                    'type': 'room_activity',
+                    'room_id': self.room_id,
+                    'text': encode_frame({
+                        'type': 'room_activity',
+                        'room_id': self.room_id,
+                        'message_id': str(message.id),
+                        'sender_id': str(self.user.id),
+                        'sender_username': self.user.username,
+                        'preview': content[:100],
+                        'timestamp': message.timestamp.isoformat(),
+                    }),
+                })
         elif message_type == 'typing':
-            await self.channel_layer.group_send(
+            # Only members can post, so only members can be typing (and
+            # is_member is False for anonymous users)
+            if not self.is_member:
+                return
+            # Coalesced into at most one room-wide frame per interval
+            get_typing_coalescer().update(
+                self.channel_layer,
                 self.room_group_name,
-                {
-                    'type': 'typing_indicator',
-                    'user_id': str(self.user.id),
-                    'username': self.user.username,
-                    'is_typing': text_data_json['is_typing'],
-                }
+                self.user.id,
+                self.user.username,
+                bool(text_data_json['is_typing'])
             )
+        elif message_type == 'heartbeat':
+            # Keeps this socket's presence entry from expiring
+            if not isinstance(self.user, AnonymousUser):
+                await sync_to_async(get_presence_store().heartbeat)(self.user.id, self.channel_name)
+        elif message_type == 'history_before':
+            # Older history is only sent back to the requesting socket
+            messages, has_more = await self.get_history(text_data_json.get('before'))
+            await self.send(text_data=encode_frame({
+                'type': 'history',
+                'messages': messages,
+                'has_more': has_more,
+                'next_cursor': messages[0]['cursor'] if has_more else None,
+            }))
+        elif message_type == 'read':
+            # Advance this member's read cursor; applied and broadcast in batches
+            if not self.is_member:
+                return
+            try:
+                timestamp, message_id = Message.decode_cursor(text_data_json.get('cursor'))
+            except ValueError:
+                return
+            get_read_receipts().update(
+                self.channel_layer, self.room_group_name, self.room_id, self.user.id, timestamp, message_id
+            )
+        elif message_type == 'unread_counts':
+            # Badge counts straight from the read-state counters
+            if not isinstance(self.user, AnonymousUser):
+                await self.send(text_data=encode_frame({
+                    'type': 'unread_counts',
+                    'rooms': await self.get_unread_counts(),
+                }))
 
-    async def chat_message(self, event):
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'chat_message',
-            'message_id': event['message_id'],
-            'sender_id': event['sender_id'],
-            'sender_username': event['sender_username'],
-            'content': event['content'],
-            'timestamp': event['timestamp'],
-            'parent_id': event.get('parent_id'),
-        }))
+    async def broadcast(self, handler, frame):
+        """
+        Encode the client frame once and fan it out to the room; recipients
+        forward the pre-encoded text without touching the payload. Returns
+        the encoded frame.
+        """
+        text = encode_frame(frame)
+        await group_send(self.channel_layer, self.room_group_name, {
+            'type': handler,
+            'text': text,
+        })
+        return text
 
-    async def user_join(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'user_join',
-            'user_id': event['user_id'],
-            'username': event['username'],
-            'timestamp': event['timestamp'],
-        }))
+    async def forward_frame(self, event):
+        if self.outbound.put(event['type'], event['text']) == DISCONNECT:
+            # Too slow to keep up even after resyncs: stop buffering for it
+            await self.discard_groups()
+            await self.close(code=4008)
 
-    async def user_leave(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'user_leave',
-            'user_id': event['user_id'],
-            'username': event['username'],
-            'timestamp': event['timestamp'],
-        }))
+    async def discard_groups(self):
+        if self.room_id is not None:
+            await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
 
-    async def typing_indicator(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'typing',
-            'user_id': event['user_id'],
-            'username': event['username'],
-            'is_typing': event['is_typing'],
-        }))
+    async def replay(self, since):
+        try:
+            frames, complete = await database_sync_to_async(missed_frames)(self.room_id, since)
+        except ValueError:
+            frames, complete = [], False
+        if not complete:
+            # More was missed than a replay may send: only a full reload fills the gap
+            await self.send(text_data=encode_frame({'type': 'reload'}))
+            return
+        for text in frames:
+            await self.send(text_data=text)
+
+    async def send_text(self, text):
+        await self.send(text_data=text)
+
+    # Group event handlers: all room events arrive pre-encoded
+    chat_message = forward_frame
+    user_join = forward_frame
+    user_leave = forward_frame
+    typing_indicator = forward_frame
+    read_receipts = forward_frame
+
+    def build_message(self, content, parent_id=None):
+        try:
+            parent_uuid = uuid.UUID(str(parent_id)) if parent_id else None
+        except ValueError:
+            parent_uuid = None
+        
+        return Message(
+            room_id=uuid.UUID(str(self.room_id)),
+            sender=self.user,
+            content=content,
+            parent_message_id=parent_uuid
+        )
 
     @database_sync_to_async
     def save_message(self, content, parent_id=None):
-        room = ChatRoom.objects.get(id=self.room_id)
         parent = None
         
         if parent_id:
@@ -138,23 +309,165 @@ class ChatConsumer(AsyncWebsocketConsumer):
             except Message.DoesNotExist:
                 pass
         
-        message = Message.objects.create(
-            room=room,
-            sender=self.user,
-            content=content,
-            parent_message=parent
-        )
+        # The room was resolved and authorized in connect()
+        with track('chat_ws_save_message'):
+            message = Message.objects.create(
+                room_id=self.room_id,
+                sender=self.user,
+                content=content,
+                parent_message=parent
+            )
         return message
 
     @database_sync_to_async
-    def update_user_status(self, status):
+    def mark_room_read(self):
+        last_message = Message.objects.filter(room_id=self.room_id).newest_first().only('id', 'timestamp').first()
+        RoomReadState.objects.mark_read(self.user.id, self.room_id, last_message)
+
+    @database_sync_to_async
+    def get_unread_counts(self):
+        return {str(room_id): count for room_id, count in RoomReadState.objects.counts_for(self.user).items()}
+
+    @database_sync_to_async
+    def get_history(self, before):
+        try:
+            messages, has_more = message_page(
+                self.room_id,
+                before=before,
+                limit=settings.CHAT_HISTORY_PAGE_SIZE
+            )
+        except ValueError:
+            return [], False
+        return [message.to_dict() for message in messages], has_more
+
+
+class MultiplexConsumer(ChatConsumer):
+    """
+    One socket for all of a client's rooms (ws/chat/).
+
+    Client frames:
+      {"type": "subscribe", "rooms": [id, ...]}    follow rooms from the inbox
+      {"type": "unsubscribe", "rooms": [id, ...]}
+      {"type": "focus", "room_id": id, "since": cursor}  open one room
+      {"type": "unfocus"}
+    plus every ChatConsumer frame, applied to the focused room.
+
+    Subscribed rooms only deliver "room_activity" deltas (sender, preview,
+    timestamp) for unread badges and previews; the focused room delivers the
+    full event stream, exactly like ChatConsumer.
+    """
+    frame_types = ChatConsumer.frame_types | {'subscribe', 'unsubscribe', 'focus', 'unfocus'}
+
+    async def connect(self):
+        self.user = self.scope['user']
+        self.room_id = None
+        self.joined = False
+        self.subscriptions = set()
+        
+        if isinstance(self.user, AnonymousUser):
+            await self.close()
+            return
+        
+        await self.accept()
+        await self.start()
+
+    async def disconnect(self, close_code):
+        if self.joined:
+            await self.unsubscribe(list(self.subscriptions))
+        await super().disconnect(close_code)
+
+    async def discard_groups(self):
+        await super().discard_groups()
+        await self.unsubscribe(list(self.subscriptions))
+
+    async def receive(self, text_data):
+        text_data_json = json.loads(text_data)
+        message_type = text_data_json.get('type')
+        self.label_frame(message_type)
+        
+        if message_type == 'subscribe':
+            await self.subscribe(text_data_json.get('rooms', []))
+        elif message_type == 'unsubscribe':
+            await self.unsubscribe(text_data_json.get('rooms', []))
+        elif message_type == 'focus':
+            await self.focus(text_data_json.get('room_id'), text_data_json.get('since'))
+        elif message_type == 'unfocus':
+            if self.room_id is not None:
+                await self.leave_room()
+        elif self.room_id is None:
+            await self.send(text_data=encode_frame({
+                'type': 'error',
+                'error': str(_('No room is focused')),
+            }))
+        else:
+            await super().receive(text_data)
+
+    async def subscribe(self, room_ids):
+        room_ids = [str(room_id) for room_id in room_ids]
+        room_ids = room_ids[:max(settings.CHAT_MULTIPLEX_MAX_ROOMS - len(self.subscriptions), 0)]
+        allowed, unread = await self.authorize_rooms(room_ids)
+        for room_id in allowed:
+            if room_id not in self.subscriptions:
+                await self.channel_layer.group_add(f'inbox_{room_id}', self.channel_name)
+                self.subscriptions.add(room_id)
+        await self.send(text_data=encode_frame({
+            'type': 'subscribed',
+            'rooms': allowed,
+            'unread': unread,
+        }))
+
+    async def unsubscribe(self, room_ids):
+        for room_id in map(str, room_ids):
+            if room_id in self.subscriptions:
+                await self.channel_layer.group_discard(f'inbox_{room_id}', self.channel_name)
+                self.subscriptions.discard(room_id)
+
+    async def focus(self, room_id, since=None):
+        room_id = str(room_id)
+        if room_id == self.room_id:
+            return
+        if self.room_id is not None:
+            await self.leave_room()
+        if not await database_sync_to_async(get_room_cache().can_view)(room_id, self.user):
+            await self.send(text_data=encode_frame({
+                'type': 'error',
+                'error': str(_('Access denied')),
+            }))
+            return
+        await self.enter_room(room_id, since=since)
+
+    async def room_activity(self, event):
+        # The focused room already delivers the full chat_message frame
+        if event['room_id'] != self.room_id:
+            await self.forward_frame(event)
+
+    @database_sync_to_async
+    def authorize_rooms(self, room_ids):
+        room_cache = get_room_cache()
+        allowed = [room_id for room_id in dict.fromkeys(room_ids) if room_cache.can_view(room_id, self.user)]
+        counts = RoomReadState.objects.counts_for(self.user)
+        return allowed, {str(room_id): count for room_id, count in counts.items() if str(room_id) in allowed}
+
+
+class NotificationWorker(SyncConsumer):
+    """
+    Background worker that fans out notifications for large rooms
+    """
+    def notification_fanout(self, event):
         try:
-            profile = UserProfile.objects.get(user=self.user)
-            profile.update_online_status(status)
-        except UserProfile.DoesNotExist:
-            # Create profile if it doesn't exist
-            UserProfile.objects.create(
-                user=self.user,
-                online_status=status,
-                last_seen=timezone.now()
-            )
\ No newline at end of file
+            message = Message.objects.select_related('room').get(id=event['message_id'])
+        except Message.DoesNotExist:
+            return
+        Notification.fan_out(message)
+
+
+class MediaWorker(SyncConsumer):
+    """
+    Background worker that renders avatar thumbnails after an upload
+    """
+    def avatar_variants(self, event):
+        profile = UserProfile.objects.filter(id=event['profile_id']).first()
+        # Skip uploads that were replaced before the worker got to them
+        if profile is None or profile.avatar.name != event['avatar']:
+            return
+        store_variants(profile)
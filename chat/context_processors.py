@@ -1,5 +1,6 @@
 from django.utils.translation import get_language
-from .models import UserProfile
+from .models import RoomReadState
+from .preferences import get_preferences
 
 def language_processor(request):
     """
@@ -21,15 +22,26 @@ def dark_mode_processor(request):
     """
     Add dark mode preference to template context
     """
+    # Set by UserPreferencesMiddleware; shared with views and LocaleMiddleware
+    preferences = getattr(request, 'user_preferences', None)
+    if preferences is None:
+        preferences = get_preferences(request.user)
     if request.user.is_authenticated:
-        try:
-            profile = UserProfile.objects.get(user=request.user)
-            theme = profile.theme
-        except UserProfile.DoesNotExist:
-            theme = 'auto'
+        theme = preferences['theme']
     else:
         theme = request.session.get('theme', 'auto')
     
     return {
         'theme': theme,
-    }
\ No newline at end of file
+        'user_preferences': preferences,
+    }
+
+def unread_processor(request):
+    """
+    Add the user's total unread message count (queried only if rendered)
+    """
+    if not request.user.is_authenticated:
+        return {'unread_total': 0}
+    return {
+        'unread_total': lambda: RoomReadState.objects.total_for(request.user),
+    }
@@ -0,0 +1,42 @@
+import json
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_dumps(obj):
+    return json.dumps(obj)
+
+
+def orjson_dumps(obj):
+    return orjson.dumps(obj).decode()
+
+
+_encoder = None
+
+
+def get_encoder():
+    """
+    Return the configured frame encoder (obj -> str). CHAT_JSON_ENCODER may
+    be 'auto' (orjson when installed, else json) or a dotted path.
+    """
+    global _encoder
+    if _encoder is None:
+        path = settings.CHAT_JSON_ENCODER
+        if path == 'auto':
+            _encoder = orjson_dumps if orjson is not None else json_dumps
+        else:
+            _encoder = import_string(path)
+    return _encoder
+
+
+def encode_frame(frame):
+    """
+    Serialize a client-bound WebSocket frame once so group events can carry
+    the text instead of every recipient re-encoding the same dict
+    """
+    return get_encoder()(frame)
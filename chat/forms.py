@@ -1,6 +1,7 @@
 from django import forms
 from django.contrib.auth.models import User
 from django.utils.translation import gettext_lazy as _
+from .avatars import validate_avatar
 from .models import ChatRoom, Message, UserProfile
 
 class ChatRoomForm(forms.ModelForm):
@@ -95,9 +96,20 @@ class UserProfileForm(forms.ModelForm):
             self.fields['last_name'].initial = self.instance.user.last_name
             self.fields['email'].initial = self.instance.user.email
     
+    def clean_avatar(self):
+        avatar = self.cleaned_data.get('avatar')
+        if avatar and 'avatar' in self.changed_data:
+            validate_avatar(avatar)
+        return avatar
+    
     def save(self, commit=True):
         profile = super().save(commit=False)
         
+        # Thumbnails of the previous image no longer apply; new ones are
+        # generated in the background (chat.avatars)
+        if 'avatar' in self.changed_data:
+            profile.avatar_variants = {}
+        
         # Update user fields
         if self.instance.user:
             self.instance.user.first_name = self.cleaned_data['first_name']
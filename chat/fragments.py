@@ -0,0 +1,71 @@
+import hashlib
+import json
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.template.loader import get_template
+from django.utils import timezone, translation
+from django.utils.safestring import mark_safe
+
+# Viewer-side variants of a message bubble
+SENT = 'sent'
+RECEIVED = 'received'
+
+
+def related_state(message):
+    """
+    Digest of everything a bubble shows besides the message's id and
+    timestamp: its text, the sender's name and avatar and the reply preview
+    """
+    sender = message.sender
+    try:
+        profile = sender.profile
+    except ObjectDoesNotExist:
+        profile = None
+    parent = message.parent_message
+    state = [
+        message.content,
+        sender.username,
+        profile.avatar.name if profile is not None and profile.avatar else '',
+        profile.avatar_variants if profile is not None else {},
+        [str(parent.id), parent.sender.username, parent.content] if parent is not None else None,
+    ]
+    return hashlib.sha256(json.dumps(state, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def fragment_key(message, variant, language, tz):
+    return f'chat:msg:v2:{message.id}:{variant}:{language}:{tz}:{related_state(message)}'
+
+
+def render_fragments(messages, user):
+    """
+    Rendered chat/message.html for each message, as seen by `user`, in
+    order. Fragments come from the default cache with one get_many; misses
+    are rendered and stored with one set_many.
+
+    Keys hold the message id, the sent/received variant, the active language
+    and time zone, and a digest of the message text, the sender's name and
+    avatar and the reply preview, all of which for_display() has already
+    loaded. An edit, or a profile or avatar change (including
+    store_variants' queryset update, which sends no signal), therefore
+    changes the key, and the stale fragments expire after
+    CHAT_MESSAGE_FRAGMENT_TTL.
+    """
+    language = translation.get_language()
+    tz = timezone.get_current_timezone_name()
+    variants = [SENT if message.sender_id == user.id else RECEIVED for message in messages]
+    keys = [fragment_key(message, variant, language, tz) for message, variant in zip(messages, variants)]
+    cached = cache.get_many(keys)
+
+    template = None
+    rendered = {}
+    fragments = []
+    for message, variant, key in zip(messages, variants, keys):
+        html = cached.get(key)
+        if html is None:
+            template = template or get_template('chat/message.html')
+            html = rendered[key] = template.render({'message': message, 'sent': variant == SENT})
+        fragments.append(mark_safe(html))
+    if rendered:
+        cache.set_many(rendered, settings.CHAT_MESSAGE_FRAGMENT_TTL)
+    return fragments
@@ -0,0 +1,25 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from chat.archive import archive_messages
+
+
+class Command(BaseCommand):
+    help = 'Move messages older than CHAT_ARCHIVE_AFTER_DAYS from Message to ArchivedMessage'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=float, default=settings.CHAT_ARCHIVE_AFTER_DAYS)
+        parser.add_argument('--batch-size', type=int, default=settings.CHAT_ARCHIVE_BATCH_SIZE)
+        parser.add_argument(
+            '--interval', type=float, default=0,
+            help='Keep running and archive every INTERVAL seconds (default: archive once and exit)'
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            moved = archive_messages(days=options['days'], batch_size=options['batch_size'])
+            if options['verbosity'] > 0:
+                self.stdout.write(f'Archived {moved} messages')
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
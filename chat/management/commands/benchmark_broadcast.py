@@ -0,0 +1,63 @@
+import json
+import time
+import uuid
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from chat.encoding import encode_frame
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class Command(BaseCommand):
+    help = 'Measure per-recipient CPU cost of room fan-out: per-handler json.dumps vs serialize-once'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, default=1000)
+        parser.add_argument('--rounds', type=int, default=20)
+        parser.add_argument('--content-length', type=int, default=200)
+
+    def handle(self, *args, **options):
+        frame = {
+            'type': 'chat_message',
+            'message_id': str(uuid.uuid4()),
+            'sender_id': '42',
+            'sender_username': 'benchmark',
+            'content': 'x' * options['content_length'],
+            'timestamp': timezone.now().isoformat(),
+            'parent_id': None,
+        }
+        recipients = options['recipients'] * options['rounds']
+
+        before = self.measure(lambda: dict(frame), self.rebuild_and_dump, recipients)
+        after = self.measure(lambda: {'type': 'chat_message', 'text': encode_frame(frame)}, self.forward, recipients)
+
+        self.stdout.write(f'layer serialization: {"msgpack (channels_redis)" if msgpack else "none (msgpack not installed)"}')
+        self.stdout.write(f'per-handler json.dumps: {before * 1e6:8.2f} us/recipient')
+        self.stdout.write(f'serialize-once:         {after * 1e6:8.2f} us/recipient ({before / after:.1f}x)')
+
+    def measure(self, build_event, handler, recipients):
+        start = time.process_time()
+        event = build_event()
+        for _i in range(recipients):
+            # channels_redis packs and unpacks the event for every recipient
+            delivered = msgpack.unpackb(msgpack.packb(event)) if msgpack else dict(event)
+            handler(delivered)
+        return (time.process_time() - start) / recipients
+
+    def rebuild_and_dump(self, event):
+        # The previous ChatConsumer.chat_message handler
+        return json.dumps({
+            'type': 'chat_message',
+            'message_id': event['message_id'],
+            'sender_id': event['sender_id'],
+            'sender_username': event['sender_username'],
+            'content': event['content'],
+            'timestamp': event['timestamp'],
+            'parent_id': event.get('parent_id'),
+        })
+
+    def forward(self, event):
+        return event['text']
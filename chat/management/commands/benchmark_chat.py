@@ -0,0 +1,235 @@
+import asyncio
+import json
+import platform
+import sys
+import time
+import uuid
+import django
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.base import SessionBase
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext, setup_databases, teardown_databases
+from django.utils import timezone
+from chat import views
+from chat.consumers import ChatConsumer
+from chat.models import ChatRoom, Message, RoomReadState
+
+# Single-process stand-ins for the Redis-backed services
+IN_MEMORY_SETTINGS = {
+    'CACHES': {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    'CHANNEL_LAYERS': {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    'CHAT_PRESENCE_BACKEND': 'chat.presence.LocalPresenceStore',
+    'CHAT_REPLAY_BACKEND': 'chat.replay.LocalReplayBuffer',
+}
+
+
+def percentiles(values):
+    """
+    p50/p95/p99/max of a list of seconds, in milliseconds
+    """
+    if not values:
+        return None
+    values = sorted(values)
+
+    def at(fraction):
+        return round(values[min(len(values) - 1, int(len(values) * fraction))] * 1000, 3)
+
+    return {'p50': at(0.50), 'p95': at(0.95), 'p99': at(0.99), 'max': round(values[-1] * 1000, 3)}
+
+
+class Command(BaseCommand):
+    help = (
+        'Offline benchmark suite: WebSocket fan-out through ChatConsumer and the index, room_detail '
+        'and send_message views, reported as JSON. Runs against a throwaway test database, '
+        'so the configured one is never written to'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--room-sizes', nargs='+', type=int, default=[10, 100])
+        parser.add_argument('--messages', type=int, default=100, help='Messages sent per room size')
+        parser.add_argument('--rate', type=float, default=0, help='Messages per second (default: as fast as possible)')
+        parser.add_argument('--view-rooms', type=int, default=50, help='Rooms the view benchmark user belongs to')
+        parser.add_argument('--view-messages', type=int, default=200, help='Messages in the room_detail room')
+        parser.add_argument('--repeat', type=int, default=20, help='Requests per view')
+        parser.add_argument(
+            '--channel-layer', choices=['memory', 'default'], default='memory',
+            help="'memory' uses the in-memory channel layer and local presence/replay stores; "
+                 "'default' uses the configured (Redis) services"
+        )
+        parser.add_argument('--skip', nargs='*', choices=['websocket', 'views'], default=[])
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        self.prefix = f'bench_suite_{uuid.uuid4().hex[:8]}'
+        report = {'meta': self.meta(options)}
+        overrides = IN_MEMORY_SETTINGS if options['channel_layer'] == 'memory' else {}
+        # Seeded rooms and messages go to a test database created for this
+        # run (as `manage.py test` would) and dropped afterwards
+        old_config = setup_databases(verbosity=0, interactive=False, aliases={'default'})
+        try:
+            with override_settings(**overrides):
+                if 'websocket' not in options['skip']:
+                    report['websocket'] = [
+                        self.benchmark_fanout(size, options['messages'], options['rate'])
+                        for size in options['room_sizes']
+                    ]
+                if 'views' not in options['skip']:
+                    report['views'] = self.benchmark_views(
+                        options['view_rooms'], options['view_messages'], options['repeat']
+                    )
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    def meta(self, options):
+        return {
+            'timestamp': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'channel_layer': options['channel_layer'],
+            'write_behind': settings.CHAT_WRITE_BEHIND,
+            'argv': sys.argv[1:],
+        }
+
+    def create_users(self, label, count):
+        User.objects.bulk_create(User(username=f'{self.prefix}_{label}_{i}') for i in range(count))
+        return list(User.objects.filter(username__startswith=f'{self.prefix}_{label}_').order_by('id'))
+
+    # WebSocket fan-out
+
+    def benchmark_fanout(self, room_size, messages, rate):
+        users = self.create_users(f'room{room_size}', room_size)
+        room = ChatRoom.objects.create(name=f'Benchmark {room_size}', creator=users[0])
+        room.participants.add(*users)
+        result = asyncio.run(self.fanout(room, users, messages, rate))
+        result.update(room_size=room_size, messages=messages, rate=rate or None)
+        return result
+
+    async def fanout(self, room, users, messages, rate):
+        communicators = []
+        for user in users:
+            communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{room.id}/')
+            communicator.scope['user'] = user
+            communicator.scope['url_route'] = {'kwargs': {'room_id': str(room.id)}}
+            connected, _subprotocol = await communicator.connect(timeout=30)
+            assert connected, 'benchmark socket was rejected'
+            communicators.append(communicator)
+
+        sent_at = {}
+        latencies = []
+
+        async def receive(communicator):
+            received = 0
+            while received < messages:
+                frame = json.loads(await communicator.receive_from(timeout=60))
+                if frame['type'] == 'chat_message':
+                    latencies.append(time.perf_counter() - sent_at[frame['content']])
+                    received += 1
+
+        # Queries run on the database thread used by database_sync_to_async
+        queries = CaptureQueriesContext(connection)
+        await database_sync_to_async(queries.__enter__)()
+
+        sender, recipients = communicators[0], communicators[1:]
+        receivers = [asyncio.ensure_future(receive(communicator)) for communicator in recipients]
+        start = time.perf_counter()
+        for i in range(messages):
+            content = f'benchmark {i}'
+            sent_at[content] = time.perf_counter()
+            await sender.send_to(text_data=json.dumps({'type': 'chat_message', 'content': content}))
+            await asyncio.sleep(1 / rate if rate else 0)
+        await asyncio.gather(*receivers)
+        elapsed = time.perf_counter() - start
+
+        await database_sync_to_async(queries.__exit__)(None, None, None)
+        query_count = await database_sync_to_async(lambda: len(queries))()
+        for communicator in communicators:
+            await communicator.disconnect()
+
+        return {
+            'elapsed_s': round(elapsed, 3),
+            'messages_per_s': round(messages / elapsed, 1),
+            'deliveries_per_s': round(len(latencies) / elapsed, 1),
+            'fanout_latency_ms': percentiles(latencies),
+            'queries_per_message': round(query_count / messages, 2),
+        }
+
+    # Views
+
+    def benchmark_views(self, room_count, message_count, repeat):
+        user, other = self.create_users('views', 2)
+        rooms = ChatRoom.objects.bulk_create(
+            ChatRoom(name=f'Benchmark view room {i}', creator=other) for i in range(room_count)
+        )
+        ChatRoom.participants.through.objects.bulk_create(
+            ChatRoom.participants.through(chatroom_id=room.id, user_id=member.id)
+            for room in rooms
+            for member in (user, other)
+        )
+        RoomReadState.objects.bulk_create(
+            RoomReadState(user=member, room=room) for room in rooms for member in (user, other)
+        )
+        room = rooms[0]
+        Message.objects.bulk_create(
+            Message(room=room, sender=other, content=f'Seeded message {i}') for i in range(message_count)
+        )
+
+        factory = RequestFactory()
+
+        def get(path):
+            request = factory.get(path)
+            request.user = user
+            request.session = SessionBase()
+            return request
+
+        def post(path, body):
+            request = factory.post(path, data=json.dumps(body), content_type='application/json')
+            request.user = user
+            request.session = SessionBase()
+            return request
+
+        return {
+            'index': self.time_view('index', lambda: views.index(get('/')), repeat),
+            'room_detail': self.time_view('room_detail', lambda: views.room_detail(get(f'/room/{room.id}/'), room_id=room.id), repeat),
+            'send_message': self.time_view(
+                'send_message',
+                lambda: views.send_message(post(f'/api/room/{room.id}/send/', {'content': 'benchmark'}), room_id=room.id),
+                repeat
+            ),
+        }
+
+    def time_view(self, name, call, repeat):
+        timings = []
+        queries = []
+        status = None
+        for _i in range(repeat):
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                try:
+                    response = call()
+                except Exception as e:
+                    # A broken view fails the run: timing an exception is not a result
+                    raise CommandError(f'{name} failed: {type(e).__name__}: {e}') from e
+                timings.append(time.perf_counter() - start)
+            queries.append(len(captured.captured_queries))
+            status = response.status_code
+            if status >= 400:
+                raise CommandError(f'{name} returned HTTP {status}')
+        return {
+            'status': status,
+            'requests': repeat,
+            'latency_ms': percentiles(timings),
+            'queries_per_request': round(sum(queries) / len(queries), 2),
+        }
@@ -0,0 +1,55 @@
+import time
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from chat.models import ChatRoom, Message, Notification, RoomReadState
+
+
+class Command(BaseCommand):
+    help = 'Measure the inbox query for users in 10, 100 and 1,000 rooms (seeded data is rolled back)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[10, 100, 1000])
+        parser.add_argument('--messages-per-room', type=int, default=5)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        for size in options['sizes']:
+            with transaction.atomic():
+                user = self.seed(size, options['messages_per_room'])
+                timings = []
+                for _i in range(options['repeat']):
+                    with CaptureQueriesContext(connection) as ctx:
+                        start = time.perf_counter()
+                        rooms = list(ChatRoom.objects.inbox(user))
+                        timings.append(time.perf_counter() - start)
+                self.stdout.write(
+                    f'rooms={size:<6} fetched={len(rooms):<6} queries={len(ctx.captured_queries):<3} '
+                    f'best={min(timings) * 1000:.2f}ms mean={sum(timings) / len(timings) * 1000:.2f}ms'
+                )
+                transaction.set_rollback(True)
+
+    def seed(self, size, messages_per_room):
+        user = User.objects.create_user(f'bench_inbox_{size}')
+        other = User.objects.create_user(f'bench_inbox_other_{size}')
+        rooms = ChatRoom.objects.bulk_create(
+            ChatRoom(name=f'Room {i}', creator=other) for i in range(size)
+        )
+        ChatRoom.participants.through.objects.bulk_create(
+            ChatRoom.participants.through(chatroom_id=room.id, user_id=user.id)
+            for room in rooms
+        )
+        messages = Message.objects.bulk_create(
+            Message(room=room, sender=other, content=f'Message {n} in {room.name}')
+            for room in rooms
+            for n in range(messages_per_room)
+        )
+        Notification.objects.bulk_create(
+            Notification(user=user, message=message) for message in messages
+        )
+        RoomReadState.objects.bulk_create(
+            RoomReadState(user=user, room=room, unread_count=messages_per_room)
+            for room in rooms
+        )
+        return user
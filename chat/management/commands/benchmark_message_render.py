@@ -0,0 +1,81 @@
+import statistics
+import time
+import uuid
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.template.loader import get_template, render_to_string
+from django.utils import timezone, translation
+from chat.fragments import SENT, RECEIVED, fragment_key, render_fragments
+from chat.models import ChatRoom, Message, UserProfile
+
+
+class Command(BaseCommand):
+    help = 'Time rendering a page of room messages without, and with cold/warm, fragment caching (seeded data is deleted afterwards)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=200)
+        parser.add_argument('--senders', type=int, default=10)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def seed(self, prefix, count, senders):
+        users = [User.objects.create_user(f'{prefix}_{i}') for i in range(senders)]
+        for user in users:
+            UserProfile.objects.update_or_create(user=user, defaults={
+                'avatar': f'avatars/{user.username}.png',
+                'avatar_variants': {
+                    str(size): {'webp': f'avatars/variants/{user.username}-{size}.webp', 'fallback': f'avatars/variants/{user.username}-{size}.jpg'}
+                    for size in (32, 64)
+                },
+            })
+        room = ChatRoom.objects.create(name='Render benchmark', creator=users[0])
+        parent = None
+        for i in range(count):
+            parent = Message.objects.create(
+                room=room,
+                sender=users[i % senders],
+                content=f'Message {i}\nwith a second line and a <tag> to escape',
+                parent_message=parent if i % 3 == 0 else None,
+            )
+        return users[0], room
+
+    def time_ms(self, repeat, render, before=None):
+        samples = []
+        for _ in range(repeat):
+            if before:
+                before()
+            start = time.perf_counter()
+            render()
+            samples.append((time.perf_counter() - start) * 1000)
+        return statistics.median(samples)
+
+    def handle(self, *args, **options):
+        prefix = f'bench_render_{uuid.uuid4().hex[:6]}'
+        viewer, room = self.seed(prefix, options['messages'], options['senders'])
+        try:
+            messages, _has_more = room.messages.for_display().page(limit=options['messages'])
+            template = get_template('chat/message.html')
+            language, tz = translation.get_language(), timezone.get_current_timezone_name()
+            keys = [
+                fragment_key(message, SENT if message.sender_id == viewer.id else RECEIVED, language, tz)
+                for message in messages
+            ]
+
+            def uncached():
+                # What message_list.html did before fragments: render every bubble
+                for message in messages:
+                    template.render({'message': message, 'sent': message.sender_id == viewer.id})
+
+            page = lambda: render_to_string('chat/message_list.html', {'messages': messages, 'user': viewer})
+            evict = lambda: cache.delete_many(keys)
+            results = {
+                'uncached': self.time_ms(options['repeat'], uncached),
+                'cold cache': self.time_ms(options['repeat'], page, before=evict),
+                'warm cache': self.time_ms(options['repeat'], page, before=lambda: render_fragments(messages, viewer)),
+            }
+            for name, ms in results.items():
+                self.stdout.write(f'{name:>10}: {ms:8.2f} ms median for {len(messages)} messages')
+            cache.delete_many(keys)
+        finally:
+            room.delete()
+            User.objects.filter(username__startswith=prefix).delete()
@@ -0,0 +1,55 @@
+import asyncio
+import time
+from channels.db import database_sync_to_async
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from chat.models import ChatRoom, Message
+from chat.persistence import MessageBatcher
+
+
+class Command(BaseCommand):
+    help = 'Compare per-message persistence with the write-behind batcher (seeded data is deleted afterwards)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000)
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--flush-interval', type=float, default=0.05)
+
+    def handle(self, *args, **options):
+        user = User.objects.create_user('bench_writes')
+        room = ChatRoom.objects.create(name='Write benchmark', creator=user)
+        try:
+            count = options['messages']
+            direct = asyncio.run(self.per_message(room, user, count))
+            batched = asyncio.run(self.write_behind(room, user, count, options['batch_size'], options['flush_interval']))
+            self.stdout.write(f'per-message:  {count / direct:10.0f} msg/s ({direct:.2f}s for {count})')
+            self.stdout.write(f'write-behind: {count / batched:10.0f} msg/s ({batched:.2f}s for {count}, including final flush)')
+        finally:
+            user.delete()
+
+    async def per_message(self, room, user, count):
+        @database_sync_to_async
+        def save_message(content):
+            # Mirrors ChatConsumer.save_message
+            return Message.objects.create(
+                room=ChatRoom.objects.get(id=room.id),
+                sender=user,
+                content=content
+            )
+
+        start = time.perf_counter()
+        for i in range(count):
+            await save_message(f'direct {i}')
+        return time.perf_counter() - start
+
+    async def write_behind(self, room, user, count, batch_size, flush_interval):
+        batcher = MessageBatcher(batch_size=batch_size, flush_interval=flush_interval)
+        start = time.perf_counter()
+        for i in range(count):
+            batcher.add(Message(room_id=room.id, sender=user, content=f'batched {i}'))
+            # Yield like a consumer would between frames
+            await asyncio.sleep(0)
+        await batcher.close()
+        elapsed = time.perf_counter() - start
+        assert batcher.written == count, batcher.written
+        return elapsed
@@ -0,0 +1,88 @@
+import resource
+import time
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from chat.models import ChatRoom, Message
+from chat.search import get_search_backend
+from chat.transfer import export_chunks, import_history
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure bulk import and streaming export throughput for one large room, '
+        'e.g. --messages 10000000 (seeded data is deleted afterwards)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=100000)
+        parser.add_argument('--senders', type=int, default=50)
+        parser.add_argument('--reply-every', type=int, default=10, help='Every Nth message replies to the one before')
+        parser.add_argument('--batch-size', type=int, default=settings.CHAT_IMPORT_BATCH_SIZE)
+        parser.add_argument('--chunk-size', type=int, default=settings.CHAT_EXPORT_CHUNK_SIZE)
+        parser.add_argument('--format', choices=('ndjson', 'csv'), default='ndjson')
+
+    def records(self, count, senders, reply_every):
+        """
+        Synthetic export records, generated lazily like a file being read
+        """
+        start = timezone.now() - timedelta(seconds=count)
+        previous = None
+        for i in range(count):
+            record = {
+                'id': str(uuid.uuid4()),
+                'timestamp': (start + timedelta(seconds=i)).isoformat(),
+                'sender': senders[i % len(senders)],
+                'content': f'benchmark message {i}',
+                'parent_id': previous if reply_every and i % reply_every == 0 else None,
+            }
+            previous = record['id']
+            yield record
+
+    def handle(self, *args, **options):
+        if settings.DEBUG:
+            # connection.queries keeps every bulk INSERT's SQL, so RSS would grow with the room
+            self.stderr.write('DEBUG is on: peak RSS includes the query log; run with DEBUG=False')
+        prefix = f'bench_transfer_{uuid.uuid4().hex[:6]}'
+        senders = [f'{prefix}_{i}' for i in range(options['senders'])]
+        creator = User.objects.create_user(f'{prefix}_owner')
+        room = ChatRoom.objects.create(name='Transfer benchmark', creator=creator)
+        count = options['messages']
+        try:
+            start = time.perf_counter()
+            importer = import_history(
+                room, self.records(count, senders, options['reply_every']),
+                batch_size=options['batch_size'], create_users=True
+            )
+            elapsed = time.perf_counter() - start
+            self.stdout.write(
+                f'import: {count / elapsed:10.0f} msg/s ({elapsed:.2f}s for {importer.written}), '
+                f'peak RSS {peak_rss_mb():.0f} MB'
+            )
+
+            start = time.perf_counter()
+            size = 0
+            for chunk in export_chunks(room.id, options['format'], options['chunk_size']):
+                size += len(chunk.encode())
+            elapsed = time.perf_counter() - start
+            self.stdout.write(
+                f'export: {count / elapsed:10.0f} msg/s ({elapsed:.2f}s, {size / 2 ** 20:.1f} MB of {options["format"]}), '
+                f'peak RSS {peak_rss_mb():.0f} MB'
+            )
+        finally:
+            # Delete in batches, newest first so replies go before their parents;
+            # a cascading room.delete() would load every message
+            messages = Message.objects.filter(room=room)
+            while ids := list(messages.order_by('-timestamp', '-id').values_list('id', flat=True)[:options['batch_size']]):
+                get_search_backend().remove(ids)
+                Message.objects.filter(id__in=ids)._raw_delete(Message.objects.db)
+            room.delete()
+            User.objects.filter(username__startswith=prefix).delete()
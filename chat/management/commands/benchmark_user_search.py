@@ -0,0 +1,74 @@
+import random
+import string
+import time
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from chat import autocomplete
+from chat.models import UserSearchTerm
+
+
+class Command(BaseCommand):
+    help = 'Seed N users and compare icontains user search with the autocomplete index (seeded data is rolled back)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50000)
+        parser.add_argument('--queries', type=int, default=300)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        with transaction.atomic():
+            viewer = self.seed(options['users'], rng)
+            queries = [self.random_query(rng) for _i in range(options['queries'])]
+
+            self.report('icontains', [self.time(lambda q=q: list(
+                User.objects.filter(
+                    Q(username__icontains=q) | Q(first_name__icontains=q) | Q(last_name__icontains=q)
+                ).exclude(id=viewer.id)[:10]
+            )) for q in queries])
+
+            cache.clear()
+            self.report('index (cold)', [self.time(lambda q=q: autocomplete.search_users(q, viewer)) for q in queries])
+            self.report('index (warm)', [self.time(lambda q=q: autocomplete.search_users(q, viewer)) for q in queries])
+            transaction.set_rollback(True)
+
+    def seed(self, count, rng):
+        start = time.perf_counter()
+        User.objects.bulk_create(
+            (
+                User(
+                    username=f'bench_{i}_{self.word(rng, 6)}',
+                    first_name=self.word(rng, 6).capitalize(),
+                    last_name=self.word(rng, 8).capitalize(),
+                )
+                for i in range(count)
+            ),
+            batch_size=1000
+        )
+        users = User.objects.filter(username__startswith='bench_')
+        autocomplete.rebuild_index(queryset=users)
+        self.stdout.write(
+            f'seeded {count} users, {UserSearchTerm.objects.count()} index rows '
+            f'in {time.perf_counter() - start:.1f}s'
+        )
+        return User.objects.create_user('bench_viewer')
+
+    def word(self, rng, length):
+        return ''.join(rng.choice(string.ascii_lowercase) for _i in range(length))
+
+    def random_query(self, rng):
+        return self.word(rng, rng.choice([2, 3, 4]))
+
+    def time(self, func):
+        start = time.perf_counter()
+        func()
+        return time.perf_counter() - start
+
+    def report(self, label, timings):
+        timings = sorted(timings)
+        p50 = timings[len(timings) // 2] * 1000
+        p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000
+        self.stdout.write(f'{label:<14} p50={p50:7.2f}ms p99={p99:7.2f}ms')
@@ -0,0 +1,82 @@
+import re
+from collections import defaultdict
+from urllib.request import urlopen
+from django.core.management.base import BaseCommand, CommandError
+
+SAMPLE = re.compile(r'^(?P<name>[a-z_]+)(?:\{(?P<labels>.*)\})? (?P<value>\S+)$')
+LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def parse(text):
+    """
+    Histograms of a Prometheus text exposition, as
+    {(name, labels): {'buckets': [(le, cumulative)], 'sum': s, 'count': n}}
+    """
+    histograms = defaultdict(lambda: {'buckets': [], 'sum': 0.0, 'count': 0})
+    for line in text.splitlines():
+        match = SAMPLE.match(line)
+        if not match:
+            continue
+        labels = dict(LABEL.findall(match['labels'] or ''))
+        name, value = match['name'], float(match['value'])
+        for suffix in ('_bucket', '_sum', '_count'):
+            if name.endswith(suffix):
+                le = labels.pop('le', None)
+                series = histograms[(name[:-len(suffix)], tuple(sorted(labels.items())))]
+                if suffix == '_bucket':
+                    series['buckets'].append((float(le), value))
+                else:
+                    series[suffix[1:]] = value
+    return histograms
+
+
+def quantile(buckets, q):
+    """
+    Upper bound of the bucket holding the q-th quantile
+    """
+    if not buckets or not buckets[-1][1]:
+        return None
+    rank = q * buckets[-1][1]
+    for bound, cumulative in buckets:
+        if cumulative >= rank:
+            return bound
+    return buckets[-1][0]
+
+
+class Command(BaseCommand):
+    help = (
+        "Summarise a running server's /metrics/ endpoint (count, mean and p50/p95 bucket per series), "
+        "slowest first"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000/metrics/')
+        parser.add_argument('--raw', action='store_true', help='Print the exposition text unchanged')
+        parser.add_argument('--metric', help='Only series whose name contains this')
+
+    def handle(self, *args, **options):
+        try:
+            with urlopen(options['url'], timeout=10) as response:
+                text = response.read().decode()
+        except OSError as e:
+            raise CommandError(f"Could not fetch {options['url']}: {e}")
+
+        if options['raw']:
+            self.stdout.write(text)
+            return
+
+        rows = []
+        for (name, labels), series in parse(text).items():
+            if options['metric'] and options['metric'] not in name or not series['count']:
+                continue
+            scale, unit = (1000, 'ms') if name.endswith('_seconds') else (1, '')
+            mean = series['sum'] / series['count'] * scale
+            p50, p95 = (quantile(series['buckets'], q) for q in (0.5, 0.95))
+            rows.append((name, labels, int(series['count']), mean, p50 * scale, p95 * scale, unit))
+
+        for name, labels, count, mean, p50, p95, unit in sorted(rows, key=lambda row: (row[0], -row[3])):
+            label_text = ','.join(f'{key}={value}' for key, value in labels)
+            self.stdout.write(
+                f'{name}{{{label_text}}}  n={count}  mean={mean:.2f}{unit}  '
+                f'p50<={p50:g}{unit}  p95<={p95:g}{unit}'
+            )
@@ -0,0 +1,33 @@
+import sys
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from chat.models import ChatRoom
+from chat.transfer import FORMATS, export_chunks
+
+
+class Command(BaseCommand):
+    help = "Stream a room's full history (archived messages included) to a file or stdout as NDJSON or CSV"
+
+    def add_arguments(self, parser):
+        parser.add_argument('room_id')
+        parser.add_argument('--format', choices=FORMATS, default='ndjson')
+        parser.add_argument('--output', help='Write to this file instead of stdout')
+        parser.add_argument('--chunk-size', type=int, default=settings.CHAT_EXPORT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            room = ChatRoom.objects.get(id=options['room_id'])
+        except (ChatRoom.DoesNotExist, ValueError):
+            raise CommandError(f"No room {options['room_id']}")
+
+        start = time.perf_counter()
+        out = open(options['output'], 'w', encoding='utf-8', newline='') if options['output'] else sys.stdout
+        try:
+            for chunk in export_chunks(room.id, options['format'], options['chunk_size']):
+                out.write(chunk)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        if options['output'] and options['verbosity'] > 0:
+            self.stdout.write(f"Exported {room.name} to {options['output']} in {time.perf_counter() - start:.2f}s")
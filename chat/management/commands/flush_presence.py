@@ -0,0 +1,22 @@
+import time
+from django.core.management.base import BaseCommand
+from chat.presence import flush_last_seen
+
+
+class Command(BaseCommand):
+    help = 'Write last_seen/online_status from the presence store to UserProfile in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval', type=float, default=0,
+            help='Keep running and flush every INTERVAL seconds (default: flush once and exit)'
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            written = flush_last_seen()
+            if options['verbosity'] > 1:
+                self.stdout.write(f'Flushed {written} profiles')
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
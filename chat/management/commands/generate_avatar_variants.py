@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from chat.avatars import store_variants
+from chat.models import UserProfile
+
+
+class Command(BaseCommand):
+    help = 'Render avatar thumbnails for profiles that do not have them yet (e.g. avatars uploaded before variants existed)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Regenerate every avatar, e.g. after changing CHAT_AVATAR_SIZES')
+
+    def handle(self, *args, **options):
+        profiles = UserProfile.objects.exclude(avatar='').exclude(avatar__isnull=True)
+        if not options['all']:
+            profiles = profiles.filter(avatar_variants={})
+        done = failed = 0
+        for profile in profiles.iterator():
+            try:
+                store_variants(profile)
+                done += 1
+            except (OSError, ValueError) as e:
+                failed += 1
+                self.stderr.write(f'{profile.user_id}: {e}')
+        if options['verbosity'] > 0:
+            self.stdout.write(f'Generated variants for {done} avatars ({failed} failed)')
@@ -0,0 +1,44 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from chat.models import ChatRoom
+from chat.transfer import FORMATS, import_history, read_records
+
+
+class Command(BaseCommand):
+    help = 'Bulk import a room history in the export_room_history format (NDJSON or CSV), keeping ids, timestamps and replies'
+
+    def add_arguments(self, parser):
+        parser.add_argument('room_id')
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=FORMATS, help='Default: from the file extension')
+        parser.add_argument('--batch-size', type=int, default=settings.CHAT_IMPORT_BATCH_SIZE)
+        parser.add_argument(
+            '--create-users', action='store_true',
+            help='Create unknown senders as inactive users instead of failing'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            room = ChatRoom.objects.get(id=options['room_id'])
+        except (ChatRoom.DoesNotExist, ValueError):
+            raise CommandError(f"No room {options['room_id']}")
+        import_format = options['format'] or ('csv' if options['path'].endswith('.csv') else 'ndjson')
+
+        start = time.perf_counter()
+        with open(options['path'], encoding='utf-8', newline='') as source:
+            try:
+                importer = import_history(
+                    room, read_records(source, import_format),
+                    batch_size=options['batch_size'],
+                    create_users=options['create_users'],
+                )
+            except (KeyError, ValueError) as e:
+                raise CommandError(f'Import stopped: {e!r}')
+        elapsed = time.perf_counter() - start
+        if options['verbosity'] > 0:
+            self.stdout.write(
+                f'Imported {importer.written} messages into {room.name} in {elapsed:.2f}s '
+                f'({importer.written / elapsed:.0f} msg/s); skipped {importer.skipped} already imported, '
+                f'{importer.conflicts} belonging to other rooms; {importer.unlinked} replies without their parent'
+            )
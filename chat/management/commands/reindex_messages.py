@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from chat.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the message search index from the Message and ArchivedMessage tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        backend.rebuild(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt search index ({type(backend).__name__})'))
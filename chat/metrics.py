@@ -0,0 +1,229 @@
+import contextvars
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from django.conf import settings
+from .backpressure import policy_counts
+
+# Upper bounds of the histogram buckets (Prometheus `le`); +Inf is implied
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+HELP = {
+    'chat_http_request_seconds': 'HTTP request latency by view',
+    'chat_http_request_db_queries': 'Database queries per HTTP request (sampled)',
+    'chat_http_request_db_seconds': 'Database time per HTTP request (sampled)',
+    'chat_ws_event_seconds': 'WebSocket handler latency by consumer and event',
+    'chat_ws_event_db_queries': 'Database queries per WebSocket event (sampled)',
+    'chat_ws_event_db_seconds': 'Database time per WebSocket event (sampled)',
+    'chat_ws_save_message_seconds': 'ChatConsumer.save_message latency',
+    'chat_ws_save_message_db_queries': 'Database queries per saved message (sampled)',
+    'chat_ws_save_message_db_seconds': 'Database time per saved message (sampled)',
+    'chat_group_send_seconds': 'Channel layer group_send latency by event',
+    'chat_group_send_bytes': 'Encoded frame size of group_send events',
+    'chat_ws_outbound_policy_total': 'Slow-consumer policy outcomes (dropped, resync, disconnected)',
+}
+
+# Query counter of the handler being tracked in this context, if sampled;
+# context variables follow sync_to_async into the database thread
+_active_queries = contextvars.ContextVar('chat_metrics_queries', default=None)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """
+    Per-process histograms, rendered in the Prometheus text format. Every
+    worker keeps its own numbers; scrape each process (or aggregate in
+    Prometheus) for the whole deployment.
+    """
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+
+    def render(self):
+        with self.lock:
+            series = sorted(
+                (name, labels, list(h.buckets), list(h.counts), h.sum, h.count)
+                for (name, labels), h in self.histograms.items()
+            )
+        lines = []
+        described = set()
+        for name, labels, buckets, counts, total, count in series:
+            if name not in described:
+                lines.append(f'# HELP {name} {HELP.get(name, name)}')
+                lines.append(f'# TYPE {name} histogram')
+                described.add(name)
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + ['+Inf'], counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {total:.6f}')
+            lines.append(f'{name}_count{format_labels(labels)} {count}')
+
+        name = 'chat_ws_outbound_policy_total'
+        lines.append(f'# HELP {name} {HELP[name]}')
+        lines.append(f'# TYPE {name} counter')
+        for outcome, count in sorted(policy_counts.items()):
+            lines.append(f'{name}{format_labels((("outcome", outcome),))} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+class QueryStats:
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.count = 0
+        self.seconds = 0.0
+
+
+def query_wrapper(execute, sql, params, many, context):
+    """
+    Database execute wrapper: counts and times queries for the tracked
+    handler (and any handler it runs inside); a no-op when not sampled
+    """
+    stats = _active_queries.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - start
+        while stats is not None:
+            stats.count += 1
+            stats.seconds += elapsed
+            stats = stats.parent
+
+
+def install_query_wrapper(connection):
+    if query_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(query_wrapper)
+
+
+@contextmanager
+def track(prefix, **labels):
+    """
+    Time the block into `<prefix>_seconds` and, for a sampled fraction
+    (CHAT_METRICS_SAMPLE_RATE, always inside a sampled block), count its
+    queries into `<prefix>_db_queries` / `<prefix>_db_seconds`. Yields the
+    label dict so the block can fill in labels it only learns while running.
+    """
+    if not settings.CHAT_METRICS_ENABLED:
+        yield labels
+        return
+    parent = _active_queries.get()
+    sampled = parent is not None or random.random() < settings.CHAT_METRICS_SAMPLE_RATE
+    stats = QueryStats(parent) if sampled else None
+    token = _active_queries.set(stats)
+    start = time.perf_counter()
+    try:
+        yield labels
+    finally:
+        elapsed = time.perf_counter() - start
+        _active_queries.reset(token)
+        registry = get_registry()
+        registry.observe(f'{prefix}_seconds', elapsed, **labels)
+        if stats is not None:
+            registry.observe(f'{prefix}_db_queries', stats.count, QUERY_BUCKETS, **labels)
+            registry.observe(f'{prefix}_db_seconds', stats.seconds, **labels)
+
+
+async def group_send(channel_layer, group, message):
+    """
+    channel_layer.group_send(), recording its latency and the size of the
+    pre-encoded frame by event type
+    """
+    if not settings.CHAT_METRICS_ENABLED:
+        return await channel_layer.group_send(group, message)
+    start = time.perf_counter()
+    await channel_layer.group_send(group, message)
+    registry = get_registry()
+    registry.observe('chat_group_send_seconds', time.perf_counter() - start, event=message['type'])
+    registry.observe('chat_group_send_bytes', len(message.get('text', '')), SIZE_BUCKETS, event=message['type'])
+
+
+class MetricsMiddleware:
+    """
+    Record each request's latency (and, sampled, its queries) by view name.
+    Goes first in MIDDLEWARE so the other middleware is included.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with track('chat_http_request', view='unresolved') as labels:
+            response = self.get_response(request)
+            match = getattr(request, 'resolver_match', None)
+            if match is not None:
+                labels['view'] = match.view_name
+        return response
+
+
+class InstrumentedConsumerMixin:
+    """
+    Times every event a consumer handles (websocket.connect/receive/
+    disconnect and group events) by consumer class and event type. receive()
+    handlers call label_frame() to split websocket.receive by the type of
+    client frame, limited to the consumer's `frame_types`.
+    """
+    frame_types = frozenset()
+
+    async def dispatch(self, message):
+        with track('chat_ws_event', consumer=type(self).__name__, event=message['type']) as labels:
+            self.metric_labels = labels
+            await super().dispatch(message)
+
+    def label_frame(self, frame_type):
+        # Chosen by the client: unknown types share one label value
+        if frame_type not in self.frame_types:
+            frame_type = 'unknown'
+        self.metric_labels['event'] = f'websocket.receive.{frame_type}'
+
+
+_registry = None
+
+
+def get_registry():
+    """
+    Return the per-process MetricsRegistry, creating it on first use
+    """
+    global _registry
+    if _registry is None:
+        _registry = MetricsRegistry()
+    return _registry
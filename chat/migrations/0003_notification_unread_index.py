@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-17 06:21
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_message_room_timestamp_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['user', 'message', 'is_read'], name='chat_notif_user_unread_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-17 06:22
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_notification_unread_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False, verbose_name='Timestamp'),
+        ),
+    ]
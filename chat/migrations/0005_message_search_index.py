@@ -0,0 +1,37 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        # Filled by 0013_message_search_original, which recreates the table
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS chat_message_fts USING fts5("
+            "content, room_id, message_id, "
+            "tokenize = 'porter unicode61 remove_diacritics 2')"
+        )
+    elif connection.vendor == 'postgresql':
+        # Matches the expression produced by SearchVector('content', config='simple')
+        schema_editor.execute(
+            "CREATE INDEX IF NOT EXISTS chat_message_content_fts ON chat_message "
+            "USING GIN (to_tsvector('simple'::regconfig, COALESCE(content, '')))"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS chat_message_fts')
+    elif connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS chat_message_content_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_message_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
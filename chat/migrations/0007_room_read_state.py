@@ -0,0 +1,55 @@
+# Generated by Django 5.2.18 on 2026-10-17 06:49
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def create_read_states(apps, schema_editor):
+    """
+    One row per room participant, seeded with the unread notification count
+    """
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    Notification = apps.get_model('chat', 'Notification')
+    RoomReadState = apps.get_model('chat', 'RoomReadState')
+    unread = {
+        (row['user_id'], row['message__room_id']): row['count']
+        for row in Notification.objects.filter(is_read=False).values(
+            'user_id', 'message__room_id'
+        ).annotate(count=models.Count('id')).order_by()
+    }
+    memberships = ChatRoom.participants.through.objects.values_list('user_id', 'chatroom_id')
+    RoomReadState.objects.bulk_create(
+        (
+            RoomReadState(user_id=user_id, room_id=room_id, unread_count=unread.get((user_id, room_id), 0))
+            for user_id, room_id in memberships.iterator()
+        ),
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_user_search_term'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomReadState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('last_read_timestamp', models.DateTimeField(blank=True, null=True)),
+                ('last_read_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message')),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='chat.chatroom')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['room', 'user'], name='chat_readstate_room_user_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'room'), name='chat_readstate_user_room_uniq')],
+            },
+        ),
+        migrations.RunPython(create_read_states, migrations.RunPython.noop),
+    ]
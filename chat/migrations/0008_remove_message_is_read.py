@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-17 06:51
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_room_read_state'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='message',
+            name='is_read',
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-17 06:52
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def create_search_index(apps, schema_editor):
+    # The SQLite FTS table covers both tables (archived rows keep their
+    # entries); PostgreSQL needs the GIN index from 0005 on the archive too
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            "CREATE INDEX IF NOT EXISTS chat_archivedmessage_content_fts ON chat_archivedmessage "
+            "USING GIN (to_tsvector('simple'::regconfig, COALESCE(content, '')))"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS chat_archivedmessage_content_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_remove_message_is_read'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedMessage',
+            fields=[
+                ('id', models.UUIDField(editable=False, primary_key=True, serialize=False)),
+                ('content', models.TextField(verbose_name='Message')),
+                ('timestamp', models.DateTimeField(verbose_name='Timestamp')),
+                ('parent_message_id', models.UUIDField(blank=True, null=True)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_messages', to='chat.chatroom', verbose_name='Chat Room')),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Sender')),
+            ],
+            options={
+                'verbose_name': 'Archived Message',
+                'verbose_name_plural': 'Archived Messages',
+                'indexes': [models.Index(fields=['room', 'timestamp', 'id'], name='chat_archive_room_ts_idx')],
+            },
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 07:10
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_avatar_variants'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='archivedmessage',
+            index=models.Index(fields=['timestamp', 'id'], name='chat_archive_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['timestamp', 'id'], name='chat_message_ts_idx'),
+        ),
+    ]
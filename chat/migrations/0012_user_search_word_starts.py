@@ -0,0 +1,78 @@
+# Generated by Django 5.2.18 on 2026-10-17 07:53
+
+import re
+
+from django.conf import settings
+from django.db import migrations, models
+
+# Frozen copy of chat.search.normalize_text and chat.autocomplete.user_terms
+# as of this migration, so later changes to the app cannot alter it
+ARABIC_DIACRITICS = re.compile('[\u0610-\u061a\u0640\u064b-\u065f\u0670\u06d6-\u06ed]')
+ARABIC_LETTERS = str.maketrans({
+    'أ': 'ا',
+    'إ': 'ا',
+    'آ': 'ا',
+    'ٱ': 'ا',
+    'ى': 'ي',
+    'ة': 'ه',
+})
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 300
+
+
+def normalize_name(value):
+    value = ARABIC_DIACRITICS.sub('', value or '').translate(ARABIC_LETTERS)
+    return ' '.join(value.lower().split())
+
+
+def user_terms(username, first_name, last_name):
+    names = {
+        normalize_name(username),
+        normalize_name(first_name),
+        normalize_name(last_name),
+        normalize_name(f'{first_name} {last_name}'),
+    }
+    terms = {}
+    for name in names:
+        for start in range(len(name) - MIN_TERM_LENGTH + 1):
+            if start and (name[start - 1].isalnum() or not name[start].isalnum()):
+                continue
+            term = name[start:start + MAX_TERM_LENGTH]
+            terms[term] = terms.get(term, False) or start == 0
+    return terms
+
+
+def index_word_starts(apps, schema_editor):
+    """
+    Replace the every-suffix terms with word-start terms
+    """
+    User = apps.get_model('auth', 'User')
+    UserSearchTerm = apps.get_model('chat', 'UserSearchTerm')
+    UserSearchTerm.objects.all().delete()
+    batch = []
+    for user in User.objects.only('id', 'username', 'first_name', 'last_name').order_by().iterator(chunk_size=1000):
+        batch.extend(
+            UserSearchTerm(user_id=user.id, term=term, is_prefix=is_prefix)
+            for term, is_prefix in user_terms(user.username, user.first_name, user.last_name).items()
+        )
+        if len(batch) >= 10000:
+            UserSearchTerm.objects.bulk_create(batch, batch_size=1000)
+            batch = []
+    UserSearchTerm.objects.bulk_create(batch, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_timestamp_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='usersearchterm',
+            index=models.Index(fields=['user', 'term'], name='chat_usersearch_user_idx'),
+        ),
+        # The old every-suffix rows are only rebuilt forwards
+        migrations.RunPython(index_word_starts, migrations.RunPython.noop),
+    ]
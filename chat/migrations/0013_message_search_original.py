@@ -0,0 +1,68 @@
+import re
+
+from django.db import migrations
+
+# Frozen copy of chat.search.normalize_text as of this migration, so later
+# changes to the app cannot alter it
+ARABIC_DIACRITICS = re.compile('[\u0610-\u061a\u0640\u064b-\u065f\u0670\u06d6-\u06ed]')
+ARABIC_LETTERS = str.maketrans({
+    'أ': 'ا',
+    'إ': 'ا',
+    'آ': 'ا',
+    'ٱ': 'ا',
+    'ى': 'ي',
+    'ة': 'ه',
+})
+
+
+def normalize_text(text):
+    return ARABIC_DIACRITICS.sub('', text or '').translate(ARABIC_LETTERS)
+
+
+def fill_search_index(schema_editor, original):
+    """
+    Index every hot and archived message, normalizing in SQL through a
+    function registered on this connection
+    """
+    connection = schema_editor.connection
+    connection.ensure_connection()
+    connection.connection.create_function('chat_normalize_text', 1, normalize_text, deterministic=True)
+    columns = 'content, room_id, message_id, original' if original else 'content, room_id, message_id'
+    for table in ('chat_message', 'chat_archivedmessage'):
+        values = 'chat_normalize_text(content), room_id, id' + (', content' if original else '')
+        schema_editor.execute(f'INSERT INTO chat_message_fts ({columns}) SELECT {values} FROM {table}')
+
+
+def keep_original_content(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute('DROP TABLE IF EXISTS chat_message_fts')
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE chat_message_fts USING fts5("
+        "content, room_id, message_id, original UNINDEXED, "
+        "tokenize = 'porter unicode61 remove_diacritics 2')"
+    )
+    fill_search_index(schema_editor, original=True)
+
+
+def drop_original_content(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute('DROP TABLE IF EXISTS chat_message_fts')
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE chat_message_fts USING fts5("
+        "content, room_id, message_id, "
+        "tokenize = 'porter unicode61 remove_diacritics 2')"
+    )
+    fill_search_index(schema_editor, original=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0012_user_search_word_starts'),
+    ]
+
+    operations = [
+        migrations.RunPython(keep_original_content, drop_original_content),
+    ]
@@ -3,8 +3,58 @@ from django.contrib.auth.models import User
 from django.utils.translation import gettext_lazy as _
 from django.utils import timezone
 from django.core.validators import MinLengthValidator
+from django.db.models import Q, F, OuterRef, Subquery, Count, Sum, Case, When, BooleanField, IntegerField
+from django.db.models.functions import Coalesce
+from datetime import datetime
 import uuid
 
+class ChatRoomQuerySet(models.QuerySet):
+    """
+    QuerySet helpers for chat rooms
+    """
+    def for_user(self, user):
+        """
+        Rooms the user created or participates in, without a join + DISTINCT
+        """
+        memberships = ChatRoom.participants.through.objects.filter(
+            user=user
+        ).values('chatroom_id')
+        return self.filter(Q(creator=user) | Q(id__in=memberships))
+
+    def inbox(self, user):
+        """
+        The user's rooms annotated with their last message and unread count,
+        fetched in a single query
+        """
+        last_message = Message.objects.filter(
+            room=OuterRef('pk')
+        ).order_by('-timestamp', '-id')
+        # Maintained incrementally in RoomReadState: a primary-key lookup
+        # instead of counting notification rows
+        unread = RoomReadState.objects.filter(
+            room=OuterRef('pk'),
+            user=user
+        ).values('unread_count')[:1]
+        # Rooms idle for longer than the hot window preview their newest
+        # archived message instead
+        last_archived = ArchivedMessage.objects.filter(
+            room=OuterRef('pk')
+        ).order_by('-timestamp', '-id')
+        preview = {
+            field: Coalesce(
+                Subquery(last_message.values(field)[:1]),
+                Subquery(last_archived.values(field)[:1]),
+            )
+            for field in ('id', 'content', 'timestamp', 'sender__username')
+        }
+        return self.for_user(user).annotate(
+            last_message_id=preview['id'],
+            last_message_content=preview['content'],
+            last_message_timestamp=preview['timestamp'],
+            last_message_sender=preview['sender__username'],
+            unread_count=Coalesce(Subquery(unread, output_field=IntegerField()), 0),
+        ).order_by('-updated_at')
+
 class ChatRoom(models.Model):
     """
     Model representing a chat room
@@ -18,6 +68,8 @@ class ChatRoom(models.Model):
     created_at = models.DateTimeField(auto_now_add=True, verbose_name=_('Created At'))
     updated_at = models.DateTimeField(auto_now=True, verbose_name=_('Updated At'))
     
+    objects = ChatRoomQuerySet.as_manager()
+    
     class Meta:
         verbose_name = _('Chat Room')
         verbose_name_plural = _('Chat Rooms')
@@ -31,6 +83,66 @@ class ChatRoom(models.Model):
     
     def last_message(self):
         return self.messages.order_by('-timestamp').first()
+    
+    def touch(self):
+        """
+        Bump updated_at without rewriting the rest of the row
+        """
+        self.updated_at = timezone.now()
+        ChatRoom.objects.filter(pk=self.pk).update(updated_at=self.updated_at)
+
+class MessageQuerySet(models.QuerySet):
+    """
+    QuerySet helpers for rendering and paging through a room's history
+    """
+    def for_display(self):
+        """
+        Fetch everything the message bubble renders (sender, avatar and
+        reply preview) in a single joined query
+        """
+        return self.select_related(
+            'sender',
+            'sender__profile',
+            'parent_message',
+            'parent_message__sender',
+        )
+
+    def newest_first(self):
+        return self.order_by('-timestamp', '-id')
+
+    def before(self, cursor):
+        """
+        Keyset filter: messages strictly older than the (timestamp, id) cursor
+        """
+        timestamp, message_id = Message.decode_cursor(cursor)
+        return self.filter(
+            Q(timestamp__lt=timestamp) |
+            Q(timestamp=timestamp, id__lt=message_id)
+        )
+
+    def after(self, cursor):
+        """
+        Keyset filter: messages strictly newer than the (timestamp, id) cursor
+        """
+        timestamp, message_id = Message.decode_cursor(cursor)
+        return self.filter(
+            Q(timestamp__gt=timestamp) |
+            Q(timestamp=timestamp, id__gt=message_id)
+        )
+
+    def page(self, before=None, limit=50):
+        """
+        Return (messages, has_more) with at most `limit` messages in
+        chronological order, ending just before `before` if given
+        """
+        queryset = self.newest_first()
+        if before:
+            queryset = queryset.before(before)
+        rows = list(queryset[:limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+        return rows, has_more
 
 class Message(models.Model):
     """
@@ -40,21 +152,88 @@ class Message(models.Model):
     room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='messages', verbose_name=_('Chat Room'))
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages', verbose_name=_('Sender'))
     content = models.TextField(validators=[MinLengthValidator(1)], verbose_name=_('Message'))
-    timestamp = models.DateTimeField(auto_now_add=True, verbose_name=_('Timestamp'))
-    is_read = models.BooleanField(default=False, verbose_name=_('Is Read'))
+    timestamp = models.DateTimeField(default=timezone.now, editable=False, verbose_name=_('Timestamp'))
     parent_message = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='replies', verbose_name=_('Parent Message'))
     
+    objects = MessageQuerySet.as_manager()
+    
     class Meta:
         verbose_name = _('Message')
         verbose_name_plural = _('Messages')
         ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['room', 'timestamp', 'id'], name='chat_message_room_ts_idx'),
+            # Newest-first listings across rooms (admin) and archival scans
+            models.Index(fields=['timestamp', 'id'], name='chat_message_ts_idx'),
+        ]
     
     def __str__(self):
         return f"{self.sender.username}: {self.content[:50]}"
     
-    def mark_as_read(self):
-        self.is_read = True
-        self.save()
+    @property
+    def cursor(self):
+        """
+        Opaque keyset cursor pointing at this message
+        """
+        return f"{self.timestamp.isoformat()}_{self.id}"
+    
+    @staticmethod
+    def decode_cursor(cursor):
+        """
+        Parse a cursor produced by `Message.cursor`, raising ValueError if malformed
+        """
+        timestamp, _sep, message_id = str(cursor).rpartition('_')
+        return datetime.fromisoformat(timestamp), uuid.UUID(message_id)
+    
+    def to_dict(self):
+        return {
+            'message_id': str(self.id),
+            'sender_id': str(self.sender_id),
+            'sender_username': self.sender.username,
+            'content': self.content,
+            'timestamp': self.timestamp.isoformat(),
+            'parent_id': str(self.parent_message_id) if self.parent_message_id else None,
+            'cursor': self.cursor,
+        }
+
+class ArchivedMessageQuerySet(MessageQuerySet):
+    def for_display(self):
+        # Parents may live in either table; see chat.archive.attach_parents
+        return self.select_related('sender', 'sender__profile')
+
+class ArchivedMessage(models.Model):
+    """
+    Cold copy of a message older than CHAT_ARCHIVE_AFTER_DAYS, moved out of
+    the hot Message table by chat.archive. parent_message_id is a plain UUID
+    because the parent may be hot or archived.
+    """
+    id = models.UUIDField(primary_key=True, editable=False)
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='archived_messages', verbose_name=_('Chat Room'))
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', verbose_name=_('Sender'))
+    content = models.TextField(verbose_name=_('Message'))
+    timestamp = models.DateTimeField(verbose_name=_('Timestamp'))
+    parent_message_id = models.UUIDField(null=True, blank=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+    
+    objects = ArchivedMessageQuerySet.as_manager()
+    
+    class Meta:
+        verbose_name = _('Archived Message')
+        verbose_name_plural = _('Archived Messages')
+        indexes = [
+            models.Index(fields=['room', 'timestamp', 'id'], name='chat_archive_room_ts_idx'),
+            models.Index(fields=['timestamp', 'id'], name='chat_archive_ts_idx'),
+        ]
+    
+    # Filled in by chat.archive.attach_parents for rendering
+    parent_message = None
+    
+    # Rendered and paged exactly like hot messages
+    cursor = Message.cursor
+    to_dict = Message.to_dict
+    
+    def __str__(self):
+        return f"{self.sender.username}: {self.content[:50]}"
 
 class UserProfile(models.Model):
     """
@@ -64,6 +243,9 @@ class UserProfile(models.Model):
     online_status = models.BooleanField(default=False, verbose_name=_('Online Status'))
     last_seen = models.DateTimeField(default=timezone.now, verbose_name=_('Last Seen'))
     avatar = models.ImageField(upload_to='avatars/', null=True, blank=True, verbose_name=_('Avatar'))
+    # {size: {'webp': name, 'fallback': name}}, filled in by chat.avatars
+    # off the request; empty until the thumbnails exist
+    avatar_variants = models.JSONField(default=dict, blank=True, editable=False)
     language = models.CharField(max_length=10, choices=[
         ('en', 'English'),
         ('ar', 'Arabic')
@@ -81,12 +263,50 @@ class UserProfile(models.Model):
     def __str__(self):
         return f"{self.user.username}'s Profile"
     
+    def avatar_sources(self):
+        """
+        URLs of the avatar and its thumbnails, as {'url': original,
+        'variants': {size: {'webp': url, 'fallback': url}}}; None without
+        an avatar
+        """
+        if not self.avatar:
+            return None
+        storage = self.avatar.storage
+        return {
+            'url': self.avatar.url,
+            'variants': {
+                size: {kind: storage.url(name) for kind, name in names.items()}
+                for size, names in self.avatar_variants.items()
+            },
+        }
+    
     def update_online_status(self, status):
         self.online_status = status
         if not status:
             self.last_seen = timezone.now()
         self.save()
 
+class NotificationQuerySet(models.QuerySet):
+    """
+    QuerySet helpers for notifications
+    """
+    def with_read_state(self, user):
+        """
+        Annotate `is_unread`: read state comes from the user's room read
+        cursor, so opening a room never rewrites its notification rows
+        """
+        read_through = RoomReadState.objects.filter(
+            user=user,
+            room=OuterRef('message__room')
+        ).values('last_read_timestamp')[:1]
+        return self.filter(user=user).annotate(
+            is_unread=Case(
+                When(Q(is_read=True) | Q(message__timestamp__lte=Subquery(read_through)), then=False),
+                default=True,
+                output_field=BooleanField(),
+            )
+        )
+
 class Notification(models.Model):
     """
     Model for user notifications
@@ -96,5 +316,138 @@ class Notification(models.Model):
     is_read = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     
+    objects = NotificationQuerySet.as_manager()
+    
+    @classmethod
+    def fan_out(cls, message, batch_size=1000):
+        """
+        Notify every participant of the message's room except the sender,
+        using batched multi-row INSERTs instead of one INSERT per participant
+        """
+        recipients = message.room.participants.exclude(
+            id=message.sender_id
+        ).values_list('id', flat=True)
+        return cls.objects.bulk_create(
+            (cls(user_id=user_id, message=message) for user_id in recipients.iterator()),
+            batch_size=batch_size
+        )
+    
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', 'message', 'is_read'], name='chat_notif_user_unread_idx'),
+        ]
+
+class RoomReadStateQuerySet(models.QuerySet):
+    """
+    Per-(user, room) unread counters, updated with single statements
+    """
+    def message_sent(self, room_id, sender_id, count=1):
+        """
+        Count `count` new messages as unread for every member but the sender
+        """
+        return self.filter(room_id=room_id).exclude(user_id=sender_id).update(
+            unread_count=F('unread_count') + count
+        )
+
+    def mark_read(self, user_id, room_id, message=None):
+        """
+        Reset the user's counter for the room and move the read cursor to
+        `message` (the newest message the user has seen), if given
+        """
+        values = {'unread_count': 0}
+        if message is not None:
+            values.update(
+                # Archived messages can only be referenced by timestamp
+                last_read_message_id=message.id if isinstance(message, Message) else None,
+                last_read_timestamp=message.timestamp
+            )
+        if not self.filter(user_id=user_id, room_id=room_id).update(**values):
+            self.bulk_create([RoomReadState(user_id=user_id, room_id=room_id, **values)], ignore_conflicts=True)
+
+    def advance(self, user_id, room_id, message_id, timestamp):
+        """
+        Move the read cursor forward to the given message (never backwards)
+        and recount the messages from others that are still unread
+        """
+        newer = Message.objects.filter(
+            room_id=room_id,
+            timestamp__gt=timestamp
+        ).exclude(sender_id=user_id).order_by().values('room').annotate(count=Count('id')).values('count')
+        return self.filter(user_id=user_id, room_id=room_id).filter(
+            Q(last_read_timestamp__isnull=True) | Q(last_read_timestamp__lt=timestamp)
+        ).update(
+            last_read_message_id=message_id,
+            last_read_timestamp=timestamp,
+            unread_count=Coalesce(Subquery(newer, output_field=IntegerField()), 0),
+        )
+
+    def cursors_for(self, room_id, since=None, exclude_user_id=None):
+        """
+        {user_id: last_read_timestamp} for the room's members who have read
+        anything (at or after `since`, if given)
+        """
+        states = self.filter(room_id=room_id, last_read_timestamp__isnull=False)
+        if since is not None:
+            states = states.filter(last_read_timestamp__gte=since)
+        if exclude_user_id is not None:
+            states = states.exclude(user_id=exclude_user_id)
+        return dict(states.values_list('user_id', 'last_read_timestamp'))
+
+    def add_members(self, room_id, user_ids):
+        self.bulk_create(
+            [RoomReadState(user_id=user_id, room_id=room_id) for user_id in user_ids],
+            ignore_conflicts=True
+        )
+
+    def counts_for(self, user):
+        """
+        {room_id: unread_count} for the user's rooms with unread messages
+        """
+        return dict(self.filter(user=user, unread_count__gt=0).values_list('room_id', 'unread_count'))
+
+    def total_for(self, user):
+        return self.filter(user=user).aggregate(total=Sum('unread_count'))['total'] or 0
+
+class RoomReadState(models.Model):
+    """
+    Denormalized unread counter and read cursor for one member of a room.
+    Rows are created when users join a room (see chat.signals), bumped for
+    every message and reset when the member reads the room.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='read_states')
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='read_states')
+    unread_count = models.PositiveIntegerField(default=0)
+    last_read_message = models.ForeignKey(Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    # Copy of last_read_message.timestamp so cursor comparisons need no join
+    last_read_timestamp = models.DateTimeField(null=True, blank=True)
+    
+    objects = RoomReadStateQuerySet.as_manager()
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'room'], name='chat_readstate_user_room_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['room', 'user'], name='chat_readstate_room_user_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.user_id} in {self.room_id}: {self.unread_count} unread"
+
+class UserSearchTerm(models.Model):
+    """
+    Autocomplete index for user search: every suffix of a user's normalized
+    username and names that starts a word, so name-start and word-start
+    lookups are index range scans
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='search_terms')
+    term = models.CharField(max_length=300)
+    is_prefix = models.BooleanField(default=False)
+    
     class Meta:
-        ordering = ['-created_at']
\ No newline at end of file
+        indexes = [
+            models.Index(fields=['term', 'is_prefix', 'user'], name='chat_usersearch_term_idx'),
+            # Contacts' matches: a term range per contact
+            models.Index(fields=['user', 'term'], name='chat_usersearch_user_idx'),
+        ]
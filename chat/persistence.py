@@ -0,0 +1,193 @@
+import asyncio
+import atexit
+import json
+import logging
+from collections import Counter
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+from .models import ChatRoom, Message, RoomReadState
+from .search import get_search_backend
+
+logger = logging.getLogger(__name__)
+# Messages that could not be written even one at a time, one JSON export
+# record (plus room_id) per log line; route it to a file to recover them
+# with import_room_history
+dead_letter_logger = logging.getLogger(f'{__name__}.dead_letter')
+
+
+class MessageBatcher:
+    """
+    Write-behind buffer for chat messages.
+
+    Messages are built (id and timestamp included) and broadcast by the
+    consumer straight away, then handed to the batcher which writes them
+    with a single bulk_create once `batch_size` messages are pending or
+    `flush_interval` seconds have passed; an idle batcher waits without
+    polling. A failed batch is put back at the head of the queue and
+    retried with a capped backoff, up to `max_retries` attempts. After that
+    its messages are written one at a time, so a single bad row cannot hold
+    back the rest, and rows that still fail go to the dead-letter log. The
+    queue therefore always drains. Whatever is still pending when the
+    process exits is flushed synchronously the same way.
+    """
+    def __init__(self, batch_size=100, flush_interval=0.05, max_backoff=5.0, max_retries=3):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self.max_retries = max_retries
+        self.pending = []
+        self.failures = 0
+        self.written = 0
+        self.dead_lettered = 0
+        self._task = None
+        self._wakeup = None
+        self._lock = None
+        self._closing = False
+
+    def add(self, message):
+        self.pending.append(message)
+        self._ensure_running()
+        # The first message starts the flush timer; a full batch flushes now
+        if len(self.pending) == 1 or len(self.pending) >= self.batch_size:
+            self._wakeup.set()
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._lock = asyncio.Lock()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while not self._closing:
+            if not self.pending:
+                # Idle until add() or close()
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            if self.failures or len(self.pending) < self.batch_size:
+                delay = self.flush_interval
+                if self.failures:
+                    delay = min(self.flush_interval * 2 ** self.failures, self.max_backoff)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """
+        Write everything pending, stopping at a failed batch that has
+        retries left
+        """
+        async with self._lock:
+            while self.pending:
+                batch = self.pending[:self.batch_size]
+                del self.pending[:len(batch)]
+                try:
+                    await database_sync_to_async(self._write)(batch)
+                except Exception:
+                    self.failures += 1
+                    logger.exception('Failed to write %d buffered messages (attempt %d)', len(batch), self.failures)
+                    if self.failures < self.max_retries:
+                        self.pending[:0] = batch
+                        return
+                    await database_sync_to_async(self._salvage)(batch)
+                self.failures = 0
+
+    async def close(self):
+        """
+        Stop the background flusher and write whatever is still pending
+        """
+        if self._task is not None:
+            # Let the current flush finish rather than cancelling it mid-write
+            self._closing = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+            self._closing = False
+        if self.pending:
+            await self.flush()
+
+    def flush_sync(self):
+        """
+        Blocking flush used at interpreter shutdown
+        """
+        while self.pending:
+            batch = self.pending[:self.batch_size]
+            del self.pending[:len(batch)]
+            try:
+                self._write(batch)
+            except Exception:
+                logger.exception('Failed to write %d buffered messages at shutdown', len(batch))
+                self._salvage(batch)
+
+    def _salvage(self, batch):
+        """
+        Write a failed batch one message at a time, oldest first so parents
+        precede their replies, dead-lettering the messages that still fail
+        """
+        for message in batch:
+            try:
+                self._write([message])
+            except Exception:
+                self.dead_lettered += 1
+                logger.exception('Dead-lettering buffered message %s', message.id)
+                dead_letter_logger.error(json.dumps({
+                    'id': str(message.id),
+                    'room_id': str(message.room_id),
+                    'timestamp': message.timestamp.isoformat(),
+                    'sender': message.sender.username,
+                    'content': message.content,
+                    'parent_id': str(message.parent_message_id) if message.parent_message_id else None,
+                }, ensure_ascii=False))
+
+    def _write(self, batch):
+        room_ids = {message.room_id for message in batch}
+        batch_ids = {message.id for message in batch}
+        parent_ids = {
+            message.parent_message_id for message in batch
+            if message.parent_message_id
+        } - batch_ids
+
+        # Validate foreign keys for the whole batch instead of per message
+        known_rooms = set(ChatRoom.objects.filter(id__in=room_ids).values_list('id', flat=True))
+        known_parents = batch_ids
+        if parent_ids:
+            known_parents = batch_ids | set(Message.objects.filter(id__in=parent_ids).values_list('id', flat=True))
+
+        rows = []
+        for message in batch:
+            if message.room_id not in known_rooms:
+                logger.warning('Dropping buffered message %s for missing room %s', message.id, message.room_id)
+                continue
+            if message.parent_message_id not in known_parents:
+                message.parent_message_id = None
+            rows.append(message)
+
+        # bulk_create skips post_save, so index and count the batch explicitly
+        with transaction.atomic():
+            Message.objects.bulk_create(rows)
+            get_search_backend().index(rows)
+            for (room_id, sender_id), count in Counter((row.room_id, row.sender_id) for row in rows).items():
+                RoomReadState.objects.message_sent(room_id, sender_id, count)
+        self.written += len(rows)
+
+
+_batcher = None
+
+
+def get_batcher():
+    """
+    Return the per-process MessageBatcher, creating it on first use
+    """
+    global _batcher
+    if _batcher is None:
+        _batcher = MessageBatcher(
+            batch_size=settings.CHAT_WRITE_BEHIND_BATCH_SIZE,
+            flush_interval=settings.CHAT_WRITE_BEHIND_FLUSH_INTERVAL,
+            max_retries=settings.CHAT_WRITE_BEHIND_MAX_RETRIES,
+        )
+        atexit.register(_batcher.flush_sync)
+    return _batcher
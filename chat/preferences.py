@@ -0,0 +1,77 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import translation
+from django.utils.functional import SimpleLazyObject
+from .models import UserProfile
+
+# Returned for users without a profile; language None keeps LocaleMiddleware's choice
+DEFAULT_PREFERENCES = {
+    'theme': 'auto',
+    'language': None,
+    'avatar_url': None,
+    'avatar': None,
+}
+
+
+def preferences_key(user_id):
+    return f'chat:prefs:v2:{user_id}'
+
+
+def load_preferences(user_id):
+    profile = UserProfile.objects.filter(user_id=user_id).only('theme', 'language', 'avatar', 'avatar_variants').first()
+    if profile is None:
+        return dict(DEFAULT_PREFERENCES)
+    return {
+        'theme': profile.theme,
+        'language': profile.language,
+        'avatar_url': profile.avatar.url if profile.avatar else None,
+        'avatar': profile.avatar_sources(),
+    }
+
+
+def get_preferences(user):
+    """
+    Return {'theme', 'language', 'avatar_url', 'avatar'} for the user (avatar
+    being UserProfile.avatar_sources()), from the shared cache (Redis, see
+    CACHES) when possible. Entries are dropped by chat.signals when the
+    profile is saved, so every worker sees the change on its next request.
+    """
+    if not user.is_authenticated:
+        return dict(DEFAULT_PREFERENCES)
+    key = preferences_key(user.id)
+    preferences = cache.get(key)
+    if preferences is None:
+        preferences = load_preferences(user.id)
+        cache.set(key, preferences, settings.CHAT_PREFERENCES_CACHE_TTL)
+    return preferences
+
+
+def invalidate_preferences(user_id):
+    # After commit: a delete inside the transaction would let another worker
+    # cache the old row again before the new one is visible
+    key = preferences_key(user_id)
+    transaction.on_commit(lambda: cache.delete(key))
+
+
+class UserPreferencesMiddleware:
+    """
+    Attach the user's preferences to the request (loaded at most once, on
+    first access) and activate the profile language for authenticated users
+    on paths without a language prefix, so `/` redirects to their language.
+    A prefix in the URL always wins: it is what i18n_patterns resolves.
+
+    Must come after AuthenticationMiddleware; LocaleMiddleware runs earlier
+    and still handles anonymous users (cookie / Accept-Language).
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.user_preferences = SimpleLazyObject(lambda: get_preferences(request.user))
+        if request.user.is_authenticated and translation.get_language_from_path(request.path_info) is None:
+            language = request.user_preferences['language']
+            if language:
+                translation.activate(language)
+                request.LANGUAGE_CODE = translation.get_language()
+        return self.get_response(request)
@@ -0,0 +1,203 @@
+import math
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.utils.module_loading import import_string
+from .models import UserProfile
+
+
+class LocalPresenceStore:
+    """
+    In-process presence store, suitable for development and a single worker.
+
+    Each user maps to the channels (sockets) they have open, with the time
+    each one expires unless it sends a heartbeat first.
+    """
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.connections = defaultdict(dict)
+        self.seen = {}
+        self.lock = threading.Lock()
+
+    def connect(self, user_id, channel_name):
+        now = time.time()
+        with self.lock:
+            self.connections[user_id][channel_name] = now + self.ttl
+            self.seen[user_id] = now
+            return self._alive(user_id, now)
+
+    heartbeat = connect
+
+    def disconnect(self, user_id, channel_name):
+        now = time.time()
+        with self.lock:
+            self.connections[user_id].pop(channel_name, None)
+            self.seen[user_id] = now
+            remaining = self._alive(user_id, now)
+            if not remaining:
+                del self.connections[user_id]
+            return remaining
+
+    def online_user_ids(self):
+        now = time.time()
+        with self.lock:
+            return [user_id for user_id in list(self.connections) if self._alive(user_id, now)]
+
+    def online_among(self, user_ids):
+        """
+        The subset of `user_ids` that is online
+        """
+        now = time.time()
+        with self.lock:
+            return {user_id for user_id in user_ids if user_id in self.connections and self._alive(user_id, now)}
+
+    def pop_seen(self):
+        with self.lock:
+            seen, self.seen = self.seen, {}
+        return seen
+
+    def _alive(self, user_id, now):
+        channels = self.connections[user_id]
+        for channel_name, expires in list(channels.items()):
+            if expires <= now:
+                del channels[channel_name]
+        return len(channels)
+
+
+class RedisPresenceStore:
+    """
+    Presence store kept in the channel layer's Redis so all workers share it.
+
+    Keys:
+      chat:presence:user:<id>  sorted set of channel names scored by expiry
+      chat:presence:online     sorted set of user ids scored by latest expiry
+      chat:presence:seen       hash of user id -> last activity (unix time)
+    """
+    online_key = 'chat:presence:online'
+    seen_key = 'chat:presence:seen'
+
+    def __init__(self, ttl=60, url=None):
+        import redis
+        self.ttl = ttl
+        self.client = redis.Redis.from_url(url or channel_layer_redis_url())
+
+    def user_key(self, user_id):
+        return f'chat:presence:user:{user_id}'
+
+    def connect(self, user_id, channel_name):
+        now = time.time()
+        key = self.user_key(user_id)
+        pipe = self.client.pipeline()
+        pipe.zadd(key, {channel_name: now + self.ttl})
+        pipe.zremrangebyscore(key, '-inf', now)
+        pipe.zcard(key)
+        pipe.expire(key, math.ceil(self.ttl))
+        pipe.zadd(self.online_key, {user_id: now + self.ttl})
+        pipe.hset(self.seen_key, user_id, now)
+        return pipe.execute()[2]
+
+    heartbeat = connect
+
+    def disconnect(self, user_id, channel_name):
+        now = time.time()
+        key = self.user_key(user_id)
+
+        def remove(pipe):
+            # Counted under WATCH on the user's key: a connect() before EXEC
+            # retries the transaction, so a user who just opened another
+            # socket is never taken out of the online set
+            score = pipe.zscore(key, channel_name)
+            remaining = pipe.zcount(key, f'({now}', '+inf') - (score is not None and score > now)
+            pipe.multi()
+            pipe.zrem(key, channel_name)
+            pipe.zremrangebyscore(key, '-inf', now)
+            pipe.hset(self.seen_key, user_id, now)
+            if not remaining:
+                pipe.zrem(self.online_key, user_id)
+            return remaining
+
+        return self.client.transaction(remove, key, value_from_callable=True)
+
+    def online_user_ids(self):
+        now = time.time()
+        pipe = self.client.pipeline()
+        pipe.zremrangebyscore(self.online_key, '-inf', now)
+        pipe.zrangebyscore(self.online_key, now, '+inf')
+        return [int(user_id) for user_id in pipe.execute()[1]]
+
+    def online_among(self, user_ids, chunk_size=1000):
+        """
+        The subset of `user_ids` that is online, read with ZMSCORE in one
+        pipeline instead of loading every online user
+        """
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+        now = time.time()
+        pipe = self.client.pipeline()
+        for start in range(0, len(user_ids), chunk_size):
+            pipe.zmscore(self.online_key, user_ids[start:start + chunk_size])
+        scores = [score for chunk in pipe.execute() for score in chunk]
+        return {user_id for user_id, score in zip(user_ids, scores) if score is not None and score > now}
+
+    def pop_seen(self):
+        pipe = self.client.pipeline()
+        pipe.hgetall(self.seen_key)
+        pipe.delete(self.seen_key)
+        seen = pipe.execute()[0]
+        return {int(user_id): float(timestamp) for user_id, timestamp in seen.items()}
+
+
+def channel_layer_redis_url():
+    """
+    Build a redis:// URL from the first host of the default channel layer
+    """
+    host = settings.CHANNEL_LAYERS['default'].get('CONFIG', {}).get('hosts', [('127.0.0.1', 6379)])[0]
+    if isinstance(host, dict):
+        host = host.get('address')
+    if isinstance(host, str):
+        return host
+    return f'redis://{host[0]}:{host[1]}/0'
+
+
+_store = None
+
+
+def get_presence_store():
+    """
+    Return the configured presence store, creating it on first use
+    """
+    global _store
+    if _store is None:
+        _store = import_string(settings.CHAT_PRESENCE_BACKEND)(ttl=settings.CHAT_PRESENCE_TTL)
+    return _store
+
+
+def flush_last_seen(store=None):
+    """
+    Write last_seen/online_status for every user active since the previous
+    flush in one bulk UPDATE and clear online_status for users whose sockets
+    have all expired. Returns the number of profiles written.
+    """
+    store = store or get_presence_store()
+    seen = store.pop_seen()
+    online = set(store.online_user_ids())
+
+    # Sockets that expired without disconnecting never show up in `seen`
+    UserProfile.objects.filter(online_status=True).exclude(user_id__in=online).update(online_status=False)
+    if not seen:
+        return 0
+
+    profiles = {profile.user_id: profile for profile in UserProfile.objects.filter(user_id__in=seen)}
+    missing = [UserProfile(user_id=user_id) for user_id in seen if user_id not in profiles]
+    if missing:
+        UserProfile.objects.bulk_create(missing, ignore_conflicts=True)
+        profiles.update((profile.user_id, profile) for profile in UserProfile.objects.filter(user_id__in=[p.user_id for p in missing]))
+
+    for user_id, profile in profiles.items():
+        profile.last_seen = datetime.fromtimestamp(seen[user_id], tz=dt_timezone.utc)
+        profile.online_status = user_id in online
+    UserProfile.objects.bulk_update(profiles.values(), ['last_seen', 'online_status'], batch_size=500)
+    return len(profiles)
@@ -0,0 +1,86 @@
+import asyncio
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+from .encoding import encode_frame
+from .metrics import group_send
+from .models import Message, RoomReadState
+
+
+class ReadReceiptBuffer:
+    """
+    Collects read-cursor advances from sockets and applies them once per
+    `interval`: one UPDATE per (user, room) that moved, and one compact
+    frame per room listing the cursors that advanced.
+
+    Only the newest cursor per (user, room) is kept between flushes, so a
+    client scrolling through a burst of messages costs one write.
+    """
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.pending = {}
+        self.flusher = None
+
+    def update(self, channel_layer, group_name, room_id, user_id, timestamp, message_id):
+        room = self.pending.setdefault((group_name, str(room_id)), {})
+        current = room.get(user_id)
+        if current is None or current[0] < timestamp:
+            room[user_id] = (timestamp, message_id)
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.get_running_loop().create_task(self.flush_later(channel_layer))
+
+    async def flush_later(self, channel_layer):
+        # Keep going while updates arrive during a flush
+        while self.pending:
+            await asyncio.sleep(self.interval)
+            pending, self.pending = self.pending, {}
+            advanced = await database_sync_to_async(self.write)(pending)
+            for group_name, cursors in advanced.items():
+                await group_send(channel_layer, group_name, {
+                    'type': 'read_receipts',
+                    'text': encode_frame({'type': 'read', 'cursors': cursors}),
+                })
+
+    def write(self, pending):
+        """
+        Persist the cursors; returns {group_name: [cursor, ...]} for those
+        pointing at a real message of their room that moved a read cursor
+        forward
+        """
+        message_ids = {message_id for room in pending.values() for _ts, message_id in room.values()}
+        # Trust the database's timestamps, not the client's
+        known = {
+            message_id: (str(room_id), timestamp)
+            for message_id, room_id, timestamp in Message.objects.filter(
+                id__in=message_ids
+            ).values_list('id', 'room_id', 'timestamp')
+        }
+        advanced = {}
+        with transaction.atomic():
+            for (group_name, room_id), cursors in pending.items():
+                for user_id, (_timestamp, message_id) in cursors.items():
+                    if message_id not in known or known[message_id][0] != room_id:
+                        continue
+                    timestamp = known[message_id][1]
+                    if not RoomReadState.objects.advance(user_id, room_id, message_id, timestamp):
+                        # Not a member, or already read past it: nothing to announce
+                        continue
+                    advanced.setdefault(group_name, []).append({
+                        'user_id': str(user_id),
+                        'message_id': str(message_id),
+                        'timestamp': timestamp.isoformat(),
+                    })
+        return advanced
+
+
+_receipts = None
+
+
+def get_read_receipts():
+    """
+    Return the per-process ReadReceiptBuffer, creating it on first use
+    """
+    global _receipts
+    if _receipts is None:
+        _receipts = ReadReceiptBuffer(interval=settings.CHAT_READ_RECEIPT_INTERVAL)
+    return _receipts
@@ -0,0 +1,124 @@
+import math
+import threading
+from collections import defaultdict, deque
+from django.conf import settings
+from django.utils.module_loading import import_string
+from .encoding import encode_frame
+from .models import Message
+from .presence import channel_layer_redis_url
+
+
+def cursor_key(cursor):
+    return Message.decode_cursor(cursor)
+
+
+def frames_since(entries, cursor, size):
+    """
+    Return (frames, complete) for the (cursor, text) entries newer than
+    `cursor`. complete is False when the buffer cannot prove it still holds
+    every message after the cursor (it starts after it, or has wrapped).
+    """
+    if not cursor:
+        return [text for _cursor, text in entries], len(entries) < size
+    since = cursor_key(cursor)
+    keys = [(cursor_key(entry_cursor), text) for entry_cursor, text in entries]
+    complete = bool(keys) and keys[0][0] <= since
+    return [text for key, text in keys if key > since], complete
+
+
+def message_frame(message):
+    """
+    Encoded chat_message frame for a stored message (sender loaded)
+    """
+    return encode_frame({'type': 'chat_message', **message.to_dict()})
+
+
+def missed_frames(room_id, cursor):
+    """
+    Return (frames, complete) for the room's chat messages after `cursor`.
+    They come from the replay buffer when it reaches back to the cursor, and
+    from the database otherwise (the buffer expired in a quiet room, or
+    wrapped). The database read is capped at CHAT_REPLAY_BUFFER_SIZE
+    messages, and complete is False only when more than that were missed.
+    Raises ValueError for a malformed cursor.
+    """
+    frames, complete = get_replay_buffer().since(room_id, cursor)
+    if complete or not cursor:
+        return frames, complete
+    limit = settings.CHAT_REPLAY_BUFFER_SIZE
+    messages = list(
+        Message.objects.filter(room_id=room_id).after(cursor)
+        .select_related('sender').order_by('timestamp', 'id')[:limit + 1]
+    )
+    if len(messages) > limit:
+        return [], False
+    return [message_frame(message) for message in messages], True
+
+
+class LocalReplayBuffer:
+    """
+    In-process ring buffer of each room's most recent chat_message frames,
+    for development and a single worker
+    """
+    def __init__(self, size=200, ttl=3600):
+        self.size = size
+        self.rooms = defaultdict(lambda: deque(maxlen=self.size))
+        self.lock = threading.Lock()
+
+    def append(self, room_id, cursor, text):
+        with self.lock:
+            self.rooms[str(room_id)].append((cursor, text))
+
+    def since(self, room_id, cursor):
+        with self.lock:
+            entries = list(self.rooms.get(str(room_id), ()))
+        return frames_since(entries, cursor, self.size)
+
+
+class RedisReplayBuffer:
+    """
+    Ring buffer kept in the channel layer's Redis so any worker can replay.
+
+    Keys:
+      chat:replay:<room id>  list of "<cursor>\\n<frame>", oldest first,
+                             trimmed to `size` and expiring after `ttl`
+    """
+    def __init__(self, size=200, ttl=3600, url=None):
+        import redis
+        self.size = size
+        self.ttl = ttl
+        self.client = redis.Redis.from_url(url or channel_layer_redis_url())
+
+    def key(self, room_id):
+        return f'chat:replay:{room_id}'
+
+    def append(self, room_id, cursor, text):
+        key = self.key(room_id)
+        pipe = self.client.pipeline()
+        pipe.rpush(key, f'{cursor}\n{text}')
+        pipe.ltrim(key, -self.size, -1)
+        pipe.expire(key, math.ceil(self.ttl))
+        pipe.execute()
+
+    def since(self, room_id, cursor):
+        entries = [
+            entry.decode().split('\n', 1)
+            for entry in self.client.lrange(self.key(room_id), 0, -1)
+        ]
+        return frames_since(entries, cursor, self.size)
+
+
+_buffer = None
+
+
+def get_replay_buffer():
+    """
+    Return the configured replay buffer, creating it on first use
+    """
+    global _buffer
+    if _buffer is None:
+        _buffer = import_string(settings.CHAT_REPLAY_BACKEND)(
+            size=settings.CHAT_REPLAY_BUFFER_SIZE,
+            ttl=settings.CHAT_REPLAY_TTL,
+        )
+    return _buffer
@@ -0,0 +1,78 @@
+from django.contrib.auth.models import User
+from .models import ChatRoom
+from django.core.exceptions import ObjectDoesNotExist
+from .access import get_room_cache
+from .presence import get_presence_store
+
+# Roster sections, in display order
+ONLINE = 'online'
+OFFLINE = 'offline'
+
+
+def encode_cursor(section, username):
+    return f'{section}:{username}'
+
+
+def decode_cursor(cursor):
+    section, _sep, username = cursor.partition(':')
+    if section not in (ONLINE, OFFLINE) or not username:
+        raise ValueError(f'invalid roster cursor: {cursor!r}')
+    return section, username
+
+
+def roster_entry(user, section, creator_id):
+    try:
+        profile = user.profile
+    except ObjectDoesNotExist:
+        profile = None
+    return {
+        'id': str(user.id),
+        'username': user.username,
+        'online': section == ONLINE,
+        'is_creator': user.id == creator_id,
+        'last_seen': profile.last_seen if profile else None,
+        'avatar': profile.avatar_sources() if profile else None,
+    }
+
+
+def roster_page(room_id, after=None, limit=50):
+    """
+    One page of the room's participants: online members first, then the
+    rest, each section ordered by username and keyset-paginated with an
+    opaque cursor. Returns (entries, next_cursor, member_count, online_count);
+    next_cursor is None on the last page. Raises ValueError for a bad cursor.
+
+    The member count comes from the room cache, and the presence store is
+    asked about this room's members only, so a page costs one query for the
+    member ids and one presence lookup for them, plus one query per section
+    it touches, profiles included.
+    """
+    room = get_room_cache().get(room_id)
+    if room is None:
+        return [], None, 0, 0
+    members = set(ChatRoom.participants.through.objects.filter(chatroom_id=room['id']).values_list('user_id', flat=True))
+    online_ids = get_presence_store().online_among(members)
+
+    sections = [
+        (ONLINE, User.objects.filter(id__in=online_ids)),
+        (OFFLINE, User.objects.filter(chat_rooms=room['id']).exclude(id__in=online_ids)),
+    ]
+    start, after_username = decode_cursor(after) if after else (ONLINE, '')
+    while sections[0][0] != start:
+        sections.pop(0)
+
+    rows = []
+    for section, users in sections:
+        remaining = limit + 1 - len(rows)
+        if remaining <= 0:
+            break
+        if section == start and after_username:
+            users = users.filter(username__gt=after_username)
+        rows += [(section, user) for user in users.select_related('profile').order_by('username')[:remaining]]
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][0], rows[-1][1].username)
+    entries = [roster_entry(user, section, room['creator_id']) for section, user in rows]
+    return entries, next_cursor, room['member_count'], len(online_ids)
@@ -1,6 +1,11 @@
+from django.conf import settings
 from django.urls import re_path
 from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'ws/chat/(?P<room_id>[^/]+)/$', consumers.ChatConsumer.as_asgi()),
-]
\ No newline at end of file
+]
+
+if settings.CHAT_MULTIPLEX:
+    # One socket for all of a client's rooms
+    websocket_urlpatterns.append(re_path(r'ws/chat/$', consumers.MultiplexConsumer.as_asgi()))
\ No newline at end of file
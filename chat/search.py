@@ -0,0 +1,273 @@
+import re
+import uuid
+from django.conf import settings
+from django.db import connection
+from django.utils.html import escape
+from django.utils.module_loading import import_string
+from .archive import fetch_messages
+from .models import ArchivedMessage, Message
+
+# Private-use markers wrapped around matches by the database; the snippet is
+# HTML-escaped afterwards and the markers become <mark> tags
+MATCH_START = '\ue000'
+MATCH_END = '\ue001'
+
+ARABIC_DIACRITICS = re.compile('[\u0610-\u061a\u0640\u064b-\u065f\u0670\u06d6-\u06ed]')
+ARABIC_LETTERS = str.maketrans({
+    'أ': 'ا',
+    'إ': 'ا',
+    'آ': 'ا',
+    'ٱ': 'ا',
+    'ى': 'ي',
+    'ة': 'ه',
+})
+
+
+def normalize_text(text):
+    """
+    Fold Arabic spelling variants so indexed text and queries agree: drop
+    harakat and tatweel, unify alef/yeh/teh marbuta forms. English is left
+    to the tokenizer (case folding and stemming).
+    """
+    return ARABIC_DIACRITICS.sub('', text).translate(ARABIC_LETTERS)
+
+
+def highlight(snippet):
+    return escape(snippet).replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>')
+
+
+def mark_original(original, marked):
+    """
+    Copy the match markers of `marked`, which is normalize_text(original)
+    with markers inserted, onto `original`. normalize_text works character
+    by character, dropping some and replacing others one for one, so the two
+    can be walked side by side; dropped characters (diacritics) stay with
+    the letter before them.
+    """
+    result = []
+    position = 0
+    for char in original:
+        if normalize_text(char):
+            while position < len(marked) and marked[position] in (MATCH_START, MATCH_END):
+                result.append(marked[position])
+                position += 1
+            position += 1
+        result.append(char)
+    result.append(marked[position:])
+    return ''.join(result)
+
+
+def trim_snippet(text, words=16):
+    """
+    Cut marked text to `words` words around its first match
+    """
+    parts = text.split()
+    if len(parts) <= words:
+        return ' '.join(parts)
+    first = next((i for i, part in enumerate(parts) if MATCH_START in part), 0)
+    start = max(0, min(first - words // 4, len(parts) - words))
+    end = start + words
+    return ('…' if start else '') + ' '.join(parts[start:end]) + ('…' if end < len(parts) else '')
+
+
+class BaseSearchBackend:
+    """
+    Interface for message search backends.
+
+    search() returns (hits, has_more) where each hit is a dict with
+    'message_id' (UUID) and 'snippet' (HTML-safe, matches in <mark>).
+    """
+    def index(self, messages):
+        pass
+
+    def remove(self, message_ids):
+        pass
+
+    def rebuild(self, batch_size=1000, queryset=None):
+        pass
+
+    def search(self, room_id, query, limit=20, offset=0):
+        raise NotImplementedError
+
+
+class SQLiteFTSBackend(BaseSearchBackend):
+    """
+    SQLite FTS5 index kept in the chat_message_fts virtual table (created by
+    migration 0005, rebuilt by 0013). Room and message ids are stored as
+    indexed tokens so room scoping and per-message deletes are index
+    lookups. Content is indexed normalized, and the original is kept in an
+    UNINDEXED column so snippets show the text as it was written.
+    """
+    table = 'chat_message_fts'
+
+    def index(self, messages):
+        messages = list(messages)
+        if not messages:
+            return
+        self.remove(message.id for message in messages)
+        self.insert(messages)
+
+    def remove(self, message_ids):
+        match = ' OR '.join(f'"{message_id.hex}"' for message_id in message_ids)
+        if not match:
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {self.table} WHERE rowid IN '
+                f'(SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s)',
+                [f'message_id:({match})']
+            )
+
+    def rebuild(self, batch_size=1000, queryset=None):
+        # Archived messages keep their entries, so both tables are indexed
+        querysets = [Message.objects.all(), ArchivedMessage.objects.all()] if queryset is None else [queryset]
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table}')
+        batch = []
+        for queryset in querysets:
+            for message in queryset.only('id', 'room_id', 'content').order_by().iterator(chunk_size=batch_size):
+                batch.append(message)
+                if len(batch) >= batch_size:
+                    self.insert(batch)
+                    batch = []
+        self.insert(batch)
+
+    def insert(self, messages):
+        # Plain insert; index() removes existing rows for the messages first
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f'INSERT INTO {self.table} (content, room_id, message_id, original) VALUES (%s, %s, %s, %s)',
+                [
+                    (normalize_text(message.content), uuid.UUID(str(message.room_id)).hex, message.id.hex, message.content)
+                    for message in messages
+                ]
+            )
+
+    def match_expression(self, room_id, query):
+        terms = normalize_text(query).split()
+        if not terms:
+            return None
+        phrases = ['"' + term.replace('"', '""') + '"' for term in terms]
+        # Prefix-match the last word so results follow the user's typing
+        phrases[-1] += '*'
+        return f'room_id:"{uuid.UUID(str(room_id)).hex}" AND content:({" ".join(phrases)})'
+
+    def search(self, room_id, query, limit=20, offset=0):
+        match = self.match_expression(room_id, query)
+        if match is None:
+            return [], False
+        with connection.cursor() as cursor:
+            # highlight() marks the whole normalized text; the markers are
+            # moved onto the original and the snippet is cut from that
+            cursor.execute(
+                f'SELECT message_id, highlight({self.table}, 0, %s, %s), original FROM {self.table} '
+                f'WHERE {self.table} MATCH %s ORDER BY rank LIMIT %s OFFSET %s',
+                [MATCH_START, MATCH_END, match, limit + 1, offset]
+            )
+            rows = cursor.fetchall()
+        hits = [
+            {'message_id': uuid.UUID(message_id), 'snippet': highlight(trim_snippet(mark_original(original, marked)))}
+            for message_id, marked, original in rows[:limit]
+        ]
+        return hits, len(rows) > limit
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """
+    PostgreSQL full-text search over to_tsvector(config, content), backed by
+    the GIN expression index created in migration 0005. The index is
+    maintained by PostgreSQL, so index()/remove() have nothing to do.
+    """
+    config = 'simple'
+
+    def matches(self, model, room_id, search_query):
+        from django.contrib.postgres.search import SearchHeadline, SearchRank, SearchVector
+
+        vector = SearchVector('content', config=self.config)
+        return (
+            model.objects.filter(room_id=room_id)
+            .annotate(document=vector)
+            .filter(document=search_query)
+            .annotate(
+                rank=SearchRank(vector, search_query),
+                snippet=SearchHeadline(
+                    'content', search_query, config=self.config,
+                    start_sel=MATCH_START, stop_sel=MATCH_END, max_words=16,
+                ),
+            )
+            .order_by()
+            .values_list('id', 'snippet', 'rank', 'timestamp')
+        )
+
+    def search(self, room_id, query, limit=20, offset=0):
+        from django.contrib.postgres.search import SearchQuery
+
+        search_query = SearchQuery(normalize_text(query), config=self.config, search_type='plain')
+        # Hot and archived messages are ranked together
+        rows = list(
+            self.matches(Message, room_id, search_query)
+            .union(self.matches(ArchivedMessage, room_id, search_query), all=True)
+            .order_by('-rank', '-timestamp')[offset:offset + limit + 1]
+        )
+        hits = [{'message_id': message_id, 'snippet': highlight(snippet)} for message_id, snippet, _rank, _ts in rows[:limit]]
+        return hits, len(rows) > limit
+
+
+class ContainsSearchBackend(BaseSearchBackend):
+    """
+    Fallback for databases without a full-text backend (table scan)
+    """
+    def search(self, room_id, query, limit=20, offset=0):
+        matches = [
+            model.objects.filter(room_id=room_id, content__icontains=query)
+            .order_by()
+            .values_list('id', 'content', 'timestamp')
+            for model in (Message, ArchivedMessage)
+        ]
+        rows = list(matches[0].union(matches[1], all=True).order_by('-timestamp')[offset:offset + limit + 1])
+        pattern = re.compile(re.escape(query), re.IGNORECASE)
+        hits = [
+            {'message_id': message_id, 'snippet': highlight(pattern.sub(lambda m: MATCH_START + m.group() + MATCH_END, content))}
+            for message_id, content, _timestamp in rows[:limit]
+        ]
+        return hits, len(rows) > limit
+
+
+VENDOR_BACKENDS = {
+    'sqlite': SQLiteFTSBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+_backend = None
+
+
+def get_search_backend():
+    """
+    Return the configured search backend. CHAT_SEARCH_BACKEND may be 'auto'
+    (chosen from the database vendor) or a dotted path.
+    """
+    global _backend
+    if _backend is None:
+        if settings.CHAT_SEARCH_BACKEND == 'auto':
+            _backend = VENDOR_BACKENDS.get(connection.vendor, ContainsSearchBackend)()
+        else:
+            _backend = import_string(settings.CHAT_SEARCH_BACKEND)()
+    return _backend
+
+
+def search_messages(room_id, query, page=1, page_size=20):
+    """
+    Room-scoped search; returns (results, has_more) where each result is the
+    message's to_dict() plus a highlighted 'snippet'. Callers are
+    responsible for checking the user may view the room.
+    """
+    hits, has_more = get_search_backend().search(
+        room_id, query, limit=page_size, offset=(page - 1) * page_size
+    )
+    messages = fetch_messages([hit['message_id'] for hit in hits])
+    results = []
+    for hit in hits:
+        message = messages.get(hit['message_id'])
+        if message is not None:
+            results.append(dict(message.to_dict(), snippet=hit['snippet']))
+    return results, has_more
@@ -0,0 +1,31 @@
+from daphne.cli import CommandLineInterface
+from daphne.server import Server
+
+# Scope extension carrying a WebSocket connection's Twisted transport. ASGI
+# middleware rewraps send() (channels' SessionMiddleware does), but copies
+# the scope's keys through, so the consumer can still find the transport
+TRANSPORT_EXTENSION = 'chat.transport'
+
+
+class ChatServer(Server):
+    """
+    Daphne server that exposes each WebSocket connection's transport to the
+    application under scope['extensions'], for write-buffer backpressure
+    (see backpressure.TransportWritable)
+    """
+    def create_application(self, protocol, scope):
+        if scope.get('type') == 'websocket' and getattr(protocol, 'transport', None) is not None:
+            scope.setdefault('extensions', {})[TRANSPORT_EXTENSION] = {'transport': protocol.transport}
+        return super().create_application(protocol, scope)
+
+
+class ChatCommandLineInterface(CommandLineInterface):
+    """
+    The daphne command line, serving with ChatServer:
+    python -m chat.server config.asgi:application
+    """
+    server_class = ChatServer
+
+
+if __name__ == '__main__':
+    ChatCommandLineInterface.entrypoint()
@@ -0,0 +1,93 @@
+from django.contrib.auth.models import User
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from .autocomplete import index_user
+from .metrics import install_query_wrapper
+from .access import get_room_cache
+from .models import ChatRoom, Message, RoomReadState, UserProfile
+from .preferences import invalidate_preferences
+from .search import get_search_backend
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    install_query_wrapper(connection)
+
+
+@receiver(post_save, sender=ChatRoom)
+@receiver(post_delete, sender=ChatRoom)
+def invalidate_room(sender, instance, **kwargs):
+    get_room_cache().invalidate(instance.pk)
+
+
+@receiver(m2m_changed, sender=ChatRoom.participants.through)
+def invalidate_room_participants(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action.startswith('post_'):
+            get_room_cache().invalidate(instance.pk)
+        return
+
+    # user.chat_rooms.add/remove/clear(): `instance` is the user
+    if action == 'pre_clear':
+        instance._chat_cleared_room_ids = list(instance.chat_rooms.values_list('id', flat=True))
+    elif action == 'post_clear':
+        pk_set = getattr(instance, '_chat_cleared_room_ids', [])
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        for room_id in pk_set or ():
+            get_room_cache().invalidate(room_id)
+
+
+@receiver(post_save, sender=Message)
+def index_message(sender, instance, raw=False, **kwargs):
+    if not raw:
+        get_search_backend().index([instance])
+
+
+@receiver(post_save, sender=Message)
+def count_unread(sender, instance, created=False, raw=False, **kwargs):
+    if created and not raw:
+        RoomReadState.objects.message_sent(instance.room_id, instance.sender_id)
+
+
+@receiver(m2m_changed, sender=ChatRoom.participants.through)
+def sync_read_states(sender, instance, action, reverse, pk_set, **kwargs):
+    # Every participant has a read-state row for message_sent() to bump
+    if reverse:
+        # user.chat_rooms.add/remove/clear(): `instance` is the user
+        states = RoomReadState.objects.filter(user_id=instance.pk)
+        if action == 'post_add':
+            for room_id in pk_set:
+                RoomReadState.objects.add_members(room_id, [instance.pk])
+        elif action == 'post_remove':
+            states.filter(room_id__in=pk_set).delete()
+        elif action == 'post_clear':
+            states.delete()
+        return
+
+    states = RoomReadState.objects.filter(room_id=instance.pk)
+    if action == 'post_add':
+        RoomReadState.objects.add_members(instance.pk, pk_set)
+    elif action == 'post_remove':
+        states.filter(user_id__in=pk_set).delete()
+    elif action == 'post_clear':
+        states.delete()
+
+
+@receiver(post_delete, sender=Message)
+def unindex_message(sender, instance, **kwargs):
+    get_search_backend().remove([instance.pk])
+
+
+@receiver(post_save, sender=User)
+def index_user_names(sender, instance, raw=False, update_fields=None, **kwargs):
+    # Logins save only last_login; skip saves that cannot change the names
+    if raw or (update_fields is not None and not {'username', 'first_name', 'last_name'} & set(update_fields)):
+        return
+    index_user(instance)
+
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def invalidate_user_preferences(sender, instance, **kwargs):
+    invalidate_preferences(instance.user_id)
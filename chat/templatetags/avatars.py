@@ -0,0 +1,21 @@
+from django import template
+
+register = template.Library()
+
+
+@register.inclusion_tag('chat/avatar.html')
+def avatar(sources, size, css_class='', alt=''):
+    """
+    Render UserProfile.avatar_sources() at `size` CSS pixels: WebP with a
+    JPEG/PNG fallback and 2x variants when the thumbnails exist, otherwise
+    the original upload
+    """
+    variants = sources['variants']
+    return {
+        'sources': sources,
+        'variant': variants.get(str(size)),
+        'retina': variants.get(str(size * 2)),
+        'size': size,
+        'css_class': css_class,
+        'alt': alt,
+    }
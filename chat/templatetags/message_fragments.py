@@ -0,0 +1,13 @@
+from django import template
+from chat.fragments import render_fragments
+
+register = template.Library()
+
+
+@register.simple_tag
+def rendered_messages(messages, user):
+    """
+    The messages' bubbles as cached HTML fragments, for
+    {% rendered_messages messages user as fragments %}
+    """
+    return render_fragments(messages, user)
@@ -1,3 +1,1078 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import tempfile
+from datetime import timedelta
+from io import BytesIO
+from asgiref.sync import async_to_sync
+from channels.auth import AuthMiddlewareStack
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, transaction
+from django.template import Context, Template
+from django.template.loader import render_to_string
+from django.test import RequestFactory, TestCase
+from django.test.signals import template_rendered
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils import timezone, translation
+from PIL import Image
+from .access import get_room_cache
+from .admin import MessageAdmin
+from .archive import archive_messages, message_page
+from .autocomplete import search_users
+from .avatars import store_variants
+from .backpressure import DISCONNECT, DROPPED, QUEUED, RESYNC, RESYNC_FRAME, OutboundQueue, transport_writable
+from .consumers import MEDIA_CHANNEL, NOTIFICATION_CHANNEL, ChatConsumer
+from .fragments import RECEIVED, SENT, fragment_key
+from .models import ArchivedMessage, ChatRoom, Message, Notification, RoomReadState, UserProfile, UserSearchTerm
+from . import replay
+from .persistence import MessageBatcher
+from .preferences import get_preferences
+from .presence import get_presence_store
+from .receipts import ReadReceiptBuffer
+from .replay import get_replay_buffer, missed_frames
+from .roster import roster_page
+from .routing import websocket_urlpatterns
+from .search import search_messages
+from .server import TRANSPORT_EXTENSION, ChatServer
+from .transfer import export_chunks, import_history, read_records
+from .typing import TypingCoalescer, get_typing_coalescer
+from .views import send_message
 
-# Create your tests here.
+# Tests run without Redis: in-process cache, channel layer and stores
+LOCAL_SERVICES = dict(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    CHAT_PRESENCE_BACKEND='chat.presence.LocalPresenceStore',
+    CHAT_REPLAY_BACKEND='chat.replay.LocalReplayBuffer',
+)
+
+
+@override_settings(**LOCAL_SERVICES)
+class MessageRenderQueryTests(TestCase):
+    """
+    Rendering the room message loop must not issue queries per message
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.viewer = User.objects.create_user('viewer', password='x')
+        cls.senders = [User.objects.create_user(f'sender{i}', password='x') for i in range(5)]
+        for sender in cls.senders:
+            UserProfile.objects.create(user=sender, avatar=f'avatars/{sender.username}.png')
+        cls.room = ChatRoom.objects.create(name='Busy room', creator=cls.viewer)
+
+    def create_messages(self, count):
+        parent = None
+        for i in range(count):
+            parent = Message.objects.create(
+                room=self.room,
+                sender=self.senders[i % len(self.senders)],
+                content=f'message {i}',
+                parent_message=parent if i % 2 else None,
+            )
+
+    def count_render_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            messages, _has_more = self.room.messages.for_display().page(limit=500)
+            html = render_to_string('chat/message_list.html', {
+                'messages': messages,
+                'user': self.viewer,
+            })
+        return len(ctx.captured_queries), html
+
+    def test_query_count_is_constant(self):
+        self.create_messages(5)
+        small, _html = self.count_render_queries()
+
+        self.create_messages(200)
+        large, html = self.count_render_queries()
+
+        self.assertEqual(small, 1)
+        self.assertEqual(large, small)
+        self.assertIn('avatars/sender0.png', html)
+        self.assertIn('Reply to', html)
+
+
+@override_settings(**LOCAL_SERVICES, ALLOWED_HOSTS=['testserver'])
+class InboxQueryTests(TestCase):
+    """
+    The index inbox loads every room's preview and unread count in a
+    constant number of queries
+    """
+    def setUp(self):
+        self.user = User.objects.create_user('inbox', password='x')
+        self.other = User.objects.create_user('other', password='x')
+        self.client.force_login(self.user)
+        with translation.override('en'):
+            self.url = reverse('chat:index')
+
+    def add_rooms(self, count):
+        for i in range(count):
+            room = ChatRoom.objects.create(name=f'Room {i}', creator=self.other)
+            room.participants.add(self.user, self.other)
+            Message.objects.create(room=room, sender=self.other, content=f'hello {i}')
+
+    def inbox_rows(self):
+        response = self.client.get(self.url)
+        return [(room.last_message_content, room.last_message_sender, room.unread_count) for room in response.context['rooms']]
+
+    def test_query_count_is_constant_in_the_number_of_rooms(self):
+        self.add_rooms(2)
+        # The first request also loads the cached user preferences
+        self.inbox_rows()
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(len(self.inbox_rows()), 2)
+
+        self.add_rooms(20)
+        with self.assertNumQueries(len(ctx.captured_queries)):
+            rows = self.inbox_rows()
+        self.assertEqual(len(rows), 22)
+        self.assertIn(('hello 0', 'other', 1), rows)
+
+
+@override_settings(**LOCAL_SERVICES)
+class FragmentCacheTests(TestCase):
+    """
+    Message bubbles are rendered once per viewer variant and language, and
+    again whenever what they show changes
+    """
+    def setUp(self):
+        cache.clear()
+        self.sender = User.objects.create_user('sender', password='x')
+        self.viewer = User.objects.create_user('viewer', password='x')
+        self.profile = UserProfile.objects.create(user=self.sender, avatar='avatars/first.png')
+        self.room = ChatRoom.objects.create(name='Fragments', creator=self.sender)
+        self.parent = Message.objects.create(room=self.room, sender=self.viewer, content='original question')
+        self.reply = Message.objects.create(room=self.room, sender=self.sender, content='answer', parent_message=self.parent)
+        self.renders = []
+        template_rendered.connect(self.record_render)
+        self.addCleanup(template_rendered.disconnect, self.record_render)
+
+    def record_render(self, sender, template, context, **kwargs):
+        if template.name == 'chat/message.html':
+            self.renders.append(context['message'].id)
+
+    def render(self, user, language='en'):
+        messages = list(Message.objects.filter(id=self.reply.id).for_display())
+        with translation.override(language):
+            return Template(
+                '{% load message_fragments %}{% rendered_messages messages user as fragments %}{{ fragments.0 }}'
+            ).render(Context({'messages': messages, 'user': user}))
+
+    def test_second_render_comes_from_the_cache(self):
+        first = self.render(self.viewer)
+        with self.assertNumQueries(1):
+            second = self.render(self.viewer)
+
+        self.assertEqual(second, first)
+        self.assertEqual(self.renders, [self.reply.id])
+
+    def test_key_varies_by_variant_and_language(self):
+        message = Message.objects.for_display().get(id=self.reply.id)
+        keys = {fragment_key(message, variant, language, 'UTC') for variant in (SENT, RECEIVED) for language in ('en', 'ar')}
+        self.assertEqual(len(keys), 4)
+
+        self.assertIn('message-bubble sent', self.render(self.sender))
+        self.assertIn('message-bubble received', self.render(self.viewer))
+        self.render(self.viewer, 'ar')
+        self.assertEqual(len(self.renders), 3)
+
+    def test_changes_to_what_the_bubble_shows_render_a_new_fragment(self):
+        self.render(self.viewer)
+
+        self.profile.avatar = 'avatars/second.png'
+        self.profile.save()
+        self.assertIn('avatars/second.png', self.render(self.viewer))
+
+        self.sender.username = 'renamed'
+        self.sender.save()
+        self.assertIn('renamed', self.render(self.viewer))
+
+        self.parent.content = 'edited question'
+        self.parent.save()
+        self.assertIn('edited question', self.render(self.viewer))
+
+        self.assertEqual(len(self.renders), 4)
+
+
+@override_settings(**LOCAL_SERVICES)
+class HistoryTransferTests(TestCase):
+    """
+    Importing an export never touches rows already stored, in this room or another
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', password='x')
+        cls.room = ChatRoom.objects.create(name='Private', creator=cls.owner)
+        cls.other_room = ChatRoom.objects.create(name='Other', creator=cls.owner)
+
+    def export(self, room):
+        return list(read_records(''.join(export_chunks(room.id)).splitlines()))
+
+    def setUp(self):
+        parent = Message.objects.create(room=self.room, sender=self.owner, content='confidential plan')
+        Message.objects.create(room=self.room, sender=self.owner, content='reply', parent_message=parent)
+
+    def test_reimport_skips_existing_rows(self):
+        importer = import_history(self.room, self.export(self.room))
+
+        self.assertEqual((importer.written, importer.skipped, importer.conflicts), (0, 2, 0))
+        self.assertEqual(self.room.messages.count(), 2)
+
+    def test_import_into_another_room_leaves_source_untouched(self):
+        records = self.export(self.room)
+        records.append({'id': 'ext-1', 'timestamp': '2024-01-01T00:00:00+00:00', 'sender': 'owner', 'content': 'new', 'parent_id': None})
+
+        importer = import_history(self.other_room, records)
+
+        self.assertEqual((importer.written, importer.skipped, importer.conflicts), (1, 0, 2))
+        self.assertEqual(self.room.messages.count(), 2)
+        self.assertEqual(list(self.other_room.messages.values_list('content', flat=True)), ['new'])
+        self.assertEqual(len(search_messages(self.room.id, 'confidential')[0]), 1)
+        self.assertEqual(search_messages(self.other_room.id, 'confidential')[0], [])
+
+    def test_view_streams_keyset_batches_asynchronously(self):
+        Message.objects.create(room=self.room, sender=self.owner, content='third')
+        self.client.force_login(self.owner)
+        with self.settings(CHAT_EXPORT_CHUNK_SIZE=1, ALLOWED_HOSTS=['testserver']), translation.override('en'):
+            response = self.client.get(reverse('chat:export_room_history', args=[self.room.id]) + '?format=csv')
+        self.assertTrue(response.is_async)
+
+        async def read():
+            return [chunk async for chunk in response.streaming_content]
+
+        chunks = async_to_sync(read)()
+        # Header, then one chunk per message
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual(b''.join(chunks).decode(), ''.join(export_chunks(self.room.id, 'csv')))
+
+    def test_archived_rows_are_not_duplicated(self):
+        records = self.export(self.room)
+        archive_messages(days=-1)
+        self.assertFalse(self.room.messages.exists())
+
+        importer = import_history(self.room, records)
+
+        self.assertEqual((importer.written, importer.skipped), (0, 2))
+        self.assertFalse(self.room.messages.exists())
+
+
+@override_settings(**LOCAL_SERVICES)
+class ArchivePagingTests(TestCase):
+    """
+    History pages interleave archived messages with parents kept hot for their replies
+    """
+    def setUp(self):
+        self.user = User.objects.create_user('author', password='x')
+        self.room = ChatRoom.objects.create(name='Archive', creator=self.user)
+        now = timezone.now()
+        parent = self.message('parent A', now - timedelta(days=10))
+        for i in range(5):
+            self.message(f'old {i}', now - timedelta(days=9 - i))
+        self.message('reply to A', now - timedelta(minutes=2), parent=parent)
+        self.message('new', now - timedelta(minutes=1))
+        archive_messages(days=1)
+
+    def message(self, content, timestamp, parent=None):
+        return Message.objects.create(room=self.room, sender=self.user, content=content, timestamp=timestamp, parent_message=parent)
+
+    def test_archived_messages_newer_than_a_kept_parent_are_paged(self):
+        self.assertEqual(ArchivedMessage.objects.filter(room=self.room).count(), 5)
+        expected = ['parent A'] + [f'old {i}' for i in range(5)] + ['reply to A', 'new']
+
+        messages, has_more = message_page(self.room.id, limit=50)
+        self.assertEqual([message.content for message in messages], expected)
+        self.assertFalse(has_more)
+
+        seen, before, has_more = [], None, True
+        while has_more:
+            messages, has_more = message_page(self.room.id, before=before, limit=3)
+            seen[:0] = [message.content for message in messages]
+            before = messages[0].cursor
+        self.assertEqual(seen, expected)
+
+    def test_endpoint_pages_across_the_archive_until_no_cursor(self):
+        self.client.force_login(self.user)
+        with self.settings(ALLOWED_HOSTS=['testserver']), translation.override('en'):
+            url = reverse('chat:message_history', args=[self.room.id])
+            seen, params = [], {'limit': 3}
+            while True:
+                data = self.client.get(url, params).json()
+                seen[:0] = [message['content'] for message in data['messages']]
+                if data['next_cursor'] is None:
+                    break
+                params['before'] = data['next_cursor']
+        self.assertFalse(data['has_more'])
+        self.assertEqual(seen, ['parent A'] + [f'old {i}' for i in range(5)] + ['reply to A', 'new'])
+
+    def test_archived_messages_stay_searchable(self):
+        hits, _has_more = search_messages(self.room.id, 'old')
+        self.assertEqual(len(hits), 5)
+
+
+@override_settings(**LOCAL_SERVICES, ALLOWED_HOSTS=['testserver'])
+class HistoryPagingTests(TestCase):
+    """
+    History pages follow a (timestamp, id) keyset cursor
+    """
+    def setUp(self):
+        self.user = User.objects.create_user('pager', password='x')
+        self.room = ChatRoom.objects.create(name='Paging', creator=self.user)
+        self.client.force_login(self.user)
+        with translation.override('en'):
+            self.url = reverse('chat:message_history', args=[self.room.id])
+
+    def test_ties_on_timestamp_are_ordered_by_id(self):
+        timestamp = timezone.now() - timedelta(minutes=5)
+        tied = Message.objects.bulk_create(
+            Message(room=self.room, sender=self.user, content=f'tie {i}', timestamp=timestamp) for i in range(5)
+        )
+        expected = [message.id for message in sorted(tied, key=lambda message: message.id)]
+        messages = self.room.messages.all()
+
+        self.assertEqual(sorted(messages.before(tied[2].cursor).values_list('id', flat=True)), [i for i in expected if i < tied[2].id])
+        seen, before, has_more = [], None, True
+        while has_more:
+            page, has_more = messages.page(before=before, limit=2)
+            seen[:0] = [message.id for message in page]
+            before = page[0].cursor
+        self.assertEqual(seen, expected)
+
+    def test_malformed_cursor_is_a_bad_request(self):
+        message = Message.objects.create(room=self.room, sender=self.user, content='only')
+        for cursor in ('garbage', f'yesterday_{message.id}', f'{message.timestamp.isoformat()}_not-a-uuid'):
+            with self.subTest(cursor=cursor):
+                self.assertEqual(self.client.get(self.url, {'before': cursor}).status_code, 400)
+
+    def test_last_page_has_no_cursor(self):
+        for i in range(3):
+            Message.objects.create(room=self.room, sender=self.user, content=f'm{i}')
+
+        first = self.client.get(self.url, {'limit': 2}).json()
+        self.assertTrue(first['has_more'])
+        self.assertEqual(first['next_cursor'], first['messages'][0]['cursor'])
+        last = self.client.get(self.url, {'limit': 2, 'before': first['next_cursor']}).json()
+        self.assertEqual([message['content'] for message in last['messages']], ['m0'])
+        self.assertEqual((last['has_more'], last['next_cursor']), (False, None))
+
+
+@override_settings(**LOCAL_SERVICES)
+class RoomCacheTests(TestCase):
+    """
+    Membership answers follow participant changes
+    """
+    def test_removed_participant_loses_access(self):
+        creator = User.objects.create_user('creator', password='x')
+        member = User.objects.create_user('member', password='x')
+        room = ChatRoom.objects.create(name='Private', creator=creator, is_private=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            room.participants.add(member)
+        room_cache = get_room_cache()
+        self.assertTrue(room_cache.can_view(room.id, member))
+        self.assertEqual(room_cache.get(room.id)['member_count'], 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            room.participants.remove(member)
+
+        self.assertFalse(room_cache.can_view(room.id, member))
+        self.assertTrue(room_cache.can_view(room.id, creator))
+        self.assertEqual(room_cache.get(room.id)['member_count'], 0)
+
+    def test_removal_is_cached_only_after_commit(self):
+        creator = User.objects.create_user('creator', password='x')
+        member = User.objects.create_user('member', password='x')
+        room = ChatRoom.objects.create(name='Private', creator=creator, is_private=True)
+        room.participants.add(member)
+        room_cache = get_room_cache()
+        self.assertTrue(room_cache.can_view(room.id, member))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                room.participants.remove(member)
+                # Still the committed answer; nothing was dropped early
+                self.assertTrue(room_cache.can_view(room.id, member))
+
+        self.assertFalse(room_cache.can_view(room.id, member))
+
+
+@override_settings(**LOCAL_SERVICES)
+class PreferencesCacheTests(TestCase):
+    """
+    Cached preferences are dropped once a profile change is committed
+    """
+    def setUp(self):
+        cache.clear()
+
+    def test_profile_change_is_visible_after_commit(self):
+        user = User.objects.create_user('prefs', password='x')
+        profile = UserProfile.objects.create(user=user, theme='light')
+        self.assertEqual(get_preferences(user)['theme'], 'light')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            profile.theme = 'dark'
+            profile.save()
+            # Not yet committed: the cached value is still served
+            self.assertEqual(get_preferences(user)['theme'], 'light')
+
+        self.assertEqual(get_preferences(user)['theme'], 'dark')
+
+    @override_settings(ALLOWED_HOSTS=['testserver'])
+    def test_language_prefix_in_the_url_wins_over_the_profile(self):
+        user = User.objects.create_user('arabic', password='x')
+        profile = UserProfile.objects.create(user=user, language='ar')
+        self.client.force_login(user)
+
+        response = self.client.get('/en/')
+        self.assertEqual((response.status_code, response.wsgi_request.LANGUAGE_CODE), (200, 'en'))
+        # No prefix: the profile language picks where / goes
+        self.assertRedirects(self.client.get('/'), '/ar/', fetch_redirect_response=False)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            profile.language = 'en'
+            profile.save()
+        response = self.client.get('/ar/')
+        self.assertEqual((response.status_code, response.wsgi_request.LANGUAGE_CODE), (200, 'ar'))
+
+
+@override_settings(**LOCAL_SERVICES)
+class AvatarVariantTests(TestCase):
+    """
+    Avatar uploads are capped, and their content-hashed thumbnails are
+    rendered in WebP plus a fallback and served as immutable
+    """
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media_root.cleanup)
+        media = self.settings(MEDIA_ROOT=self.media_root.name, ALLOWED_HOSTS=['testserver'])
+        media.enable()
+        self.addCleanup(media.disable)
+        self.user = User.objects.create_user('pictured', password='x')
+        self.client.force_login(self.user)
+        with translation.override('en'):
+            self.edit_url = reverse('chat:edit_profile')
+
+    def image(self, mode, image_format, size=(120, 90), noise=False):
+        image = Image.frombytes(mode, size, os.urandom(size[0] * size[1] * len(mode))) if noise else Image.new(mode, size, 'red')
+        output = BytesIO()
+        image.save(output, image_format)
+        return SimpleUploadedFile(f'upload.{image_format.lower()}', output.getvalue())
+
+    def upload(self, avatar):
+        return self.client.post(self.edit_url, {'avatar': avatar, 'language': 'en', 'theme': 'auto', 'email': 'p@example.com'})
+
+    def test_variants_for_every_size_in_webp_and_fallback(self):
+        for mode, image_format, fallback in (('RGB', 'JPEG', 'JPEG'), ('RGBA', 'PNG', 'PNG')):
+            profile, _created = UserProfile.objects.get_or_create(user=self.user)
+            profile.avatar = self.image(mode, image_format)
+            profile.save()
+
+            store_variants(profile)
+
+            variants = UserProfile.objects.get(pk=profile.pk).avatar_variants
+            self.assertEqual(sorted(variants, key=int), [str(size) for size in settings.CHAT_AVATAR_SIZES])
+            for size, names in variants.items():
+                for kind, expected_format in (('webp', 'WEBP'), ('fallback', fallback)):
+                    with Image.open(os.path.join(self.media_root.name, names[kind])) as variant:
+                        self.assertEqual((variant.format, variant.size), (expected_format, (int(size), int(size))))
+
+    def test_upload_queues_variants_for_the_media_worker(self):
+        response = self.upload(self.image('RGB', 'PNG'))
+
+        self.assertEqual(response.status_code, 302)
+        profile = UserProfile.objects.get(user=self.user)
+        event = async_to_sync(get_channel_layer().receive)(MEDIA_CHANNEL)
+        self.assertEqual((event['type'], event['avatar']), ('avatar.variants', profile.avatar.name))
+
+    @override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer', 'CONFIG': {'capacity': 1}}})
+    def test_full_media_channel_serves_the_original(self):
+        async_to_sync(get_channel_layer().send)(MEDIA_CHANNEL, {'type': 'avatar.variants', 'profile_id': 0, 'avatar': ''})
+
+        with self.assertLogs('chat.views', 'WARNING'):
+            response = self.upload(self.image('RGB', 'PNG'))
+
+        self.assertEqual(response.status_code, 302)
+        sources = UserProfile.objects.get(user=self.user).avatar_sources()
+        self.assertEqual(sources['variants'], {})
+        self.assertTrue(sources['url'].endswith('.png'))
+
+    @override_settings(CHAT_AVATAR_MAX_UPLOAD_SIZE=1024 * 1024)
+    def test_oversized_upload_is_a_form_error(self):
+        response = self.upload(self.image('RGB', 'BMP', size=(700, 700), noise=True))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('at most 1 MB', str(response.context['form'].errors['avatar']))
+        self.assertFalse(UserProfile.objects.get(user=self.user).avatar)
+
+    def test_variant_is_cached_for_a_year(self):
+        variant_dir = os.path.join(self.media_root.name, 'avatars', 'variants')
+        os.makedirs(variant_dir)
+        with open(os.path.join(variant_dir, 'abc-32.webp'), 'wb') as f:
+            f.write(b'RIFF')
+        response = self.client.get('/media/avatars/variants/abc-32.webp')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+        self.assertEqual(self.client.get('/media/avatars/variants/missing.webp').status_code, 404)
+
+
+@override_settings(**LOCAL_SERVICES, CHAT_REPLAY_BUFFER_SIZE=5)
+class ReplayResumeTests(TestCase):
+    """
+    A reconnecting socket gets the messages after its cursor, from the
+    replay buffer or, once that no longer covers the gap, the database
+    """
+    def setUp(self):
+        replay._buffer = None
+        self.user = User.objects.create_user('resumer', password='x')
+        self.room = ChatRoom.objects.create(name='Quiet room', creator=self.user)
+        start = timezone.now() - timedelta(hours=2)
+        self.messages = [
+            Message.objects.create(room=self.room, sender=self.user, content=f'missed {i}', timestamp=start + timedelta(minutes=i))
+            for i in range(8)
+        ]
+
+    def test_expired_buffer_falls_back_to_database(self):
+        frames, complete = missed_frames(self.room.id, self.messages[4].cursor)
+        self.assertTrue(complete)
+        self.assertEqual([json.loads(text)['content'] for text in frames], ['missed 5', 'missed 6', 'missed 7'])
+
+    def test_gap_larger_than_the_cap_reloads(self):
+        frames, complete = missed_frames(self.room.id, self.messages[0].cursor)
+        self.assertFalse(complete)
+        self.assertEqual(frames, [])
+
+    def test_http_messages_are_replayed(self):
+        request = RequestFactory().post('/', json.dumps({'content': 'over http'}), content_type='application/json')
+        request.user = self.user
+        self.assertEqual(send_message(request, self.room.id).status_code, 200)
+
+        frames, _complete = get_replay_buffer().since(self.room.id, None)
+        self.assertEqual([json.loads(text)['content'] for text in frames], ['over http'])
+
+
+@override_settings(**LOCAL_SERVICES)
+class MessageBatcherTests(TestCase):
+    """
+    Write-behind batches drain even when a row cannot be written
+    """
+    def setUp(self):
+        self.user = User.objects.create_user('batched', password='x')
+        self.room = ChatRoom.objects.create(name='Write-behind', creator=self.user)
+        self.stored = Message.objects.create(room=self.room, sender=self.user, content='already stored')
+
+    def messages(self, *contents):
+        return [Message(room_id=self.room.id, sender=self.user, content=content) for content in contents]
+
+    def duplicate(self):
+        # Same primary key as a stored row, so its batch fails
+        return Message(id=self.stored.id, room_id=self.room.id, sender=self.user, content='duplicate')
+
+    def test_failing_batch_is_salvaged_after_retries(self):
+        batcher = MessageBatcher(batch_size=10, flush_interval=0.001, max_backoff=0.001, max_retries=2)
+
+        async def run():
+            for message in [self.duplicate(), *self.messages('first', 'second')]:
+                batcher.add(message)
+            for _ in range(200):
+                if not batcher.pending:
+                    break
+                await asyncio.sleep(0.005)
+            await batcher.close()
+
+        with self.assertLogs('chat.persistence.dead_letter') as logs, self.assertLogs('chat.persistence', 'ERROR'):
+            async_to_sync(run)()
+        self.assertEqual(batcher.pending, [])
+        self.assertEqual((batcher.written, batcher.dead_lettered), (2, 1))
+        self.assertEqual(json.loads(logs.records[0].getMessage())['content'], 'duplicate')
+        self.assertEqual(Message.objects.filter(room=self.room).count(), 3)
+
+    def test_idle_batcher_does_not_poll(self):
+        flushes = []
+
+        class CountingBatcher(MessageBatcher):
+            async def flush(self):
+                flushes.append(len(self.pending))
+                await super().flush()
+
+        batcher = CountingBatcher(flush_interval=0.005)
+
+        async def run():
+            batcher.add(self.messages('only')[0])
+            await asyncio.sleep(0.1)
+            await batcher.close()
+
+        async_to_sync(run)()
+        self.assertEqual(flushes, [1])
+        self.assertEqual(batcher.written, 1)
+
+    def test_shutdown_flush_keeps_writing_after_a_failure(self):
+        batcher = MessageBatcher(batch_size=2)
+        batcher.pending = [self.duplicate(), *self.messages('first', 'second', 'third')]
+
+        with self.assertLogs('chat.persistence', 'ERROR'):
+            batcher.flush_sync()
+        self.assertEqual((batcher.written, batcher.dead_lettered), (3, 1))
+        self.assertEqual(Message.objects.filter(room=self.room).count(), 4)
+
+
+@override_settings(**LOCAL_SERVICES, ALLOWED_HOSTS=['testserver'], CHAT_METRICS_TOKEN='scrape-secret')
+class MetricsAccessTests(TestCase):
+    """
+    /metrics/ needs staff or the scrape token, whatever the peer address
+    """
+    def test_loopback_peer_is_not_enough(self):
+        self.assertEqual(self.client.get('/metrics/', REMOTE_ADDR='127.0.0.1').status_code, 403)
+        self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+
+    def test_scrape_token(self):
+        response = self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer scrape-secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+
+
+@override_settings(**LOCAL_SERVICES)
+class UserSearchTests(TestCase):
+    """
+    Autocomplete matches word starts, contacts first
+    """
+    def setUp(self):
+        cache.clear()
+        self.viewer = User.objects.create_user('viewer', password='x')
+        self.stranger = User.objects.create_user('sam_stranger', password='x', first_name='Sam')
+        self.contact = User.objects.create_user('samira', password='x', first_name='Samira', last_name='Haddad')
+        room = ChatRoom.objects.create(name='Team', creator=self.viewer)
+        room.participants.add(self.viewer, self.contact)
+
+    def test_only_word_starts_are_indexed(self):
+        terms = set(UserSearchTerm.objects.filter(user=self.stranger).values_list('term', flat=True))
+        self.assertEqual(terms, {'sam_stranger', 'stranger', 'sam'})
+
+    def test_contacts_rank_first(self):
+        self.assertEqual(search_users('sam', self.viewer), [self.contact, self.stranger])
+        self.assertEqual(search_users('strang', self.viewer), [self.stranger])
+        self.assertEqual(search_users('tranger', self.viewer), [])
+
+    def test_long_full_name_fits_the_column(self):
+        user = User.objects.create_user('long', password='x', first_name='a' * 150, last_name='b' * 150)
+        self.assertEqual(search_users('a' * 150 + ' b', self.viewer), [user])
+
+
+@override_settings(**LOCAL_SERVICES)
+class MessageSearchTests(TestCase):
+    """
+    Search matches normalized text but shows the message as written
+    """
+    def setUp(self):
+        self.user = User.objects.create_user('searcher', password='x')
+        self.room = ChatRoom.objects.create(name='Search', creator=self.user)
+
+    def test_snippet_keeps_original_spelling(self):
+        Message.objects.create(room=self.room, sender=self.user, content='مرحبا يا أَحْمَد كيف الحال')
+
+        results, _has_more = search_messages(self.room.id, 'احمد')
+
+        self.assertEqual(len(results), 1)
+        self.assertIn('<mark>أَحْمَد</mark>', results[0]['snippet'])
+
+    def test_long_message_snippet_is_cut_around_the_match(self):
+        words = [f'word{i}' for i in range(40)]
+        words[30] = 'needle'
+        Message.objects.create(room=self.room, sender=self.user, content=' '.join(words))
+
+        snippet = search_messages(self.room.id, 'needle')[0][0]['snippet']
+
+        self.assertTrue(snippet.startswith('…word24 '))
+        self.assertIn('<mark>needle</mark>', snippet)
+        self.assertEqual(len(snippet.split()), 16)
+
+    def test_markup_is_escaped(self):
+        Message.objects.create(room=self.room, sender=self.user, content='<b>bold</b> claim')
+        self.assertEqual(search_messages(self.room.id, 'claim')[0][0]['snippet'], '&lt;b&gt;bold&lt;/b&gt; <mark>claim</mark>')
+
+
+@override_settings(**LOCAL_SERVICES)
+class TypingCoalescerTests(TestCase):
+    """
+    A typist who starts while the "nobody is typing" frame is being sent
+    is still broadcast, and only room members are counted as typing
+    """
+    def typists_after_typing(self, user, room):
+        async def run():
+            communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{room.id}/')
+            communicator.scope['user'] = user
+            communicator.scope['url_route'] = {'kwargs': {'room_id': str(room.id)}}
+            connected, _subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.send_to(text_data=json.dumps({'type': 'typing', 'is_typing': True}))
+            await communicator.receive_nothing(timeout=0.05)
+            typists = dict(get_typing_coalescer().rooms.get(f'chat_{room.id}', {}))
+            await communicator.disconnect()
+            return typists
+
+        return async_to_sync(run)()
+
+    def test_only_members_are_counted_as_typing(self):
+        member = User.objects.create_user('member', password='x')
+        visitor = User.objects.create_user('visitor', password='x')
+        room = ChatRoom.objects.create(name='Public', creator=member)
+
+        self.assertEqual(self.typists_after_typing(AnonymousUser(), room), {})
+        self.assertEqual(self.typists_after_typing(visitor, room), {})
+        self.assertEqual(list(self.typists_after_typing(member, room)), [member.id])
+
+    def test_typist_during_final_send_is_not_lost(self):
+        coalescer = TypingCoalescer(interval=0.001)
+        frames = []
+
+        class ChannelLayer:
+            async def group_send(self, group, message):
+                frames.append(json.loads(message['text'])['count'])
+                if frames == [1, 0]:
+                    # Someone starts typing while the empty frame is in flight
+                    await asyncio.sleep(0)
+                    coalescer.update(self, group, 2, 'second', True)
+
+        async def run():
+            layer = ChannelLayer()
+            coalescer.update(layer, 'chat_room', 1, 'first', True)
+            await asyncio.sleep(0.01)
+            coalescer.update(layer, 'chat_room', 1, 'first', False)
+            for _ in range(100):
+                await asyncio.sleep(0.005)
+                if frames[-1:] == [1] and len(frames) > 2:
+                    break
+            coalescer.update(layer, 'chat_room', 2, 'second', False)
+            while coalescer.flushers:
+                await asyncio.sleep(0.005)
+
+        async_to_sync(run)()
+        self.assertEqual(frames, [1, 0, 1, 0])
+
+
+@override_settings(
+    **dict(LOCAL_SERVICES, CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer', 'CONFIG': {'capacity': 1}}}),
+    CHAT_NOTIFICATION_FANOUT_THRESHOLD=0,
+)
+class NotificationFanoutTests(TestCase):
+    """
+    A full notification channel does not fail the message send
+    """
+    def test_full_channel_falls_back_to_inline_fanout(self):
+        sender = User.objects.create_user('poster', password='x')
+        reader = User.objects.create_user('reader', password='x')
+        room = ChatRoom.objects.create(name='Crowded', creator=sender)
+        room.participants.add(sender, reader)
+        # Fill the channel, as a backlog would with the worker stopped
+        async_to_sync(get_channel_layer().send)(NOTIFICATION_CHANNEL, {'type': 'notification.fanout', 'message_id': 'queued'})
+
+        request = RequestFactory().post('/', json.dumps({'content': 'hello'}), content_type='application/json')
+        request.user = sender
+        with self.assertLogs('chat.views', 'WARNING'):
+            response = send_message(request, room.id)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(Notification.objects.filter(user=reader).exists())
+
+
+@override_settings(**LOCAL_SERVICES)
+class RosterTests(TestCase):
+    """
+    Roster pages list online members first and only count this room's
+    """
+    def test_online_members_first(self):
+        creator = User.objects.create_user('creator', password='x')
+        online = User.objects.create_user('zoe', password='x')
+        offline = User.objects.create_user('adam', password='x')
+        outsider = User.objects.create_user('outsider', password='x')
+        room = ChatRoom.objects.create(name='Roster', creator=creator)
+        room.participants.add(online, offline)
+        presence = get_presence_store()
+        presence.connect(online.id, 'socket-1')
+        presence.connect(outsider.id, 'socket-2')
+        try:
+            entries, next_cursor, member_count, online_count = roster_page(room.id, limit=1)
+            self.assertEqual(([entry['username'] for entry in entries], member_count, online_count), (['zoe'], 2, 1))
+            entries, next_cursor, _member_count, _online_count = roster_page(room.id, after=next_cursor, limit=1)
+            self.assertEqual(([entry['username'] for entry in entries], next_cursor), (['adam'], None))
+        finally:
+            presence.disconnect(online.id, 'socket-1')
+            presence.disconnect(outsider.id, 'socket-2')
+
+    @override_settings(ALLOWED_HOSTS=['testserver'])
+    def test_online_users_are_limited_to_contacts(self):
+        cache.clear()
+        viewer = User.objects.create_user('viewer', password='x')
+        contact = User.objects.create_user('contact', password='x')
+        stranger = User.objects.create_user('stranger', password='x')
+        for user in (contact, stranger):
+            UserProfile.objects.create(user=user)
+        room = ChatRoom.objects.create(name='Contacts', creator=viewer)
+        room.participants.add(viewer, contact)
+        presence = get_presence_store()
+        presence.connect(contact.id, 'socket-1')
+        presence.connect(stranger.id, 'socket-2')
+        self.client.force_login(viewer)
+        try:
+            with translation.override('en'):
+                response = self.client.get(reverse('chat:get_online_users'))
+            self.assertEqual([user['username'] for user in response.json()['online_users']], ['contact'])
+        finally:
+            presence.disconnect(contact.id, 'socket-1')
+            presence.disconnect(stranger.id, 'socket-2')
+
+
+@override_settings(**LOCAL_SERVICES, ALLOWED_HOSTS=['testserver'])
+class PageRenderTests(TestCase):
+    """
+    The main pages render with their templates and URL names in place
+    """
+    def test_index_and_room_detail(self):
+        user = User.objects.create_user('reader', password='x')
+        room = ChatRoom.objects.create(name='Lobby', creator=user)
+        room.participants.add(user)
+        Message.objects.create(room=room, sender=user, content='hello')
+        self.client.force_login(user)
+        with translation.override('en'):
+            index_url, room_url = reverse('chat:index'), reverse('chat:room_detail', args=[room.id])
+        self.assertEqual(self.client.get(index_url).status_code, 200)
+        self.assertContains(self.client.get(room_url), 'hello')
+
+
+@override_settings(**LOCAL_SERVICES)
+class InboxFanoutTests(TestCase):
+    """
+    Chat messages reach inbox_<room> groups only while the multiplexed
+    endpoint is enabled
+    """
+    def inbox_frames(self):
+        user = User.objects.create_user('poster', password='x')
+        room = ChatRoom.objects.create(name='Inbox', creator=user)
+        room.participants.add(user)
+
+        async def run():
+            layer = get_channel_layer()
+            inbox = await layer.new_channel()
+            await layer.group_add(f'inbox_{room.id}', inbox)
+            communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{room.id}/')
+            communicator.scope['user'] = user
+            communicator.scope['url_route'] = {'kwargs': {'room_id': str(room.id)}}
+            connected, _subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.send_to(text_data=json.dumps({'type': 'chat_message', 'content': 'hi'}))
+            while json.loads(await communicator.receive_from())['type'] != 'chat_message':
+                pass
+            await communicator.disconnect()
+            frames = []
+            while True:
+                try:
+                    frames.append((await asyncio.wait_for(layer.receive(inbox), 0.05))['type'])
+                except asyncio.TimeoutError:
+                    return frames
+
+        return async_to_sync(run)()
+
+    def test_no_inbox_fanout_by_default(self):
+        self.assertEqual(self.inbox_frames(), [])
+
+    @override_settings(CHAT_MULTIPLEX=True)
+    def test_inbox_fanout_when_enabled(self):
+        self.assertEqual(self.inbox_frames(), ['room_activity'])
+
+
+class SlowConsumerTests(TestCase):
+    """
+    Slow-consumer policies engage when the socket, not send(), is the
+    bottleneck
+    """
+    def test_slow_send_sheds_ephemeral_frames_then_resyncs(self):
+        sent = []
+
+        async def slow_send(text):
+            await asyncio.sleep(0.01)
+            sent.append(text)
+
+        async def run():
+            queue = OutboundQueue(slow_send, capacity=6, ephemeral_ratio=0.5, max_resyncs=1)
+            queue.start()
+            outcomes = []
+            # Events arrive several times faster than the socket takes them
+            for i in range(30):
+                outcomes.append(queue.put('chat_message', f'm{i}'))
+                outcomes.append(queue.put('typing_indicator', f't{i}'))
+                await asyncio.sleep(0.002)
+            await queue.stop()
+            return outcomes
+
+        outcomes = async_to_sync(run)()
+        self.assertEqual(outcomes[:2], [QUEUED, QUEUED])
+        self.assertLess(outcomes.index(DROPPED), outcomes.index(RESYNC))
+        self.assertLess(outcomes.index(RESYNC), outcomes.index(DISCONNECT))
+        self.assertIn(RESYNC_FRAME, sent)
+
+    @override_settings(**LOCAL_SERVICES, ALLOWED_HOSTS=['testserver'])
+    def test_paused_transport_holds_frames_behind_auth_middleware(self):
+        class Transport:
+            producer = None
+
+            def registerProducer(self, producer, streaming):
+                self.producer = producer
+
+            def unregisterProducer(self):
+                self.producer = None
+
+        user = User.objects.create_user('slow', password='x')
+        room = ChatRoom.objects.create(name='Slow', creator=user)
+        room.participants.add(user)
+        self.client.force_login(user)
+        cookie = f'{settings.SESSION_COOKIE_NAME}={self.client.cookies[settings.SESSION_COOKIE_NAME].value}'
+        transport = Transport()
+
+        async def run():
+            # The same stack as config.asgi; SessionMiddleware rewraps send()
+            application = AuthMiddlewareStack(URLRouter(websocket_urlpatterns))
+            communicator = WebsocketCommunicator(application, f'/ws/chat/{room.id}/', headers=[(b'cookie', cookie.encode())])
+            # What ChatServer adds to the scope under Daphne
+            communicator.scope['extensions'] = {TRANSPORT_EXTENSION: {'transport': transport}}
+            connected, _subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+            while json.loads(await communicator.receive_from())['type'] != 'user_join':
+                pass
+            # Twisted's write buffer is over its bufferSize
+            transport.producer.pauseProducing()
+            await communicator.send_to(text_data=json.dumps({'type': 'chat_message', 'content': 'held'}))
+            held = await communicator.receive_nothing(timeout=0.1)
+            transport.producer.resumeProducing()
+            released = json.loads(await communicator.receive_from())
+            await communicator.disconnect()
+            return held, released
+
+        held, released = async_to_sync(run)()
+        self.assertTrue(held)
+        self.assertEqual((released['type'], released['content']), ('chat_message', 'held'))
+        self.assertIsNone(transport.producer)
+
+    def test_chat_server_passes_the_transport_in_the_scope(self):
+        scopes = []
+
+        async def application(scope, receive, send):
+            scopes.append(scope)
+
+        class Protocol:
+            transport = object()
+
+        async def run():
+            server = ChatServer(application, endpoints=['tcp:port=0'])
+            protocol = Protocol()
+            server.connections = {protocol: {}}
+            server.create_application(protocol, {'type': 'websocket'})
+            await server.connections[protocol]['application_instance']
+
+        async_to_sync(run)()
+        self.assertIs(scopes[0]['extensions'][TRANSPORT_EXTENSION]['transport'], Protocol.transport)
+        self.assertIsNone(transport_writable({}))
+
+
+@override_settings(**LOCAL_SERVICES)
+class ReadReceiptTests(TestCase):
+    """
+    Read cursors are coalesced per (user, room), only move forward, and
+    recount what is still unread
+    """
+    def setUp(self):
+        self.reader = User.objects.create_user('reader', password='x')
+        self.writer = User.objects.create_user('writer', password='x')
+        self.room = ChatRoom.objects.create(name='Receipts', creator=self.writer)
+        self.room.participants.add(self.reader, self.writer)
+        other_room = ChatRoom.objects.create(name='Elsewhere', creator=self.writer)
+        start = timezone.now() - timedelta(minutes=10)
+        self.messages = [
+            Message.objects.create(room=self.room, sender=self.writer, content=f'm{i}', timestamp=start + timedelta(minutes=i))
+            for i in range(4)
+        ]
+        self.foreign = Message.objects.create(room=other_room, sender=self.writer, content='elsewhere')
+
+    def state(self):
+        return RoomReadState.objects.get(user=self.reader, room=self.room)
+
+    def test_messages_count_as_unread_for_others(self):
+        self.assertEqual(self.state().unread_count, 4)
+        self.assertEqual(RoomReadState.objects.get(user=self.writer, room=self.room).unread_count, 0)
+
+    def test_burst_is_written_once_with_the_newest_cursor(self):
+        buffer = ReadReceiptBuffer(interval=0.001)
+        frames = []
+
+        class ChannelLayer:
+            async def group_send(self, group, message):
+                frames.append((group, json.loads(message['text'])))
+
+        async def run():
+            layer = ChannelLayer()
+            for message in self.messages[:3]:
+                # Client timestamps are ignored in favour of the stored ones
+                buffer.update(layer, 'chat_room', self.room.id, self.reader.id, message.timestamp, message.id)
+            buffer.update(layer, 'chat_room', self.room.id, self.writer.id, timezone.now(), self.foreign.id)
+            while buffer.flusher is not None and not buffer.flusher.done():
+                await asyncio.sleep(0.005)
+
+        async_to_sync(run)()
+        self.assertEqual(len(frames), 1)
+        group, frame = frames[0]
+        self.assertEqual((group, frame['type']), ('chat_room', 'read'))
+        self.assertEqual([cursor['message_id'] for cursor in frame['cursors']], [str(self.messages[2].id)])
+        state = self.state()
+        self.assertEqual((state.last_read_message_id, state.unread_count), (self.messages[2].id, 1))
+
+    def test_stale_cursor_is_not_broadcast(self):
+        RoomReadState.objects.advance(self.reader.id, self.room.id, self.messages[3].id, self.messages[3].timestamp)
+        buffer = ReadReceiptBuffer(interval=0.001)
+        pending = {('chat_room', str(self.room.id)): {self.reader.id: (self.messages[1].timestamp, self.messages[1].id)}}
+
+        self.assertEqual(buffer.write(pending), {})
+
+    def test_cursor_never_moves_backwards(self):
+        RoomReadState.objects.advance(self.reader.id, self.room.id, self.messages[3].id, self.messages[3].timestamp)
+        moved = RoomReadState.objects.advance(self.reader.id, self.room.id, self.messages[1].id, self.messages[1].timestamp)
+
+        self.assertEqual(moved, 0)
+        state = self.state()
+        self.assertEqual((state.last_read_message_id, state.unread_count), (self.messages[3].id, 0))
+
+
+@override_settings(**LOCAL_SERVICES, ALLOWED_HOSTS=['testserver'])
+class AdminKeysetTests(TestCase):
+    """
+    The message changelist pages with keyset "older" links
+    """
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'x')
+        room = ChatRoom.objects.create(name='Admin', creator=self.admin)
+        start = timezone.now() - timedelta(hours=1)
+        self.messages = Message.objects.bulk_create(
+            Message(room=room, sender=self.admin, content=f'm{i}', timestamp=start + timedelta(seconds=i))
+            for i in range(MessageAdmin.list_per_page + 5)
+        )
+        self.client.force_login(self.admin)
+        self.url = reverse('admin:chat_message_changelist')
+
+    def test_older_link_continues_after_the_last_row(self):
+        first = self.client.get(self.url)
+        changelist = first.context['cl']
+        self.assertEqual(len(changelist.result_list), MessageAdmin.list_per_page)
+        self.assertIsNone(changelist.newest_url)
+        self.assertContains(first, 'Older')
+
+        older = self.client.get(self.url + changelist.older_url).context['cl']
+        self.assertEqual([message.content for message in older.result_list], [f'm{i}' for i in range(4, -1, -1)])
+        self.assertIsNone(older.older_url)
+        self.assertIsNotNone(older.newest_url)
+
+    def test_malformed_key_is_rejected(self):
+        response = self.client.get(self.url, {'before': 'not-a-cursor'})
+        self.assertRedirects(response, self.url + '?e=1', fetch_redirect_response=False)
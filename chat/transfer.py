@@ -0,0 +1,264 @@
+import csv
+import json
+import uuid
+from datetime import datetime
+from itertools import islice
+from channels.db import database_sync_to_async
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+from .models import ArchivedMessage, Message
+from .search import get_search_backend
+
+FORMATS = ('ndjson', 'csv')
+CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+    'csv': 'text/csv; charset=utf-8',
+}
+# Fields of an exported message: NDJSON keys and CSV columns, in order
+FIELDS = ('id', 'timestamp', 'sender', 'content', 'parent_id')
+
+
+# Exports read archived messages, then hot ones, each oldest first. Parents
+# kept hot for their replies may follow those replies.
+EXPORT_MODELS = (ArchivedMessage, Message)
+
+
+def history_batch(model, room_id, after=None, limit=2000):
+    """
+    Up to `limit` of the room's messages in `model` after the keyset cursor
+    `after`, oldest first, as tuples in FIELDS order
+    """
+    queryset = model.objects.filter(room_id=room_id)
+    if after:
+        queryset = queryset.after(after)
+    return list(queryset.order_by('timestamp', 'id').values_list(
+        'id', 'timestamp', 'sender__username', 'content', 'parent_message_id'
+    )[:limit])
+
+
+def row_cursor(row):
+    return f'{row[1].isoformat()}_{row[0]}'
+
+
+def export_record(row):
+    message_id, timestamp, sender, content, parent_id = row
+    return {
+        'id': str(message_id),
+        'timestamp': timestamp.isoformat(),
+        'sender': sender,
+        'content': content,
+        'parent_id': str(parent_id) if parent_id else None,
+    }
+
+
+class EchoBuffer:
+    """
+    File-like object handing csv.writer's output back to the caller
+    """
+    def write(self, value):
+        return value
+
+
+def chunk_encoder(format):
+    """
+    Return (header, encode) for `format`: the text that starts an export and
+    a function turning a batch of rows into text
+    """
+    if format == 'csv':
+        writer = csv.writer(EchoBuffer())
+        return writer.writerow(FIELDS), lambda rows: ''.join(writer.writerow(export_record(row).values()) for row in rows)
+    return '', lambda rows: ''.join(json.dumps(export_record(row), ensure_ascii=False) + '\n' for row in rows)
+
+
+def export_chunks(room_id, format='ndjson', chunk_size=2000):
+    """
+    Yield the room's history in `format`, one string per keyset batch of up
+    to `chunk_size` messages, so memory stays constant whatever the room's
+    size
+    """
+    header, encode = chunk_encoder(format)
+    if header:
+        yield header
+    for model in EXPORT_MODELS:
+        after = None
+        while rows := history_batch(model, room_id, after, chunk_size):
+            yield encode(rows)
+            after = row_cursor(rows[-1])
+
+
+async def aexport_chunks(room_id, format='ndjson', chunk_size=2000):
+    """
+    export_chunks() for StreamingHttpResponse under ASGI, which would read a
+    synchronous iterator to the end before sending anything
+    """
+    header, encode = chunk_encoder(format)
+    if header:
+        yield header
+    read_batch = database_sync_to_async(history_batch)
+    for model in EXPORT_MODELS:
+        after = None
+        while rows := await read_batch(model, room_id, after, chunk_size):
+            yield encode(rows)
+            after = row_cursor(rows[-1])
+
+
+def read_records(lines, format='ndjson'):
+    """
+    Parse an export (an iterable of text lines, e.g. an open file) lazily
+    into record dicts
+    """
+    if format == 'csv':
+        return csv.DictReader(lines)
+    return (json.loads(line) for line in lines if line.strip())
+
+
+def parse_timestamp(value):
+    timestamp = datetime.fromisoformat(value)
+    if timezone.is_naive(timestamp):
+        timestamp = timezone.make_aware(timestamp)
+    return timestamp
+
+
+def import_id(room_id, source_id):
+    """
+    Message id for an imported record: UUIDs (our own exports) are kept,
+    ids from other systems map to a stable UUID within the room, so
+    parent links resolve without an id table and re-imports are idempotent
+    """
+    try:
+        return uuid.UUID(str(source_id))
+    except ValueError:
+        return uuid.uuid5(room_id, str(source_id))
+
+
+class HistoryImporter:
+    """
+    Bulk import of export records into a room's Message table, one
+    transaction and one bulk_create per `batch_size` records.
+
+    Ids, timestamps and parent links are preserved. A parent that is neither
+    in the batch nor already stored is linked after the whole import, so
+    only those forward references are held in memory. Records whose id is
+    already stored, hot or archived, are never written or re-indexed: they
+    count as `skipped` when the row belongs to this room (a re-import) and
+    as `conflicts` when it belongs to another room (e.g. an export imported
+    into a different room). Senders are matched by username; unknown ones raise
+    ValueError unless `create_users`, which adds them as inactive users
+    without a password. Imported messages are indexed for search but not
+    counted as unread.
+    """
+    def __init__(self, room, batch_size=1000, create_users=False):
+        self.room = room
+        self.batch_size = batch_size
+        self.create_users = create_users
+        self.user_ids = {}
+        self.pending_parents = {}
+        self.written = 0
+        self.skipped = 0
+        self.conflicts = 0
+        self.unlinked = 0
+
+    def run(self, records):
+        """
+        Import every record; returns the number of messages written
+        """
+        records = iter(records)
+        while batch := list(islice(records, self.batch_size)):
+            self.write(batch)
+        self.link_pending_parents()
+        if self.user_ids:
+            self.room.participants.add(*self.user_ids.values())
+        return self.written
+
+    def sender_ids(self, usernames):
+        missing = set(usernames) - self.user_ids.keys()
+        if missing:
+            self.user_ids.update(User.objects.filter(username__in=missing).values_list('username', 'id'))
+            unknown = missing - self.user_ids.keys()
+            if unknown and not self.create_users:
+                raise ValueError(f'unknown senders: {", ".join(sorted(unknown))}')
+            for username in unknown:
+                # One by one so post_save still creates the profile
+                user = User.objects.create(username=username, is_active=False, password=make_password(None))
+                self.user_ids[username] = user.id
+        return self.user_ids
+
+    def stored_rooms(self, message_ids):
+        """
+        Room of each of `message_ids` already stored in either table
+        """
+        rooms = dict(Message.objects.filter(id__in=message_ids).values_list('id', 'room_id'))
+        rooms.update(ArchivedMessage.objects.filter(id__in=message_ids).values_list('id', 'room_id'))
+        return rooms
+
+    def new_messages(self, messages):
+        stored = self.stored_rooms([message.id for message in messages])
+        fresh = {}
+        for message in messages:
+            room_id = stored.get(message.id)
+            if room_id is None and message.id not in fresh:
+                fresh[message.id] = message
+            elif room_id is None or room_id == self.room.id:
+                self.skipped += 1
+            else:
+                self.conflicts += 1
+        return list(fresh.values())
+
+    def write(self, records):
+        senders = self.sender_ids(record['sender'] for record in records)
+        messages = self.new_messages([
+            Message(
+                id=import_id(self.room.id, record['id']),
+                room_id=self.room.id,
+                sender_id=senders[record['sender']],
+                content=record['content'],
+                timestamp=parse_timestamp(record['timestamp']),
+                parent_message_id=import_id(self.room.id, record['parent_id']) if record.get('parent_id') else None,
+            )
+            for record in records
+        ])
+        if not messages:
+            return
+        batch_ids = {message.id for message in messages}
+        parent_ids = {message.parent_message_id for message in messages if message.parent_message_id} - batch_ids
+        known = set(
+            Message.objects.filter(id__in=parent_ids, room_id=self.room.id).values_list('id', flat=True)
+        ) if parent_ids else set()
+        for message in messages:
+            if message.parent_message_id in parent_ids and message.parent_message_id not in known:
+                self.pending_parents[message.id] = message.parent_message_id
+                message.parent_message_id = None
+
+        # bulk_create skips post_save, so index the batch explicitly. No
+        # ignore_conflicts: every row was checked above, and a row inserted
+        # concurrently fails the batch instead of being re-indexed here.
+        with transaction.atomic():
+            Message.objects.bulk_create(messages)
+            get_search_backend().index(messages)
+        self.written += len(messages)
+
+    def link_pending_parents(self):
+        children = {}
+        for child_id, parent_id in self.pending_parents.items():
+            children.setdefault(parent_id, []).append(child_id)
+        parent_ids = list(children)
+        for start in range(0, len(parent_ids), self.batch_size):
+            chunk = parent_ids[start:start + self.batch_size]
+            for parent_id in Message.objects.filter(id__in=chunk, room_id=self.room.id).values_list('id', flat=True):
+                Message.objects.filter(id__in=children.pop(parent_id)).update(parent_message_id=parent_id)
+        # Parents that never arrived (or live in the archive) stay unlinked
+        self.unlinked = sum(len(ids) for ids in children.values())
+        self.pending_parents = {}
+
+
+def import_history(room, records, batch_size=1000, create_users=False):
+    """
+    Import export records into `room`; returns the HistoryImporter, which
+    holds the number of messages `written`, `skipped` and in `conflicts`,
+    and of `unlinked` replies
+    """
+    importer = HistoryImporter(room, batch_size=batch_size, create_users=create_users)
+    importer.run(records)
+    return importer
@@ -0,0 +1,101 @@
+import asyncio
+import time
+import uuid
+from django.conf import settings
+from .encoding import encode_frame
+from .metrics import group_send
+
+
+class TypingCoalescer:
+    """
+    Aggregates typing state per room so a room receives at most one
+    "who is typing" frame per `interval` instead of one per keystroke.
+
+    State is per worker process; every frame carries `source` so clients
+    can merge the lists sent by different workers.
+    """
+    def __init__(self, interval=0.5, max_typists=5, timeout=5.0):
+        self.interval = interval
+        self.max_typists = max_typists
+        self.timeout = timeout
+        self.source = uuid.uuid4().hex
+        self.rooms = {}
+        self.flushers = {}
+
+    def update(self, channel_layer, group_name, user_id, username, is_typing):
+        """
+        Record a typing frame; returns False when it changed nothing
+        (e.g. a repeated is_typing=true) and no broadcast will follow
+        """
+        typists = self.rooms.setdefault(group_name, {})
+        if is_typing:
+            changed = user_id not in typists
+            typists[user_id] = (username, time.monotonic() + self.timeout)
+        else:
+            changed = typists.pop(user_id, None) is not None
+        if not typists:
+            self.rooms.pop(group_name, None)
+
+        if changed:
+            self.schedule(channel_layer, group_name)
+        return changed
+
+    def schedule(self, channel_layer, group_name):
+        flusher = self.flushers.get(group_name)
+        if flusher is None or flusher.done():
+            self.flushers[group_name] = asyncio.get_running_loop().create_task(
+                self.flush_later(channel_layer, group_name)
+            )
+
+    async def flush_later(self, channel_layer, group_name):
+        sent = None
+        while True:
+            await asyncio.sleep(self.interval)
+            frame = self.snapshot(group_name)
+            if frame != sent:
+                await group_send(channel_layer, group_name, {
+                    'type': 'typing_indicator',
+                    'text': encode_frame(frame),
+                })
+                sent = frame
+            # Re-check after the await: a typist who started during the send
+            # found this flusher still running and scheduled no other
+            if not frame['count'] and not self.rooms.get(group_name):
+                break
+        self.flushers.pop(group_name, None)
+
+    def snapshot(self, group_name):
+        # Typists who stopped without saying so drop off after `timeout`
+        now = time.monotonic()
+        typists = self.rooms.get(group_name, {})
+        for user_id, (_username, expires) in list(typists.items()):
+            if expires <= now:
+                del typists[user_id]
+        if not typists:
+            self.rooms.pop(group_name, None)
+        return {
+            'type': 'typing',
+            'source': self.source,
+            'typists': [
+                {'user_id': str(user_id), 'username': username}
+                for user_id, (username, _expires) in list(typists.items())[:self.max_typists]
+            ],
+            'count': len(typists),
+        }
+
+
+_coalescer = None
+
+
+def get_typing_coalescer():
+    """
+    Return the per-process TypingCoalescer, creating it on first use
+    """
+    global _coalescer
+    if _coalescer is None:
+        _coalescer = TypingCoalescer(
+            interval=settings.CHAT_TYPING_INTERVAL,
+            max_typists=settings.CHAT_TYPING_MAX_TYPISTS,
+            timeout=settings.CHAT_TYPING_TIMEOUT,
+        )
+    return _coalescer
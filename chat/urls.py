@@ -5,14 +5,18 @@ from . import views
 app_name = 'chat'
 
 urlpatterns = [
-    # path('', views.index, name='index'),
-    # path('room/<uuid:room_id>/', views.room_detail, name='room_detail'),
-    # path('room/create/', views.create_room, name='create_room'),
-    # path('room/<uuid:room_id>/send/', views.send_message, name='send_message'),
-    # path('profile/<str:username>/', views.user_profile, name='user_profile'),
-    # path('profile/edit/', views.edit_profile, name='edit_profile'),
-    # path('notifications/', views.notifications, name='notifications'),
-    # path('notifications/<int:notification_id>/read/', views.mark_notification_read, name='mark_notification_read'),
-    # path('api/online-users/', views.get_online_users, name='get_online_users'),
-    # path('api/search-users/', views.search_users, name='search_users'),
+    path('', views.index, name='index'),
+    path('room/<uuid:room_id>/', views.room_detail, name='room_detail'),
+    path('room/create/', views.create_room, name='create_room'),
+    path('room/<uuid:room_id>/send/', views.send_message, name='send_message'),
+    path('profile/edit/', views.edit_profile, name='edit_profile'),
+    path('profile/<str:username>/', views.user_profile, name='user_profile'),
+    path('notifications/', views.notifications, name='notifications'),
+    path('notifications/<int:notification_id>/read/', views.mark_notification_read, name='mark_notification_read'),
+    path('api/online-users/', views.get_online_users, name='get_online_users'),
+    path('api/search-users/', views.search_users, name='search_users'),
+    path('api/room/<uuid:room_id>/history/', views.message_history, name='message_history'),
+    path('api/room/<uuid:room_id>/search/', views.search_room_messages, name='search_room_messages'),
+    path('api/room/<uuid:room_id>/roster/', views.room_roster, name='room_roster'),
+    path('api/room/<uuid:room_id>/export/', views.export_room_history, name='export_room_history'),
 ]
\ No newline at end of file
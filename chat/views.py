@@ -1,42 +1,57 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
-from django.db.models import Q, Count, Max
-from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
-from django.http import JsonResponse
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
+from django.conf import settings
+from asgiref.sync import async_to_sync
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
 from django.views.decorators.http import require_POST
-from .models import ChatRoom, Message, UserProfile, Notification
-from .forms import ChatRoomForm, MessageForm, UserProfileForm
+from django.views.static import serve
+from django.utils.cache import patch_cache_control
+from .models import ChatRoom, Message, UserProfile, Notification, RoomReadState
+from .avatars import AvatarUploadHandler
+from .consumers import MEDIA_CHANNEL, NOTIFICATION_CHANNEL
+from .presence import get_presence_store
+from .access import get_room_cache
+from .search import search_messages
+from . import autocomplete
+from .archive import message_page
+from .metrics import get_registry, group_send
+from .replay import get_replay_buffer, message_frame
+from .roster import roster_page
+from . import transfer
+from .forms import ChatRoomForm, UserProfileForm
+import hmac
 import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+def online_contacts(user):
+    """
+    Profiles of the online users sharing a room with `user`, looked up among
+    their contacts (at most CHAT_USER_SEARCH_MAX_CONTACTS, see
+    autocomplete.contact_ids) instead of loading everyone who is online
+    """
+    online_ids = get_presence_store().online_among(autocomplete.contact_ids(user))
+    return UserProfile.objects.filter(user_id__in=online_ids).select_related('user')
 
 @login_required
 def index(request):
     """
     Home page - shows all chat rooms and recent conversations
     """
-    # Get all rooms the user is part of
-    rooms = ChatRoom.objects.filter(
-        Q(creator=request.user) | Q(participants=request.user)
-    ).distinct().order_by('-updated_at')
-    
-    # Get recent messages for preview
-    recent_messages = {}
-    for room in rooms:
-        last_message = room.messages.order_by('-timestamp').first()
-        if last_message:
-            recent_messages[room.id] = last_message
-    
-    # Get online users
-    online_users = UserProfile.objects.filter(
-        online_status=True
-    ).exclude(user=request.user).select_related('user')
+    # Get all rooms the user is part of, annotated with the last message
+    # preview and unread count (see ChatRoomQuerySet.inbox)
+    rooms = ChatRoom.objects.inbox(request.user)
     
     context = {
         'rooms': rooms,
-        'recent_messages': recent_messages,
-        'online_users': online_users,
-        'user_profile': request.user.profile if hasattr(request.user, 'profile') else None,
+        'online_users': online_contacts(request.user),
     }
     
     return render(request, 'chat/index.html', context)
@@ -49,26 +64,114 @@ def room_detail(request, room_id):
     room = get_object_or_404(ChatRoom, id=room_id)
     
     # Check if user has access to the room
-    if room.is_private and request.user not in room.participants.all() and request.user != room.creator:
+    if not get_room_cache().can_view(room.id, request.user):
         return redirect('chat:index')
     
-    messages = room.messages.all().order_by('timestamp')
+    # Only render the newest page; older history is fetched on demand
+    messages, has_more = message_page(room.id, limit=settings.CHAT_HISTORY_PAGE_SIZE)
+    
+    # Reset the unread counter and move the read cursor to the newest message
+    RoomReadState.objects.mark_read(request.user.id, room.id, messages[-1] if messages else None)
+    
+    # Other members' read cursors, for the read ticks on the rendered page
+    read_cursors = RoomReadState.objects.cursors_for(
+        room.id,
+        since=messages[0].timestamp if messages else None,
+        exclude_user_id=request.user.id
+    )
     
-    # Mark notifications as read
-    Notification.objects.filter(
-        user=request.user,
-        message__room=room,
-        is_read=False
-    ).update(is_read=True)
+    # First roster page; the rest is fetched from room_roster on demand
+    roster, roster_cursor, member_count, online_count = roster_page(room.id, limit=settings.CHAT_ROSTER_PAGE_SIZE)
     
     context = {
         'room': room,
         'messages': messages,
-        'user_profile': request.user.profile if hasattr(request.user, 'profile') else None,
+        'has_more_messages': has_more,
+        'oldest_cursor': messages[0].cursor if messages else '',
+        'newest_cursor': messages[-1].cursor if messages else '',
+        'read_cursors': {str(user_id): timestamp.isoformat() for user_id, timestamp in read_cursors.items()},
+        'roster': roster,
+        'roster_cursor': roster_cursor or '',
+        'member_count': member_count,
+        'online_count': online_count,
     }
     
     return render(request, 'chat/room.html', context)
 
+@login_required
+def room_roster(request, room_id):
+    """
+    API endpoint for a page of the room's participants, online members first
+    """
+    if not get_room_cache().can_view(room_id, request.user):
+        return JsonResponse({'error': _('Access denied')}, status=403)
+    
+    try:
+        limit = min(int(request.GET.get('limit', settings.CHAT_ROSTER_PAGE_SIZE)), settings.CHAT_ROSTER_MAX_PAGE_SIZE)
+        members, next_cursor, member_count, online_count = roster_page(
+            room_id,
+            after=request.GET.get('after'),
+            limit=max(limit, 1)
+        )
+    except ValueError:
+        return JsonResponse({'error': _('Invalid cursor')}, status=400)
+    
+    return JsonResponse({
+        'members': members,
+        'next_cursor': next_cursor,
+        'member_count': member_count,
+        'online_count': online_count,
+    })
+
+@login_required
+def message_history(request, room_id):
+    """
+    API endpoint to page backwards through a room's history
+    """
+    room = get_object_or_404(ChatRoom, id=room_id)
+    
+    # Check if user has access to the room
+    if not get_room_cache().can_view(room.id, request.user):
+        return JsonResponse({'error': _('Access denied')}, status=403)
+    
+    try:
+        limit = min(int(request.GET.get('limit', settings.CHAT_HISTORY_PAGE_SIZE)), settings.CHAT_HISTORY_MAX_PAGE_SIZE)
+        messages, has_more = message_page(
+            room.id,
+            before=request.GET.get('before'),
+            limit=max(limit, 1)
+        )
+    except ValueError:
+        return JsonResponse({'error': _('Invalid cursor')}, status=400)
+    
+    return JsonResponse({
+        'messages': [message.to_dict() for message in messages],
+        'has_more': has_more,
+        # None on the last page, like the roster endpoint
+        'next_cursor': messages[0].cursor if has_more else None,
+    })
+
+@login_required
+def export_room_history(request, room_id):
+    """
+    Stream a room's full history, archived messages included, as NDJSON
+    (default) or CSV (?format=csv); staff and the room's creator only
+    """
+    room = get_object_or_404(ChatRoom, id=room_id)
+    if not (request.user.is_staff or room.creator_id == request.user.id):
+        return JsonResponse({'error': _('Access denied')}, status=403)
+    
+    export_format = request.GET.get('format', 'ndjson')
+    if export_format not in transfer.FORMATS:
+        return JsonResponse({'error': _('Unknown format')}, status=400)
+    
+    response = StreamingHttpResponse(
+        transfer.aexport_chunks(room.id, export_format, settings.CHAT_EXPORT_CHUNK_SIZE),
+        content_type=transfer.CONTENT_TYPES[export_format]
+    )
+    response['Content-Disposition'] = f'attachment; filename="room-{room.id}.{export_format}"'
+    return response
+
 @login_required
 def create_room(request):
     """
@@ -96,6 +199,24 @@ def create_room(request):
     
     return render(request, 'chat/room_form.html', context)
 
+def queue_notification_fanout(message, member_count):
+    """
+    Hand the message's notifications to the notification worker; returns
+    False when the caller should fan out inline instead (small room, worker
+    disabled, or its channel full because the worker is behind or not running)
+    """
+    if not settings.CHAT_NOTIFICATION_WORKER or member_count <= settings.CHAT_NOTIFICATION_FANOUT_THRESHOLD:
+        return False
+    try:
+        async_to_sync(get_channel_layer().send)(NOTIFICATION_CHANNEL, {
+            'type': 'notification.fanout',
+            'message_id': str(message.id),
+        })
+    except ChannelFull:
+        logger.warning('Notification channel full; fanning out message %s inline', message.id)
+        return False
+    return True
+
 @login_required
 @require_POST
 def send_message(request, room_id):
@@ -105,7 +226,8 @@ def send_message(request, room_id):
     room = get_object_or_404(ChatRoom, id=room_id)
     
     # Check if user has access to the room
-    if request.user not in room.participants.all() and request.user != room.creator:
+    room_cache = get_room_cache()
+    if not room_cache.is_member(room.id, request.user):
         return JsonResponse({'error': _('Access denied')}, status=403)
     
     data = json.loads(request.body)
@@ -121,16 +243,18 @@ def send_message(request, room_id):
         content=content
     )
     
-    # Create notifications for other participants
-    participants = room.participants.exclude(id=request.user.id)
-    for participant in participants:
-        Notification.objects.create(
-            user=participant,
-            message=message
-        )
+    # Deliver it like a socket message, and keep it for reconnecting sockets
+    text = message_frame(message)
+    async_to_sync(group_send)(get_channel_layer(), f'chat_{room.id}', {'type': 'chat_message', 'text': text})
+    get_replay_buffer().append(room.id, message.cursor, text)
+    
+    # Create notifications for other participants; large rooms are handed
+    # to the notification worker so the response time stays constant
+    if not queue_notification_fanout(message, room_cache.get(room.id)['member_count']):
+        Notification.fan_out(message)
     
     # Update room's updated_at
-    room.save()
+    room.touch()
     
     return JsonResponse({
         'success': True,
@@ -154,16 +278,44 @@ def user_profile(request, username):
     return render(request, 'chat/profile.html', context)
 
 @login_required
+@csrf_exempt
 def edit_profile(request):
     """
     Edit user profile
     """
+    # Upload handlers can only change before request.POST is read, which the
+    # CSRF check does: hence csrf_exempt here and csrf_protect below
+    request.upload_handlers.insert(0, AvatarUploadHandler(request))
+    return _edit_profile(request)
+
+@csrf_protect
+def _edit_profile(request):
     profile, created = UserProfile.objects.get_or_create(user=request.user)
     
     if request.method == 'POST':
         form = UserProfileForm(request.POST, request.FILES, instance=profile)
+        if form.is_valid() and 'avatar' in getattr(request, 'oversized_uploads', ()):
+            # Cut off by AvatarUploadHandler, so the form never saw the file
+            form.add_error('avatar', _('Avatar images may be at most %(size)d MB.') % {
+                'size': settings.CHAT_AVATAR_MAX_UPLOAD_SIZE // (1024 * 1024),
+            })
         if form.is_valid():
-            form.save()
+            profile = form.save()
+            
+            # Thumbnails are rendered by the media worker; until they exist
+            # (or if it is behind) pages serve the original image
+            if 'avatar' in form.changed_data and profile.avatar:
+                try:
+                    async_to_sync(get_channel_layer().send)(MEDIA_CHANNEL, {
+                        'type': 'avatar.variants',
+                        'profile_id': profile.id,
+                        'avatar': profile.avatar.name,
+                    })
+                except ChannelFull:
+                    logger.warning(
+                        'Media channel full; serving the original avatar for profile %s '
+                        'until generate_avatar_variants runs', profile.id,
+                    )
             
             # Update language preference in session
             request.session['django_language'] = form.cleaned_data['language']
@@ -184,9 +336,9 @@ def notifications(request):
     """
     User notifications
     """
-    notifications = Notification.objects.filter(
-        user=request.user
-    ).order_by('-created_at')[:50]
+    notifications = Notification.objects.with_read_state(
+        request.user
+    ).select_related('message').order_by('-created_at')[:50]
     
     context = {
         'notifications': notifications,
@@ -217,9 +369,7 @@ def get_online_users(request):
     """
     API endpoint to get online users
     """
-    online_users = UserProfile.objects.filter(
-        online_status=True
-    ).exclude(user=request.user).select_related('user')
+    online_users = online_contacts(request.user)
     
     users_data = [
         {
@@ -243,11 +393,8 @@ def search_users(request):
     if not query or len(query) < 2:
         return JsonResponse({'users': []})
     
-    users = User.objects.filter(
-        Q(username__icontains=query) |
-        Q(first_name__icontains=query) |
-        Q(last_name__icontains=query)
-    ).exclude(id=request.user.id)[:10]
+    # Ranked lookup against the autocomplete index (see chat.autocomplete)
+    users = autocomplete.search_users(query, request.user, limit=10)
     
     users_data = [
         {
@@ -258,4 +405,60 @@ def search_users(request):
         for user in users
     ]
     
-    return JsonResponse({'users': users_data})
\ No newline at end of file
+    return JsonResponse({'users': users_data})
+
+@login_required
+def search_room_messages(request, room_id):
+    """
+    API endpoint to search message content within a room
+    """
+    if not get_room_cache().can_view(room_id, request.user):
+        return JsonResponse({'error': _('Access denied')}, status=403)
+    
+    query = request.GET.get('q', '').strip()
+    if len(query) < 2:
+        return JsonResponse({'results': [], 'has_more': False})
+    
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    
+    results, has_more = search_messages(
+        room_id, query,
+        page=page,
+        page_size=settings.CHAT_SEARCH_PAGE_SIZE
+    )
+    
+    return JsonResponse({
+        'results': results,
+        'page': page,
+        'has_more': has_more,
+    })
+
+
+def avatar_variant(request, path):
+    """
+    Serve an avatar thumbnail. Names are content hashes that never change,
+    so responses may be cached for a year without revalidation.
+    """
+    response = serve(request, path, document_root=os.path.join(settings.MEDIA_ROOT, settings.CHAT_AVATAR_VARIANT_DIR))
+    patch_cache_control(response, public=True, max_age=settings.CHAT_AVATAR_VARIANT_MAX_AGE, immutable=True)
+    return response
+
+def metrics_authorized(request):
+    if request.user.is_staff or request.META.get('REMOTE_ADDR') in settings.CHAT_METRICS_ALLOWED_IPS:
+        return True
+    scheme, _space, token = request.headers.get('Authorization', '').partition(' ')
+    return bool(settings.CHAT_METRICS_TOKEN) and scheme.lower() == 'bearer' and hmac.compare_digest(
+        token.encode(), settings.CHAT_METRICS_TOKEN.encode()
+    )
+
+def metrics(request):
+    """
+    This process's instrumentation in the Prometheus text format; other
+    workers' numbers are not included (see CHAT_METRICS_TOKEN in settings)
+    """
+    if not metrics_authorized(request):
+        return HttpResponseForbidden()
+    return HttpResponse(get_registry().render(), content_type='text/plain; version=0.0.4; charset=utf-8')
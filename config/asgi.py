@@ -1,9 +1,10 @@
 import os
 from django.core.asgi import get_asgi_application
-from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.routing import ChannelNameRouter, ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 from channels.security.websocket import AllowedHostsOriginValidator
 import chat.routing  # استدعاء ملف routing الخاص بالتطبيق
+import chat.consumers
 
 # تحديد إعدادات Django
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
@@ -21,4 +22,10 @@ application = ProtocolTypeRouter({
             )
         )
     ),
+
+    # العمّال في الخلفية (manage.py runworker chat-notifications chat-media)
+    'channel': ChannelNameRouter({
+        chat.consumers.NOTIFICATION_CHANNEL: chat.consumers.NotificationWorker.as_asgi(),
+        chat.consumers.MEDIA_CHANNEL: chat.consumers.MediaWorker.as_asgi(),
+    }),
 })
@@ -54,12 +54,14 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chat.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.locale.LocaleMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'chat.preferences.UserPreferencesMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'allauth.account.middleware.AccountMiddleware',
@@ -80,6 +82,7 @@ TEMPLATES = [
                 'django.contrib.messages.context_processors.messages',
                 'chat.context_processors.language_processor',
                 'chat.context_processors.dark_mode_processor',
+                'chat.context_processors.unread_processor',
             ],
         },
     },
@@ -145,15 +148,176 @@ MEDIA_ROOT = BASE_DIR / 'media'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # Channels configuration
+# Each channel buffers at most `capacity` events for `expiry` seconds; slow
+# sockets are handled by the consumer's outbound queue before that limit
 CHANNEL_LAYERS = {
     'default': {
         'BACKEND': 'channels_redis.core.RedisChannelLayer',
         'CONFIG': {
             "hosts": [('127.0.0.1', 6379)],
+            "capacity": 300,
+            "expiry": 30,
         },
     },
 }
 
+# Shared cache (room access, preferences, user search, rendered messages) in
+# the channel layer's Redis: invalidation by signal must reach every worker,
+# so a per-process LocMemCache is not an option outside a single process
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379/1',
+    },
+}
+
+# Chat history paging
+CHAT_HISTORY_PAGE_SIZE = 50
+CHAT_HISTORY_MAX_PAGE_SIZE = 200
+
+# Write-behind message persistence: broadcast first, then bulk_create in
+# batches of CHAT_WRITE_BEHIND_BATCH_SIZE or every FLUSH_INTERVAL seconds.
+# A batch failing MAX_RETRIES times is written message by message; messages
+# that still fail are logged to the chat.persistence.dead_letter logger.
+CHAT_WRITE_BEHIND = False
+CHAT_WRITE_BEHIND_BATCH_SIZE = 100
+CHAT_WRITE_BEHIND_FLUSH_INTERVAL = 0.05
+CHAT_WRITE_BEHIND_MAX_RETRIES = 3
+
+# Rooms with more participants than this fan out notifications on the
+# chat-notifications background worker instead of in the request. The
+# worker must be running (manage.py runworker chat-notifications); without
+# one, set CHAT_NOTIFICATION_WORKER = False to always fan out inline. When
+# the worker's channel is full, the request fans out inline as well.
+CHAT_NOTIFICATION_FANOUT_THRESHOLD = 200
+CHAT_NOTIFICATION_WORKER = True
+
+# Presence: connections per user are tracked in the channel layer's Redis
+# (use chat.presence.LocalPresenceStore for a single-process setup) and
+# expire after CHAT_PRESENCE_TTL seconds without a heartbeat
+CHAT_PRESENCE_BACKEND = 'chat.presence.RedisPresenceStore'
+CHAT_PRESENCE_TTL = 60
+
+# Typing indicators: at most one aggregated frame per room every
+# CHAT_TYPING_INTERVAL seconds, listing up to CHAT_TYPING_MAX_TYPISTS users;
+# typists are dropped after CHAT_TYPING_TIMEOUT seconds without a frame
+CHAT_TYPING_INTERVAL = 0.5
+CHAT_TYPING_MAX_TYPISTS = 5
+CHAT_TYPING_TIMEOUT = 5
+
+# Encoder for WebSocket frames: 'auto' uses orjson when installed, or a
+# dotted path to a callable returning a str
+CHAT_JSON_ENCODER = 'auto'
+
+# Room metadata cache: a per-process LRU (size, TTL in seconds) in front of
+# the default cache backend, which also holds per-(room, user) membership
+CHAT_ROOM_CACHE_SIZE = 1024
+CHAT_ROOM_CACHE_LOCAL_TTL = 5
+CHAT_ROOM_CACHE_TTL = 300
+
+# Read receipts: cursor advances are written and broadcast at most once
+# per interval (seconds) per process
+CHAT_READ_RECEIPT_INTERVAL = 1.0
+
+# Archival: messages older than this many days move from the hot Message
+# table to ArchivedMessage (manage.py archive_messages, run on a schedule)
+CHAT_ARCHIVE_AFTER_DAYS = 90
+CHAT_ARCHIVE_BATCH_SIZE = 1000
+
+# Reconnect replay: the last CHAT_REPLAY_BUFFER_SIZE chat messages of each
+# room are kept for CHAT_REPLAY_TTL seconds (in the channel layer's Redis;
+# chat.replay.LocalReplayBuffer for a single process) so a reconnecting
+# socket only receives the messages it missed. Gaps the buffer no longer
+# covers are read from the database, up to the same number of messages.
+CHAT_REPLAY_BACKEND = 'chat.replay.RedisReplayBuffer'
+CHAT_REPLAY_BUFFER_SIZE = 200
+CHAT_REPLAY_TTL = 3600
+
+# Room participant list: online members first, CHAT_ROSTER_PAGE_SIZE per page
+CHAT_ROSTER_PAGE_SIZE = 50
+CHAT_ROSTER_MAX_PAGE_SIZE = 200
+
+# Multiplexed sockets (ws/chat/) may follow at most this many rooms. The
+# endpoint, and the extra inbox_<room> group_send it costs every chat
+# message, are off until a client uses it: set CHAT_MULTIPLEX = True.
+CHAT_MULTIPLEX = False
+CHAT_MULTIPLEX_MAX_ROOMS = 500
+
+# Slow consumers: each socket queues at most CHAT_OUTBOUND_QUEUE_SIZE frames.
+# Typing/presence/receipt frames are dropped once the queue is
+# CHAT_OUTBOUND_EPHEMERAL_RATIO full; a full queue collapses into a single
+# resync frame, and more than CHAT_SLOW_CONSUMER_MAX_RESYNCS resyncs within
+# CHAT_SLOW_CONSUMER_WINDOW seconds closes the socket. Frames are only held
+# back while the socket's write buffer is full when served by
+# `python -m chat.server config.asgi:application` (daphne with a hook that
+# passes the transport to the consumer); under plain daphne they are handed
+# straight to Twisted's buffer
+CHAT_OUTBOUND_QUEUE_SIZE = 200
+CHAT_OUTBOUND_EPHEMERAL_RATIO = 0.5
+CHAT_SLOW_CONSUMER_MAX_RESYNCS = 3
+CHAT_SLOW_CONSUMER_WINDOW = 60
+
+# Instrumentation: per-view/per-event latency and group_send latency/size
+# histograms; database query counts and times are collected for a
+# CHAT_METRICS_SAMPLE_RATE fraction of requests and events. Served in the
+# Prometheus text format at /metrics/ to staff and to scrapers sending
+# "Authorization: Bearer <CHAT_METRICS_TOKEN>". CHAT_METRICS_ALLOWED_IPS
+# matches REMOTE_ADDR, which behind a reverse proxy is the proxy's own
+# address, so only list addresses that reach the server directly.
+# Each worker process keeps and serves its own numbers: scrape every
+# process on its own address, not through the load balancer, and sum
+# the series in Prometheus.
+CHAT_METRICS_ENABLED = True
+CHAT_METRICS_SAMPLE_RATE = 0.1
+CHAT_METRICS_TOKEN = None
+CHAT_METRICS_ALLOWED_IPS = []
+
+# Avatars: uploads above CHAT_AVATAR_MAX_UPLOAD_SIZE bytes or
+# CHAT_AVATAR_MAX_PIXELS pixels are rejected; the media worker
+# (manage.py runworker chat-media) renders square WebP + JPEG/PNG thumbnails
+# for each size into CHAT_AVATAR_VARIANT_DIR. Thumbnail names are content
+# hashes, so chat.views.avatar_variant serves that directory with
+# `immutable` cache headers for CHAT_AVATAR_VARIANT_MAX_AGE seconds.
+CHAT_AVATAR_MAX_UPLOAD_SIZE = 5 * 1024 * 1024
+CHAT_AVATAR_MAX_PIXELS = 40_000_000
+CHAT_AVATAR_SIZES = [32, 40, 64, 80]
+CHAT_AVATAR_VARIANT_DIR = 'avatars/variants'
+CHAT_AVATAR_VARIANT_MAX_AGE = 365 * 24 * 3600
+
+# Uploads are streamed to temporary files beyond this size instead of
+# being held in memory; the profile view also stops reading avatars past
+# CHAT_AVATAR_MAX_UPLOAD_SIZE (chat.avatars.AvatarUploadHandler)
+FILE_UPLOAD_MAX_MEMORY_SIZE = 256 * 1024
+
+# History export/import (api/room/<id>/export/, manage.py export_room_history
+# and import_room_history): rows read and streamed per chunk, and messages
+# written per bulk_create transaction
+CHAT_EXPORT_CHUNK_SIZE = 2000
+CHAT_IMPORT_BATCH_SIZE = 1000
+
+# Admin changelists count at most this many rows exactly; larger unfiltered
+# tables show the database's row estimate and are browsed with keyset links
+CHAT_ADMIN_EXACT_COUNT_LIMIT = 10000
+
+# Rendered message bubbles are cached per message, sent/received variant,
+# language and time zone in the default cache backend (seconds)
+CHAT_MESSAGE_FRAGMENT_TTL = 86400
+
+# Per-user theme/language/avatar preferences, cached in the shared default
+# cache backend (seconds); dropped whenever the profile is saved
+CHAT_PREFERENCES_CACHE_TTL = 3600
+
+# Message search: 'auto' picks SQLite FTS5 or PostgreSQL full-text search
+# from the database vendor; or a dotted path to a chat.search backend
+CHAT_SEARCH_BACKEND = 'auto'
+CHAT_SEARCH_PAGE_SIZE = 20
+
+# Seconds to cache user-search results for hot prefixes, and each user's
+# contact ids (at most CHAT_USER_SEARCH_MAX_CONTACTS, ranked first; the
+# index page's online users are drawn from the same contacts)
+CHAT_USER_SEARCH_CACHE_TTL = 60
+CHAT_USER_SEARCH_MAX_CONTACTS = 1000
+
 # Authentication
 AUTHENTICATION_BACKENDS = [
     'django.contrib.auth.backends.ModelBackend',
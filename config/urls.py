@@ -4,11 +4,18 @@ from django.conf.urls.i18n import i18n_patterns
 from django.conf import settings
 from django.conf.urls.static import static
 from django.views.generic import RedirectView
+from chat import views as chat_views
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('i18n/', include('django.conf.urls.i18n')),
     path('accounts/', include('allauth.urls')),
+    # Outside i18n_patterns so scrapers are not redirected to a language prefix
+    path('metrics/', chat_views.metrics, name='metrics'),
+    path(
+        f"{settings.MEDIA_URL.lstrip('/')}{settings.CHAT_AVATAR_VARIANT_DIR}/<path:path>",
+        chat_views.avatar_variant, name='avatar_variant'
+    ),
 ]
 
 urlpatterns += i18n_patterns(